@@ -1,105 +1,492 @@
 import portalocker
 import time
 import os
-from typing import Optional
+import json
+import socket
+import sys
+import threading
+import uuid
+from filelock import FileLock
+from typing import Optional, Any
+
+LOCK_STATS_FILE = 'stats.jsonl'
+MAX_LOCK_STATS_SIZE = 64 * 1024 ** 2 # bytes, the file is rotated to stats.jsonl.1 once
+# histogram bucket upper bounds in seconds, the last bucket is open ended
+LOCK_HISTOGRAM_BUCKETS = [0.001, 0.01, 0.1, 1, 10, 60]
+LEASE_TIMEOUT = 30 # seconds without a heartbeat before a lock holder's lease expires
+LEASE_HEARTBEAT = 5 # seconds between heartbeats of a holder
+LEASE_CHECK_INTERVAL = 1 # seconds between lease checks of a waiter
+
+# shared locks held by this process, keyed by lock file. Readers that already hold a lock skip the
+# turnstile: a writer queued on it would otherwise wait for them while they wait for the writer.
+_held_shared: dict[str, int] = {}
+_held_shared_lock = threading.Lock()
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def process_alive(host: str, pid: int) -> bool:
+    '''Processes on other hosts are assumed to be alive.'''
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Heartbeat:
+    """Refreshes the mtime of the lease records of every lock this process holds."""
+    def __init__(self):
+        self.leases = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, lease_path: str) -> None:
+        with self.lock:
+            self.leases.add(lease_path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def remove(self, lease_path: str) -> None:
+        with self.lock:
+            self.leases.discard(lease_path)
+
+    def _run(self):
+        while True:
+            time.sleep(LEASE_HEARTBEAT)
+            with self.lock:
+                leases = list(self.leases)
+            for lease_path in leases:
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    pass
+
+_heartbeat = _Heartbeat()
+
+
+def _write_lease(lock_path: str, mode: str) -> str:
+    lease_dir = lock_path + '.lease'
+    os.makedirs(lease_dir, exist_ok=True)
+    lease_path = os.path.join(lease_dir, f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}')
+    with open(lease_path, 'w') as file:
+        json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'mode': mode,
+                   'thread': threading.get_ident(), 'acquired': time.time()}, file)
+    _heartbeat.add(lease_path)
+    return lease_path
+
+
+def _release_lease(lease_path: Optional[str]) -> None:
+    if lease_path is None:
+        return
+    _heartbeat.remove(lease_path)
+    try:
+        os.remove(lease_path)
+    except FileNotFoundError:
+        pass
+
+
+def _expired_leases(lock_path: str, mode: str) -> Optional[list[str]]:
+    """
+    Lease records of the holders of a lock if all of them expired and one of them blocks mode, None otherwise.
+    A lease expires when its holder is gone or hasn't sent a heartbeat for LEASE_TIMEOUT seconds.
+    """
+    lease_dir = lock_path + '.lease'
+    if not os.path.isdir(lease_dir):
+        return None
+    expired = []
+    blocking = False
+    for name in os.listdir(lease_dir):
+        lease_path = os.path.join(lease_dir, name)
+        try:
+            with open(lease_path, 'r') as file:
+                lease = json.load(file)
+            heartbeat = os.path.getmtime(lease_path)
+        except FileNotFoundError:
+            continue
+        except json.JSONDecodeError:
+            # still being written by a new holder
+            return None
+        if process_alive(lease['host'], lease['pid']) and time.time() - heartbeat < LEASE_TIMEOUT:
+            return None
+        expired.append(lease_path)
+        blocking = blocking or mode == 'exclusive' or lease['mode'] == 'exclusive'
+    if not blocking:
+        return None
+    return expired
+
+
+def _inode_changed(lock_path: str, handle) -> bool:
+    try:
+        return os.stat(lock_path).st_ino != os.fstat(handle.fileno()).st_ino
+    except FileNotFoundError:
+        return True
+
+
+def _break_lock(lock_path: str, handle, mode: str) -> None:
+    """
+    Steals a lock whose holders' leases all expired by swapping in a new lock file. The old holders keep
+    a lock on the unlinked file that nobody else waits for.
+    """
+    with FileLock(lock_path + '.break'):
+        if _inode_changed(lock_path, handle):
+            # someone else broke it already
+            return
+        expired = _expired_leases(lock_path, mode)
+        if expired is None:
+            return
+        temp_path = f'{lock_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        open(temp_path, 'a').close()
+        os.replace(temp_path, lock_path)
+        for lease_path in expired:
+            _release_lease(lease_path)
+
+
+class _LockWaiter:
+    """
+    Waits for a lock on an open handle from a helper thread (in the kernel unless check_interval is given),
+    so the caller can give up or look at leases while it waits. An abandoned waiter closes its handle and
+    releases the lock if it is granted later.
+    """
+    def __init__(self, handle, flags, check_interval=None):
+        self.handle = handle
+        self.flags = flags
+        self.check_interval = check_interval
+        self.acquired = False
+        self.abandoned = False
+        self.error = None
+        self.state_lock = threading.Lock()
+        self.done = threading.Event()
+        try:
+            portalocker.lock(handle, flags | portalocker.LOCK_NB)
+            self.acquired = True
+            self.done.set()
+        except portalocker.exceptions.LockException:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _lock(self) -> bool:
+        if self.check_interval is None:
+            portalocker.lock(self.handle, self.flags)
+            return True
+        while True:
+            with self.state_lock:
+                if self.abandoned:
+                    self.handle.close()
+                    return False
+            try:
+                portalocker.lock(self.handle, self.flags | portalocker.LOCK_NB)
+                return True
+            except portalocker.exceptions.LockException:
+                time.sleep(self.check_interval)
+
+    def _run(self):
+        try:
+            if not self._lock():
+                return
+        except Exception as e:
+            self.error = e
+            self.done.set()
+            return
+        with self.state_lock:
+            if self.abandoned:
+                portalocker.unlock(self.handle)
+                self.handle.close()
+            else:
+                self.acquired = True
+        self.done.set()
+
+    def wait(self, timeout) -> bool:
+        self.done.wait(timeout)
+        with self.state_lock:
+            if self.error is not None:
+                self.handle.close()
+                raise self.error
+            return self.acquired
+
+    def abandon(self):
+        with self.state_lock:
+            if self.acquired:
+                portalocker.unlock(self.handle)
+                self.handle.close()
+            elif self.done.is_set():
+                self.handle.close()
+            else:
+                self.abandoned = True
+
+
+def _lock_file(lock_path: str, flags, mode: str, deadline: Optional[float], check_interval=None, lease: bool = True):
+    """
+    Locks lock_path, stealing it if the leases of its holders expired.
+
+    :return: (handle, lease record) or None on timeout.
+    """
+    while True:
+        handle = open(lock_path, 'a+')
+        waiter = _LockWaiter(handle, flags, check_interval)
+        expired_checks = 0
+        acquired = False
+        while not acquired:
+            wait = LEASE_CHECK_INTERVAL if deadline is None else min(LEASE_CHECK_INTERVAL, _remaining(deadline))
+            acquired = waiter.wait(wait)
+            if acquired:
+                break
+            if deadline is not None and time.time() >= deadline:
+                waiter.abandon()
+                return None
+            # a holder that just got the lock may not have written its lease yet, so look twice
+            expired_checks = expired_checks + 1 if _expired_leases(lock_path, mode) is not None else 0
+            if expired_checks >= 2:
+                _break_lock(lock_path, handle, mode)
+            if _inode_changed(lock_path, handle):
+                break
+        if not acquired or _inode_changed(lock_path, handle):
+            # the lock was broken while we waited for it (or between open and lock), retry on the new file
+            waiter.abandon()
+            continue
+        return handle, _write_lease(lock_path, mode) if lease else None
+
+
+class LockStats:
+    """
+    Records every hold of a lock (wait time, hold time, holder, mode) as one json line in
+    <db>/locks/stats.jsonl. Lock names are relative to <db>/locks.
+    """
+    def __init__(self, db_dir: str):
+        self.stats_file = os.path.join(db_dir, 'locks', LOCK_STATS_FILE)
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+
+    def record(self, lock: str, mode: str, wait: float, hold: Optional[float], timed_out: bool = False) -> None:
+        event = {'lock': lock, 'mode': mode, 'wait': wait, 'hold': hold, 'timed_out': timed_out,
+                 'holder': f'{self.holder}:{threading.get_ident()}', 'time': time.time()}
+        try:
+            if os.path.getsize(self.stats_file) > MAX_LOCK_STATS_SIZE:
+                os.replace(self.stats_file, self.stats_file + '.1')
+        except FileNotFoundError:
+            pass
+        # single small appends are atomic, no lock needed
+        with open(self.stats_file, 'a') as file:
+            file.write(json.dumps(event) + '\n')
+
+
+def _histogram(values: list[float]) -> dict[str, Any]:
+    values = sorted(values)
+    if len(values) == 0:
+        return {'count': 0}
+    def percentile(p):
+        return values[min(int(p * len(values)), len(values) - 1)]
+    buckets = {}
+    lower = 0
+    for upper in LOCK_HISTOGRAM_BUCKETS:
+        buckets[f'<{upper}s'] = sum(1 for v in values if lower <= v < upper)
+        lower = upper
+    buckets[f'>={lower}s'] = sum(1 for v in values if v >= lower)
+    return {'count': len(values), 'total': sum(values), 'mean': sum(values) / len(values),
+            'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99), 'max': values[-1],
+            'buckets': buckets}
+
+
+def lock_histograms(db_dir: str, since: Optional[float] = None) -> dict[str, dict[str, Any]]:
+    '''Wait and hold time histograms per lock and mode ("<lock> <mode>"), from <db>/locks/stats.jsonl.'''
+    stats_file = os.path.join(db_dir, 'locks', LOCK_STATS_FILE)
+    events = {}
+    for path in (stats_file + '.1', stats_file):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since != None and event['time'] < since:
+                    continue
+                events.setdefault(f"{event['lock']} {event['mode']}", []).append(event)
+    histograms = {}
+    for key, lock_events in sorted(events.items()):
+        histograms[key] = {'wait': _histogram([e['wait'] for e in lock_events]),
+                           'hold': _histogram([e['hold'] for e in lock_events if e['hold'] != None]),
+                           'timeouts': sum(1 for e in lock_events if e['timed_out'])}
+    return histograms
+
 
 class MultiLock:
     """
     A multi-lock allowing multiple readers or one writer at a time,
     with optional timeout support.
+
+    Waiting happens in the kernel on a single open handle. Writers queue on a turnstile file
+    (<lock_file>.queue) that new readers have to pass through, so a stream of readers
+    can't starve a waiting writer.
+
+    Every holder writes a lease record (pid, host, mode) to <lock_file>.lease/ and refreshes it
+    with a heartbeat. Waiters steal the lock once the leases of all its holders expired.
     """
-    def __init__(self, lock_file):
+    def __init__(self, lock_file, stats: Optional[LockStats] = None, name: Optional[str] = None):
         """
         Initializes the ReadWriteLock with the specified lock file.
         
         :param lock_file: Path to the lock file used for synchronization.
+        :param stats: Where wait and hold times are recorded, nothing is recorded when None.
+        :param name: Name of the lock in the stats, defaults to lock_file.
         """
         self.lock_file = lock_file
+        self.stats = stats
+        self.name = name if name != None else lock_file
+        self.read_wait = 0
+        self.write_wait = 0
+        self.last_wait = 0
+        self.read_acquired = None
+        self.write_acquired = None
+        self.queue_file = lock_file + '.queue'
         self.read_handle = None
         self.write_handle = None
+        self.read_lease = None
+        self.write_lease = None
 
-        # Ensure the lock file exists
-        if not os.path.exists(self.lock_file):
-            open(self.lock_file, 'a').close()
+        # Ensure the lock files exist
+        for path in (self.lock_file, self.queue_file):
+            if not os.path.exists(path):
+                open(path, 'a').close()
 
-    def acquire_shared(self, timeout=None, check_interval=0.1):
+    def _key(self):
+        return os.path.realpath(self.lock_file)
+
+    def _acquire_turnstile(self, deadline, check_interval, lease=True):
+        return _lock_file(self.queue_file, portalocker.LOCK_EX, 'exclusive', deadline, check_interval, lease)
+
+    def _release_turnstile(self, queue):
+        queue_handle, queue_lease = queue
+        _release_lease(queue_lease)
+        try:
+            portalocker.unlock(queue_handle)
+        finally:
+            queue_handle.close()
+
+    def _timed(self, acquire, mode, timeout, check_interval) -> float:
+        start_time = time.time()
+        try:
+            acquire(timeout, check_interval)
+        except TimeoutError:
+            if self.stats != None:
+                self.stats.record(self.name, mode, time.time() - start_time, None, timed_out=True)
+            raise
+        return time.time() - start_time
+
+    def acquire_shared(self, timeout=None, check_interval=None):
         """
         Acquires a shared (read) lock.
 
         :param timeout: Maximum time (in seconds) to wait for the lock. None means wait indefinitely.
-        :param check_interval: Time (in seconds) between lock acquisition attempts.
+        :param check_interval: Poll every check_interval seconds instead of waiting in the kernel.
         :return: True if the lock was acquired, False otherwise.
         :raises TimeoutError: If the lock could not be acquired within the timeout.
         """
-        start_time = time.time()
-        while True:
-            try:
-                # Open the lock file in read mode
-                self.read_handle = open(self.lock_file, 'r')
-                # Attempt to acquire a shared lock without blocking
-                portalocker.lock(self.read_handle, portalocker.LOCK_SH | portalocker.LOCK_NB)
-                return True  # Lock acquired
-            except (portalocker.exceptions.LockException, IOError):
-                # Failed to acquire lock
-                if self.read_handle:
-                    self.read_handle.close()
-                    self.read_handle = None
-                if timeout is not None and (time.time() - start_time) >= timeout:
-                    raise TimeoutError("Timeout while trying to acquire read lock.")
-                time.sleep(check_interval)
+        self.read_wait = self._timed(self._acquire_shared, 'shared', timeout, check_interval)
+        self.last_wait = self.read_wait
+        self.read_acquired = time.time()
+        return True
+
+    def _acquire_shared(self, timeout, check_interval):
+        deadline = None if timeout is None else time.time() + timeout
+        with _held_shared_lock:
+            held = _held_shared.get(self._key(), 0) > 0
+        if not held:
+            # readers pass straight through, no lease needed
+            queue = self._acquire_turnstile(deadline, check_interval, lease=False)
+            if queue is None:
+                raise TimeoutError("Timeout while trying to acquire read lock.")
+            self._release_turnstile(queue)
+        locked = _lock_file(self.lock_file, portalocker.LOCK_SH, 'shared', deadline, check_interval)
+        if locked is None:
+            raise TimeoutError("Timeout while trying to acquire read lock.")
+        self.read_handle, self.read_lease = locked
+        with _held_shared_lock:
+            _held_shared[self._key()] = _held_shared.get(self._key(), 0) + 1
+        return True
 
     def release_shared(self):
         """
         Releases the shared (read) lock.
         """
         if self.read_handle:
+            _release_lease(self.read_lease)
+            self.read_lease = None
             try:
                 portalocker.unlock(self.read_handle)
             finally:
                 self.read_handle.close()
                 self.read_handle = None
+                with _held_shared_lock:
+                    count = _held_shared.get(self._key(), 0) - 1
+                    if count > 0:
+                        _held_shared[self._key()] = count
+                    else:
+                        _held_shared.pop(self._key(), None)
+                if self.stats != None and self.read_acquired != None:
+                    self.stats.record(self.name, 'shared', self.read_wait, time.time() - self.read_acquired)
+                self.read_acquired = None
 
-    def acquire_exclusive(self, timeout=None, check_interval=0.1):
+    def acquire_exclusive(self, timeout=None, check_interval=None):
         """
         Acquires an exclusive (write) lock.
 
         :param timeout: Maximum time (in seconds) to wait for the lock. None means wait indefinitely.
-        :param check_interval: Time (in seconds) between lock acquisition attempts.
+        :param check_interval: Poll every check_interval seconds instead of waiting in the kernel.
         :return: True if the lock was acquired, False otherwise.
         :raises TimeoutError: If the lock could not be acquired within the timeout.
         """
-        start_time = time.time()
-        while True:
-            try:
-                # Open the lock file in append mode to ensure it exists
-                self.write_handle = open(self.lock_file, 'a+')
-                # Attempt to acquire an exclusive lock without blocking
-                portalocker.lock(self.write_handle, portalocker.LOCK_EX | portalocker.LOCK_NB)
-                return True  # Lock acquired
-            except (portalocker.exceptions.LockException, IOError):
-                # Failed to acquire lock
-                if self.write_handle:
-                    self.write_handle.close()
-                    self.write_handle = None
-                if timeout is not None and (time.time() - start_time) >= timeout:
-                    raise TimeoutError("Timeout while trying to acquire write lock.")
-                time.sleep(check_interval)
+        self.write_wait = self._timed(self._acquire_exclusive, 'exclusive', timeout, check_interval)
+        self.last_wait = self.write_wait
+        self.write_acquired = time.time()
+        return True
+
+    def _acquire_exclusive(self, timeout, check_interval):
+        deadline = None if timeout is None else time.time() + timeout
+        # holding the turnstile keeps new readers out while the current ones drain
+        queue = self._acquire_turnstile(deadline, check_interval)
+        if queue is None:
+            raise TimeoutError("Timeout while trying to acquire write lock.")
+        try:
+            locked = _lock_file(self.lock_file, portalocker.LOCK_EX, 'exclusive', deadline, check_interval)
+            if locked is None:
+                raise TimeoutError("Timeout while trying to acquire write lock.")
+            self.write_handle, self.write_lease = locked
+        finally:
+            self._release_turnstile(queue)
+        return True
 
     def release_exclusive(self):
         """
         Releases the exclusive (write) lock.
         """
         if self.write_handle:
+            _release_lease(self.write_lease)
+            self.write_lease = None
             try:
                 portalocker.unlock(self.write_handle)
             finally:
                 self.write_handle.close()
                 self.write_handle = None
+                if self.stats != None and self.write_acquired != None:
+                    self.stats.record(self.name, 'exclusive', self.write_wait, time.time() - self.write_acquired)
+                self.write_acquired = None
 
     def __del__(self):
         """
         Destructor to ensure that any held locks are released.
         """
+        if sys.is_finalizing():
+            # files can't be opened anymore, the hold time is lost
+            self.stats = None
         self.release_shared()
         self.release_exclusive()
 
@@ -116,22 +503,34 @@ def clean_up_locks(db_dir: str):
 
 class DatabaseLock():
     def __init__(self, db_dir: str,  table_name:Optional[str] = None, instance_id:Optional[str] = None):
+        self.stats = LockStats(db_dir)
         db_lock_dir = os.path.join(db_dir, 'locks', 'DATABASE.lock')
-        self.db_lock = MultiLock(db_lock_dir)
+        self.db_lock = MultiLock(db_lock_dir, self.stats, 'DATABASE.lock')
         if table_name:
             
             table_lock_dir = os.path.join(db_dir, 'locks', table_name)
             if not os.path.exists(table_lock_dir):
                 os.mkdir(table_lock_dir)
             table_lock_dir = os.path.join(table_lock_dir, 'TABLE.lock')
-            self.table_lock = MultiLock(table_lock_dir)
+            self.table_lock = MultiLock(table_lock_dir, self.stats, f'{table_name}/TABLE.lock')
         if instance_id:
             instance_lock_dir = os.path.join(db_dir, 'locks', table_name, f'{instance_id}.lock')
-            self.instance_lock = MultiLock(instance_lock_dir)
+            self.instance_lock = MultiLock(instance_lock_dir, self.stats, f'{table_name}/{instance_id}.lock')
         self.table_id = instance_id
         self.table_name = table_name
 
-    def acquire_shared_lock(self, timeout=None, check_interval=0.1):
+    def _locks(self) -> list[MultiLock]:
+        if self.table_id:
+            return [self.db_lock, self.table_lock, self.instance_lock]
+        elif self.table_name:
+            return [self.db_lock, self.table_lock]
+        return [self.db_lock]
+
+    def wait_times(self) -> dict[str, float]:
+        '''Seconds spent waiting for each level of the last acquisition, stored with the process that waited.'''
+        return {lock.name: lock.last_wait for lock in self._locks()}
+
+    def acquire_shared_lock(self, timeout=None, check_interval=None):
         try:
             if self.table_id:
                 self.db_lock.acquire_shared(timeout, check_interval)
@@ -146,7 +545,7 @@ class DatabaseLock():
             self.release_shared_lock()
             raise e
 
-    def acquire_exclusive_lock(self, timeout=None, check_interval=0.1):
+    def acquire_exclusive_lock(self, timeout=None, check_interval=None):
         try:
             if self.table_id:
                 self.db_lock.acquire_shared(timeout, check_interval)
@@ -1,8 +1,15 @@
 import argparse
 import os
+import pprint
+from datetime import datetime
 from auto_data_table import table_operations
+from auto_data_table import pipeline_operations
 from auto_data_table import file_operations
-from auto_data_table.meta_operations import MetaDataStore
+from auto_data_table.meta_operations import get_metadata_store
+from auto_data_table.sqlite_meta_operations import migrate_json_metadata
+from auto_data_table.storage_operations import DEFAULT_STORAGE, STORAGE_BACKENDS
+from auto_data_table.database_lock import lock_histograms
+from auto_data_table.prompt_execution.memo_store import get_memo_stats
 
 #TODO: OPERATIONS
 # create table instance
@@ -20,33 +27,65 @@ if __name__ == "__main__":
     # operator specific operations
     parser.add_argument("-t","--table", type=str)
     parser.add_argument('-r', '--replace', action='store_true')
+    parser.add_argument('-md', '--metadata', type=str, default='sqlite', choices=['sqlite', 'json'])
     parser.add_argument('-m', '--multiple', action='store_true')
+    parser.add_argument('-s', '--storage', type=str, default=DEFAULT_STORAGE, choices=list(STORAGE_BACKENDS.keys()))
     parser.add_argument('-pid', '--prev_id', type=str, default = '')
     parser.add_argument('-p', '--prompts', nargs='*', type=str, default=[])
     parser.add_argument('-gp', '--gen_prompt', type=str, default = '')
     parser.add_argument('-id', '--instance_id', type=str, default = 'TEMP')
     parser.add_argument('-ex', '--excluded', nargs='*', type=str, default=[])
+    parser.add_argument('-ri', '--recover_instance', type=str, default=None)
+    parser.add_argument('-th', '--threads', type=int, default=table_operations.DEFAULT_THREAD_BUDGET)
+    parser.add_argument('-ts', '--tables', nargs='*', type=str, default=[])
+    parser.add_argument('--parallel_tables', type=int, default=pipeline_operations.DEFAULT_PARALLEL_TABLES)
+    # log history queries
+    parser.add_argument('--history', action='store_true')
+    parser.add_argument('--log_operation', type=str, default=None)
+    parser.add_argument('--log_instance', type=str, default=None)
+    parser.add_argument('--since', type=str, default=None)
+    parser.add_argument('--until', type=str, default=None)
     # parser.add_argument('-m', '--multiple', action='store_true')
 
     args = parser.parse_args()
     db_dir = os.path.join("./", args.database)
-    if args.operation == 'logs':
-        db_metadata = MetaDataStore(db_dir)
+    # --since/--until take an iso date ('2024-05-01', '2024-05-01T12:00') or a unix timestamp
+    times = [None if t == None else float(t) if t.replace('.', '', 1).isdigit() else datetime.fromisoformat(t).timestamp()
+             for t in (args.since, args.until)]
+    if args.operation == 'logs' and args.history:
+        db_metadata = get_metadata_store(db_dir)
+        logs = db_metadata.query_logs(args.table, args.log_instance, args.log_operation, times[0], times[1])
+        pprint.pprint(logs)
+    elif args.operation == 'logs':
+        db_metadata = get_metadata_store(db_dir)
         db_metadata.print_active_logs()
+    elif args.operation == 'lock_stats':
+        pprint.pprint(lock_histograms(db_dir, since=times[0]), sort_dicts=False)
+    elif args.operation == 'memo_stats':
+        pprint.pprint(get_memo_stats(db_dir), sort_dicts=False)
     elif args.operation == "database":
-        file_operations.setup_database(db_dir, args.replace)
+        file_operations.setup_database(db_dir, args.replace, args.metadata)
+    elif args.operation == "migrate_metadata":
+        migrate_json_metadata(db_dir)
     elif args.operation == "table":
-        table_operations.setup_table(args.table, db_dir, args.author, args.multiple)
+        table_operations.setup_table(args.table, db_dir, args.author, args.multiple, args.storage)
     elif args.operation == "table_instance":
         table_operations.setup_table_instance(args.instance_id, args.table, db_dir, args.author,args.prev_id, args.prompts, args.gen_prompt)
     elif args.operation == "delete_table":
         table_operations.delete_table(args.table,db_dir, args.author)
     elif args.operation == "delete_instance":
-        table_operations.delete_table_instance(args.instance_id, args.table, db_dir)
+        table_operations.delete_table_instance(args.instance_id, args.table, db_dir, args.author)
     elif args.operation == "execute":
-        table_operations.execute_table(args.table, db_dir, args.author, args.instance_id)
+        table_operations.execute_table(args.table, db_dir, args.author, args.instance_id, thread_budget=args.threads)
+    elif args.operation == "pipeline":
+        status = pipeline_operations.run_pipeline(args.tables, db_dir, args.author, parallel_tables=args.parallel_tables,
+                                                  thread_budget=args.threads)
+        for table_name, table_status in status.items():
+            print(f'{table_name}: {table_status}')
     elif args.operation == "restart":
         table_operations.restart_database(args.author, db_dir, excluded_processes=args.excluded)
+    elif args.operation == "recover":
+        print(table_operations.recover_table(args.author, db_dir, args.table, args.recover_instance))
 
 
     # elif args.operation == "restart":
@@ -2,11 +2,17 @@ import os
 import shutil
 import pandas as pd
 import json
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 import yaml
+import time
+import threading
+from auto_data_table.sqlite_meta_operations import SQLiteMetaDataStore
+from auto_data_table.meta_operations import ACTIVE_DIR
+from auto_data_table.storage_operations import get_table_storage, setup_table_storage, DEFAULT_STORAGE, RowFilter, \
+    apply_filters, get_read_columns
 
 
-def setup_database(db_dir: str, replace: bool = False) -> None:
+def setup_database(db_dir: str, replace: bool = False, metadata: str = 'sqlite') -> None:
     if not replace and os.path.exists(db_dir):
         raise FileExistsError('path already taken')
     elif replace and os.path.isdir(db_dir):
@@ -25,8 +31,13 @@ def setup_database(db_dir: str, replace: bool = False) -> None:
     with open(os.path.join(meta_dir, 'log.txt'), "w") as file:
         pass
 
-    with open(os.path.join(meta_dir, 'active_log.json'), "w") as file:
-        json.dump({}, file)
+    if metadata == 'sqlite':
+        SQLiteMetaDataStore.setup(db_dir)
+        return
+    elif metadata != 'json':
+        raise ValueError(f'Metadata backend not supported: {metadata}')
+
+    os.makedirs(os.path.join(meta_dir, ACTIVE_DIR))
 
     with open(os.path.join(meta_dir, 'columns_history.json'), "w") as file:
         json.dump({}, file)  
@@ -46,14 +57,12 @@ def clear_table_instance(instance_id:str, table_name:str, db_dir: str):
     metadata_path = os.path.join(prompt_dir, 'description.yaml')
     with open(metadata_path, 'r') as file:
         metadata = yaml.safe_load(file) 
+    storage = get_table_storage(table_name, db_dir)
     if 'origin' in metadata:
         prev_dir = os.path.join(table_dir, metadata['origin'])
-        prev_table_path = os.path.join(prev_dir, 'table.csv')
-        shutil.copy2(prev_table_path, current_table_path)
+        storage.copy(prev_dir, temp_dir)
     else:
-        df = pd.DataFrame()
-        current_table_path = os.path.join(temp_dir, 'table.csv')
-        df.to_csv(current_table_path, index=False)
+        storage.write(pd.DataFrame(), temp_dir)
 
 
 def setup_table_instance(instance_id:str, table_name: str, db_dir: str, prev_name_id: str = '', prev_start_time:float = 0,
@@ -70,15 +79,18 @@ def setup_table_instance(instance_id:str, table_name: str, db_dir: str, prev_nam
 
     # create or copy promtpts
     prompt_dir = os.path.join(temp_dir, 'prompts')
-    current_table_path = os.path.join(temp_dir, 'table.csv')
     metadata_path = os.path.join(prompt_dir, 'description.yaml')        
+    storage = get_table_storage(table_name, db_dir)
     
     if prev_name_id != '':
         prev_dir = os.path.join(table_dir, str(prev_name_id))
         prev_prompt_dir = os.path.join(prev_dir, 'prompts')
         shutil.copytree(prev_prompt_dir, prompt_dir, copy_function=shutil.copy2)
-        prev_table_path = os.path.join(prev_dir, 'table.csv')
-        shutil.copy2(prev_table_path, current_table_path)
+        storage.copy(prev_dir, temp_dir)
+        # row fingerprints of the prompts, so unchanged rows aren't executed again
+        prev_fingerprint_dir = os.path.join(prev_dir, 'fingerprints')
+        if os.path.isdir(prev_fingerprint_dir):
+            shutil.copytree(prev_fingerprint_dir, os.path.join(temp_dir, 'fingerprints'), copy_function=shutil.copy2)
         with open(metadata_path, 'r') as file:
             metadata = yaml.safe_load(file)
         metadata['origin'] = prev_name_id
@@ -88,8 +100,7 @@ def setup_table_instance(instance_id:str, table_name: str, db_dir: str, prev_nam
     
     elif len(prompts) != 0:
         os.makedirs(prompt_dir)
-        df = pd.DataFrame()
-        df.to_csv(current_table_path, index=False)
+        storage.write(pd.DataFrame(), temp_dir)
         prompt_dir_ = os.path.join(table_dir, 'prompts')
         for prompt in prompts:
             prompt_path_ = os.path.join(prompt_dir_, prompt + '.yaml')
@@ -101,22 +112,22 @@ def setup_table_instance(instance_id:str, table_name: str, db_dir: str, prev_nam
             yaml.safe_dump(metadata, file) 
     else:
         os.makedirs(prompt_dir)
-        df = pd.DataFrame()
-        df.to_csv(current_table_path, index=False)
+        storage.write(pd.DataFrame(), temp_dir)
         with open(metadata_path, 'w') as file:
             pass
 
-def setup_table_folder(table_name: str, db_dir: str) -> None:
+def setup_table_folder(table_name: str, db_dir: str, storage: str = DEFAULT_STORAGE) -> None:
     if table_name == 'DATABASE' or table_name == 'TABLE' or table_name == 'RESTART':
         raise ValueError(f'Special Name Taken: {table_name}.')
     table_dir = os.path.join(db_dir, table_name)
     if os.path.isdir(table_dir):
-        shutil.rmtree(db_dir)
+        shutil.rmtree(table_dir)
     if os.path.isfile(table_dir):
         os.remove(table_dir)
     os.makedirs(table_dir)
     prompt_dir = os.path.join(table_dir, 'prompts')
     os.makedirs(prompt_dir)
+    setup_table_storage(table_name, db_dir, storage)
 
 
 def materialize_table(instance_id: str, temp_instance_id:str, table_name:str, db_dir: str):
@@ -144,34 +155,50 @@ def delete_lock(table_name: str, db_dir: str, table_id:Optional[str] = None):
 def delete_table(table_name: str, db_dir: str, instance_id: Optional[str] = None):
     table_dir = os.path.join(db_dir, table_name)
     if instance_id != None:
-        table_dir = os.path.join(table_dir, str(instance_id))
-    if os.path.isdir(table_dir):
+        instance_dir = os.path.join(table_dir, str(instance_id))
+        if os.path.isdir(instance_dir):
+            shutil.rmtree(instance_dir)
+            get_table_storage(table_name, db_dir).collect_garbage(table_dir)
+    elif os.path.isdir(table_dir):
         shutil.rmtree(table_dir)
 
 # get table
-def get_table(instance_id: str, table_name: str, db_dir: str, rows: Optional[int] = None) -> pd.DataFrame:
+def get_table(instance_id: str, table_name: str, db_dir: str, rows: Optional[int] = None,
+              columns: Optional[list[str]] = None, filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
     table_dir = os.path.join(db_dir, table_name)
     table_dir = os.path.join(table_dir, instance_id)
-    table_dir = os.path.join(table_dir, 'table.csv')
-    try:
-        df = pd.read_csv(table_dir, nrows=rows) 
-        return df
-    except pd.errors.EmptyDataError:
-        return pd.DataFrame()
+    storage = get_table_storage(table_name, db_dir)
+    if not os.path.exists(os.path.join(table_dir, DELTA_FILE)):
+        return storage.read(table_dir, rows, columns, filters)
+    if not filters:
+        return _apply_table_delta(storage.read(table_dir, rows, columns), table_dir)
+    # the delta is indexed by row position and can change the filtered columns, it is applied before the filters
+    df = _apply_table_delta(storage.read(table_dir, columns=get_read_columns(columns, filters)), table_dir)
+    df = apply_filters(df, filters)
+    if columns != None:
+        df = df[columns]
+    if rows != None:
+        df = df.head(rows)
+    return df
 
 
-def get_prompts(instance_id: str, table_name:str, db_dir: str) -> dict[str, Any]:
+def get_prompt_paths(instance_id: str, table_name:str, db_dir: str) -> dict[str, str]:
     table_dir = os.path.join(db_dir, table_name)
     instance_dir = os.path.join(table_dir, instance_id)
     prompt_dir = os.path.join(instance_dir, 'prompts')
-    prompts = {}
+    paths = {}
     for item in os.listdir(prompt_dir):
         if item.endswith('.yaml'):
             name = item.split('.')[0]
-            prompt_path = os.path.join(prompt_dir, item)
-            with open(prompt_path, 'r') as file:
-                prompt = yaml.safe_load(file)
-            prompts[name] = prompt
+            paths[name] = os.path.join(prompt_dir, item)
+    return paths
+
+def get_prompts(instance_id: str, table_name:str, db_dir: str) -> dict[str, Any]:
+    prompts = {}
+    for name, prompt_path in get_prompt_paths(instance_id, table_name, db_dir).items():
+        with open(prompt_path, 'r') as file:
+            prompt = yaml.safe_load(file)
+        prompts[name] = prompt
     return prompts
 
 def write_table(df: pd.DataFrame, instance_id:str, table_name: str, db_dir: str) -> None:
@@ -179,6 +206,135 @@ def write_table(df: pd.DataFrame, instance_id:str, table_name: str, db_dir: str)
         df.drop(columns="pos_index", inplace=True)
     table_dir = os.path.join(db_dir, table_name)
     table_dir = os.path.join(table_dir, instance_id)
-    table_dir = os.path.join(table_dir, 'table.csv')
-    df = df.to_csv(table_dir, index=False)
+    storage = get_table_storage(table_name, db_dir)
+    storage.write(df, table_dir)
+
+
+
+DELTA_FILE = 'delta.jsonl'
+
+def _apply_table_delta(df: pd.DataFrame, instance_dir: str) -> pd.DataFrame:
+    # cells appended after the last compaction
+    with open(os.path.join(instance_dir, DELTA_FILE), 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # partially written last line from a crash
+                break
+            index = entry['index']
+            if index >= len(df):
+                continue
+            for column, value in entry['values'].items():
+                if column in df.columns:
+                    if df[column].dtype != object:
+                        df[column] = df[column].astype(object)
+                    df.at[index, column] = value
+    return df
+
+
+class TableDeltaLog:
+    """
+    Append-only log of finished rows for a table instance (<instance>/delta.jsonl). Each row is durable
+    once appended, and the log is folded into the base table every compact_every rows or on compact().
+    get_table applies any rows that have not been compacted yet.
+    """
+    def __init__(self, df: pd.DataFrame, instance_id: str, table_name: str, db_dir: str,
+                 compact_every: int = 100, lock: Optional[threading.RLock] = None):
+        self.df = df
+        self.instance_id = instance_id
+        self.table_name = table_name
+        self.db_dir = db_dir
+        self.compact_every = compact_every
+        self.delta_path = os.path.join(db_dir, table_name, instance_id, DELTA_FILE)
+        self.pending = 0
+        # shared with the other writers of df when prompts run in parallel
+        self.lock = lock if lock != None else threading.RLock()
+
+    def append(self, index: int, values: dict[str, Any]) -> None:
+        with self.lock:
+            for column, value in values.items():
+                if self.df[column].dtype != object:
+                    self.df[column] = self.df[column].astype(object)
+                self.df.at[index, column] = value
+            line = json.dumps({'index': int(index), 'values': values}, default=str)
+            with open(self.delta_path, 'a') as file:
+                file.write(line + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.pending += 1
+            if self.compact_every > 0 and self.pending >= self.compact_every:
+                self._compact()
+
+    def _compact(self) -> None:
+        # the base table is written before the log is dropped, replaying it again is harmless
+        write_table(self.df, self.instance_id, self.table_name, self.db_dir)
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self.pending = 0
+
+    def compact(self) -> None:
+        with self.lock:
+            self._compact()
+
+
+DEFAULT_CHECKPOINT_INTERVAL = 60 # seconds
+
+def get_row_ranges(rows: set[int]) -> list[list[int]]:
+    '''[start, stop) ranges covering the row positions.'''
+    ranges = []
+    for row in sorted(rows):
+        if len(ranges) > 0 and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return ranges
+
+
+class RowCheckpoint:
+    """
+    Finished rows of a prompt that is still running. At most every interval seconds the table with the
+    finished rows is written to the instance and their ranges are passed to on_checkpoint (recorded in the
+    process log), so a restart only runs the other rows. done_ranges are the rows of earlier checkpoints.
+    """
+    def __init__(self, df: pd.DataFrame, instance_id: str, table_name: str, db_dir: str,
+                 done_ranges: list[list[int]] = [], interval: float = DEFAULT_CHECKPOINT_INTERVAL,
+                 lock: Optional[threading.RLock] = None,
+                 on_checkpoint: Optional[Callable[[list[list[int]]], None]] = None):
+        self.df = df
+        self.instance_id = instance_id
+        self.table_name = table_name
+        self.db_dir = db_dir
+        self.interval = interval
+        self.on_checkpoint = on_checkpoint
+        self.done = {row for start, stop in done_ranges for row in range(start, stop)}
+        self.pending = 0
+        self.last_checkpoint = time.time()
+        # shared with the other writers of df when prompts run in parallel
+        self.lock = lock if lock != None else threading.RLock()
+
+    def is_done(self, index: int) -> bool:
+        return index in self.done
+
+    def add(self, rows: list[int], values: dict[str, list[Any]]) -> None:
+        '''Sets the values of finished rows (column -> one value per row).'''
+        with self.lock:
+            for column, column_values in values.items():
+                if self.df[column].dtype != object:
+                    self.df[column] = self.df[column].astype(object)
+                for index, value in zip(rows, column_values):
+                    self.df.at[index, column] = value
+            self.done.update(int(index) for index in rows)
+            self.pending += len(rows)
+            if time.time() - self.last_checkpoint >= self.interval:
+                self._checkpoint()
 
+    def _checkpoint(self) -> None:
+        if self.pending == 0:
+            return
+        # the rows are only recorded once the table with their values is written
+        write_table(self.df, self.instance_id, self.table_name, self.db_dir)
+        if self.on_checkpoint != None:
+            self.on_checkpoint(get_row_ranges(self.done))
+        self.pending = 0
+        self.last_checkpoint = time.time()
@@ -1,32 +1,45 @@
 import os
+import asyncio
 import openai
 from typing import Optional
 from time import sleep
 
-def _set_up_thread(client, model, temperature, name, instructions, uses_files):
+def _assistant_settings(model, temperature, name, instructions, response_format, uses_files) -> dict:
+    '''Arguments of assistants.create, shared by the sync and async threads so both set up the same assistant.'''
+    if response_format:
+        response_format = {
+                   'type': 'json_schema',
+                   'json_schema': 
+                      {
+                        "name":"emotions", 
+                        "schema": response_format
+                      }
+                     }
+    if uses_files:
+        tools = [{"type": "file_search"}]
+    else:
+        tools = None
+    return {'name': name, 'instructions': instructions, 'model': model, #gpt-4o-mini
+            'tools': tools, 'temperature': temperature, 'response_format': response_format}
+
+def _message_content(msg, file_ids = None) -> list:
+    message = [
+          {
+            "role": "user",
+            "content": msg,
+          }
+        ]
+    message[0]["attachments"] = []
+    if file_ids != None:
+        for file_id in file_ids:
+            att = { "file_id": file_id , "tools": [{"type": "file_search"}] }
+            message[0]["attachments"].append(att)
+    return message
+
+def _set_up_thread(client, model, temperature, name, instructions, response_format, uses_files):
         thread = client.beta.threads.create()
-        
-        if response_format:
-            response_format = {
-                       'type': 'json_schema',
-                       'json_schema': 
-                          {
-                            "name":"emotions", 
-                            "schema": response_format
-                          }
-                         }
-        if len(uses_files) != 0:
-            tools = [{"type": "file_search"}]
-        else:
-            tools = None
         assistant = client.beta.assistants.create(
-                        name=name,
-                        instructions=instructions,
-                        model= model, #gpt-4o-mini
-                        tools=tools,
-                        temperature = temperature,
-                        response_format = response_format,
-            )
+            **_assistant_settings(model, temperature, name, instructions, response_format, uses_files))
         return assistant, thread
 
 def add_open_ai_secret(secret):
@@ -47,12 +60,11 @@ class Open_AI_Thread():
         for i in range(self.retry):
             try:
                 self.assistant, self.thread = _set_up_thread(self.client, model, temperature, self.name,
-                    response_format, instructions, uses_files)
-                return True
-            except:
+                    instructions, response_format, uses_files)
+                return
+            except Exception:
                  print(f"Error Calling LLM for Setup: {self.name}")
             sleep(1)
-        return False
 
     def run_query(self):
         for i in range(self.retry):
@@ -75,29 +87,11 @@ class Open_AI_Thread():
     def add_message(self, msg, role = "user", file_ids = None):
         for i in range(self.retry):
             try:
-                message = [
-                      {
-                        "role": "user",
-                        "content": msg,
-                      }
-                    ]
-                message[0]["attachments"] = []
-                if file_ids != None:
-                    for file_id in file_ids:
-                        att = { "file_id": file_id , "tools": [{"type": "file_search"}] }
-                        message[0]["attachments"].append(att)
-                if file_id != None:
-                    self.client.beta.threads.messages.create(
-                        thread_id = self.thread.id,
-                        role=role,
-                        content= message,
-                        )
-                else:
-                    self.client.beta.threads.messages.create(
-                        thread_id=self.thread.id,
-                        role=role,
-                        content= message
-                        )
+                self.client.beta.threads.messages.create(
+                    thread_id = self.thread.id,
+                    role=role,
+                    content= _message_content(msg, file_ids),
+                    )
                 return True
             except Exception as e:
                 print(f"Error Calling LLM for {self.name} Message Adding: {e}")
@@ -132,4 +126,80 @@ class Open_AI_Thread():
         except:
             print(f'Failed to delete assistant for {self.name}')
             return False
-    
\ No newline at end of file
+    
+
+async def _set_up_async_thread(client, model, temperature, name, instructions, response_format, uses_files):
+        thread = await client.beta.threads.create()
+        assistant = await client.beta.assistants.create(
+            **_assistant_settings(model, temperature, name, instructions, response_format, uses_files))
+        return assistant, thread
+
+class Async_Open_AI_Thread():
+    '''
+    Open_AI_Thread on the async client, a query waits without holding a thread. Set up with
+    await Async_Open_AI_Thread.create(...).
+    '''
+    def __init__(self, name, client: openai.AsyncOpenAI, retry: int = 10):
+        self.client = client
+        self.retry = retry
+        self.name = name
+        self.assistant = None
+        self.thread = None
+
+    @classmethod
+    async def create(cls, name, model, temperature:float = 0.2, retry: int = 10,
+                     instructions: Optional[str] = None, response_format = None,
+                     client: Optional[openai.AsyncOpenAI] = None, uses_files: bool = True) -> 'Async_Open_AI_Thread':
+        if not client:
+            client = openai.AsyncOpenAI()
+        thread = cls(name, client, retry)
+        for i in range(retry):
+            try:
+                thread.assistant, thread.thread = await _set_up_async_thread(client, model, temperature, name,
+                    instructions, response_format, uses_files)
+                return thread
+            except Exception:
+                 print(f"Error Calling LLM for Setup: {name}")
+            await asyncio.sleep(1)
+        return thread
+
+    async def run_query(self):
+        for i in range(self.retry):
+            try:
+                run = await self.client.beta.threads.runs.create_and_poll(thread_id=self.thread.id, assistant_id=self.assistant.id)
+                if run.status == 'completed':
+                    messages = await self.client.beta.threads.messages.list(thread_id=self.thread.id)
+                    msg = messages.data[0].content[0].text.value
+                    return msg
+                else:
+                    print(f'Run Status Error: {self.name}')
+                    print(run.last_error)
+                    print(run.status)
+                    await asyncio.sleep(1)
+            except Exception as e:
+                print(f"Error Calling LLM for {self.name} Run: {e}")  
+            await asyncio.sleep(1)  
+        return None
+
+    async def add_message(self, msg, role = "user", file_ids = None):
+        for i in range(self.retry):
+            try:
+                await self.client.beta.threads.messages.create(
+                    thread_id = self.thread.id,
+                    role=role,
+                    content= _message_content(msg, file_ids),
+                    )
+                return True
+            except Exception as e:
+                print(f"Error Calling LLM for {self.name} Message Adding: {e}")
+            await asyncio.sleep(1)
+        return False
+
+    async def delete_assistant(self):
+        try:
+            await self.client.beta.assistants.delete(self.assistant.id)
+            self.assistant = None
+            return True
+        except Exception:
+            print(f'Failed to delete assistant for {self.name}')
+            return False
@@ -0,0 +1,163 @@
+import os
+import json
+from typing import Optional, Any
+from filelock import FileLock
+
+LOG_FILE = 'log.txt'
+SEGMENT_DIR = 'log_segments'
+SEGMENT_SUMMARY_FILE = 'index.json'
+DEFAULT_SEGMENT_SIZE = 16 * 1024 ** 2 # bytes
+
+# [offset, length, log_time, table_name, operation, instance_ids] per log entry of a sealed segment
+SegmentIndexEntry = list[Any]
+
+
+def _entry_instances(entry: dict[str, Any]) -> list[str]:
+    data = entry.get('data') or {}
+    instances = [entry.get('instance_id'), data.get('perm_instance_id'), data.get('instance_id')]
+    return sorted({instance for instance in instances if isinstance(instance, str) and instance != ''})
+
+
+def _matches(log_time: float, table: str, operation: str, instances: list[str],
+             table_name: Optional[str], instance_id: Optional[str], operation_name: Optional[str],
+             since: Optional[float], until: Optional[float]) -> bool:
+    if table_name != None and table != table_name:
+        return False
+    if operation_name != None and operation != operation_name:
+        return False
+    if instance_id != None and instance_id not in instances:
+        return False
+    if since != None and log_time < since:
+        return False
+    if until != None and log_time >= until:
+        return False
+    return True
+
+
+class OperationLog:
+    """
+    Log of finished operations as JSON lines. Entries are appended to metadata/log.txt, which is sealed into
+    metadata/log_segments/<n>.jsonl once it grows past segment_size. Every sealed segment has an index of its
+    entries (<n>.index.json) and a summary (time range, tables, operations) in log_segments/index.json, so
+    history queries skip whole segments and only read the matching lines of the others.
+    """
+    def __init__(self, meta_dir: str, segment_size: int = DEFAULT_SEGMENT_SIZE) -> None:
+        self.log_file = os.path.join(meta_dir, LOG_FILE)
+        self.segment_dir = os.path.join(meta_dir, SEGMENT_DIR)
+        self.summary_file = os.path.join(self.segment_dir, SEGMENT_SUMMARY_FILE)
+        self.segment_size = segment_size
+        self.lock = FileLock(os.path.join(meta_dir, 'LOG_SEGMENT.lock'))
+
+    def append(self, lines: list[str], truncate_to: Optional[int] = None) -> None:
+        '''truncate_to drops a partial append first, used when a metadata transaction is replayed.'''
+        with self.lock:
+            with open(self.log_file, 'a') as file:
+                if truncate_to != None and os.path.getsize(self.log_file) > truncate_to:
+                    file.truncate(truncate_to)
+                file.write(''.join(lines))
+
+    def _segment_path(self, segment: str) -> str:
+        return os.path.join(self.segment_dir, segment + '.jsonl')
+
+    def _segment_index_path(self, segment: str) -> str:
+        return os.path.join(self.segment_dir, segment + '.index.json')
+
+    def _write_json(self, path: str, data: Any) -> None:
+        with open(path + '.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(path + '.tmp', path)
+
+    def _index_segment(self, path: str) -> tuple[dict[str, Any], list[SegmentIndexEntry]]:
+        entries = []
+        offset = 0
+        with open(path, 'rb') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a partially written line
+                    offset += len(line)
+                    continue
+                entries.append([offset, len(line), entry['log_time'], entry['table_name'], entry['operation'],
+                                _entry_instances(entry)])
+                offset += len(line)
+        times = [entry[2] for entry in entries]
+        summary = {'min_time': min(times, default=0), 'max_time': max(times, default=0),
+                   'tables': sorted({entry[3] for entry in entries}),
+                   'operations': sorted({entry[4] for entry in entries})}
+        return summary, entries
+
+    def _get_summaries(self) -> dict[str, dict[str, Any]]:
+        if not os.path.isdir(self.segment_dir):
+            return {}
+        summaries = {}
+        if os.path.exists(self.summary_file):
+            with open(self.summary_file, 'r') as file:
+                summaries = json.load(file)
+        segments = sorted(name[:-len('.jsonl')] for name in os.listdir(self.segment_dir) if name.endswith('.jsonl'))
+        changed = False
+        for segment in segments:
+            if segment in summaries:
+                continue
+            # sealed right before a crash, the summary was never recorded
+            summary, entries = self._index_segment(self._segment_path(segment))
+            self._write_json(self._segment_index_path(segment), entries)
+            summaries[segment] = summary
+            changed = True
+        if changed:
+            self._write_json(self.summary_file, summaries)
+        return {segment: summaries[segment] for segment in segments}
+
+    def rotate_if_full(self) -> None:
+        with self.lock:
+            if not os.path.exists(self.log_file) or os.path.getsize(self.log_file) < self.segment_size:
+                return
+            os.makedirs(self.segment_dir, exist_ok=True)
+            summaries = self._get_summaries()
+            segment = f'{len(summaries) + 1:06d}'
+            summary, entries = self._index_segment(self.log_file)
+            self._write_json(self._segment_index_path(segment), entries)
+            os.replace(self.log_file, self._segment_path(segment))
+            with open(self.log_file, 'w') as file:
+                pass
+            summaries[segment] = summary
+            self._write_json(self.summary_file, summaries)
+
+    def query(self, table_name: Optional[str] = None, instance_id: Optional[str] = None,
+              operation: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None) -> list[dict[str, Any]]:
+        '''Log entries matching every given condition, with since <= log_time < until, oldest first.'''
+        conditions = (table_name, instance_id, operation, since, until)
+        results = []
+        with self.lock:
+            for segment, summary in self._get_summaries().items():
+                if since != None and summary['max_time'] < since:
+                    continue
+                if until != None and summary['min_time'] >= until:
+                    continue
+                if table_name != None and table_name not in summary['tables']:
+                    continue
+                if operation != None and operation not in summary['operations']:
+                    continue
+                with open(self._segment_index_path(segment), 'r') as file:
+                    entries = json.load(file)
+                matches = [(offset, length) for offset, length, *fields in entries if _matches(*fields, *conditions)]
+                if len(matches) == 0:
+                    continue
+                with open(self._segment_path(segment), 'rb') as file:
+                    for offset, length in matches:
+                        file.seek(offset)
+                        results.append(json.loads(file.read(length)))
+            if not os.path.exists(self.log_file):
+                return results
+            # the active segment is bounded by segment_size and scanned
+            with open(self.log_file, 'rb') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if _matches(entry['log_time'], entry['table_name'], entry['operation'],
+                                _entry_instances(entry), *conditions):
+                        results.append(entry)
+        return results
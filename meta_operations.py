@@ -2,11 +2,16 @@ import json
 import os
 from dataclasses import dataclass, field, asdict
 from dataclasses_json import dataclass_json
-from typing import Optional, Union, Any, Dict
+from typing import Optional, Union, Any, Dict, Iterator
 import time
 from filelock import FileLock
 import uuid
+import socket
 import pprint
+import bisect
+from auto_data_table.log_operations import OperationLog
+import threading
+from contextlib import contextmanager
 
 #TODO: there is an edge case where i might write to log twice -> Okay for now
 
@@ -26,6 +31,9 @@ class ProcessLog():
     step_times: list[float]
     data: dict[str, Any]
     success: Optional[bool]
+    # worker running the process, used to recover processes whose worker died
+    pid: Optional[int] = None
+    host: Optional[str] = None
 
 # @dataclass_json
 # @dataclass
@@ -70,86 +78,267 @@ class ProcessLog():
 #     data: dict[str, Any] # {sub_operation: {data_name: data}}
 
 
+SQLITE_FILE = 'metadata.db'
+TRANSACTION_FILE = 'transaction.json'
+ACTIVE_DIR = 'active' # one <process_id>.json per running process
+
 ColumnHistoryDict = dict[str, dict[str, dict[str, dict[str, float]]]]
 TableHistoryDict = dict[str, dict[str, float]]
 TableMultipleDict = dict[str, bool]
 ActiveProcessDict = Dict[str, ProcessLog]
+# {table_name: {'table': [[time, instance_id], ...], 'columns': {column: [[time, instance_id], ...]}}} sorted by time
+VersionIndexDict = dict[str, dict[str, Any]]
+# (table_name, column, instance_id) with None for the latest instance/all columns
+Dependency = tuple[str, Optional[str], Optional[str]]
+
+
+def _insert_version(versions: list, vtime: float, instance_id: str) -> None:
+    bisect.insort_right(versions, [vtime, instance_id], key=lambda v: v[0])
+
+
+def _last_version_before(versions: list, before_time: Optional[float]) -> tuple[float, str]:
+    '''Latest [time, instance_id] strictly before before_time, (0, 0) when there is none.'''
+    if before_time == None:
+        pos = len(versions)
+    else:
+        pos = bisect.bisect_left(versions, before_time, key=lambda v: v[0])
+    if pos == 0:
+        return 0, 0
+    return versions[pos - 1][0], versions[pos - 1][1]
+
+
+def _build_version_index(table_history: TableHistoryDict, columns_history: ColumnHistoryDict) -> VersionIndexDict:
+    version_index = {}
+    for table_name, instances in table_history.items():
+        version_index[table_name] = {'table': [], 'columns': {}}
+        for instance_id, vtime in instances.items():
+            _insert_version(version_index[table_name]['table'], vtime, instance_id)
+    for table_name, instances in columns_history.items():
+        if table_name not in version_index:
+            version_index[table_name] = {'table': [], 'columns': {}}
+        column_index = version_index[table_name]['columns']
+        for instance_id, columns in instances.items():
+            for column, vtime in columns.items():
+                _insert_version(column_index.setdefault(column, []), vtime, instance_id)
+    return version_index
 
-def _serialize_active_log(temp_logs: ActiveProcessDict) -> dict:
-    serialized_logs = {
-            key: value.to_dict()  # Convert dataclass object to dictionary
-            for key, value in temp_logs.items()
-        }
-    return serialized_logs
 
-def _deserialize_active_log(serialized_logs: dict) -> ActiveProcessDict:
-    deserialized_dict = {
-                key: ProcessLog.from_dict(value)  # Convert dictionary back to dataclass object
-                for key, value in serialized_logs.items()
-    }
-    return deserialized_dict
+@dataclass
+class _TransactionState():
+    files: dict[str, Any] = field(default_factory=dict) # path -> loaded json
+    dirty: set[str] = field(default_factory=set)
+    deleted: set[str] = field(default_factory=set)
+    log_lines: list[str] = field(default_factory=list)
 
 
 class MetaDataStore:
     # on failure: do nothing...on restarts -> have option to revert temp tables
-    def _save_active_log(self, temp_logs: ActiveProcessDict) -> None:
-        logs = _serialize_active_log(temp_logs)
-        with open(self.active_file, 'w') as f:
-            json.dump(logs, f, indent=4)
+    def _transaction_state(self) -> Optional[_TransactionState]:
+        return getattr(self.local, 'transaction', None)
+
+    def _read_file(self, path: str) -> Any:
+        state = self._transaction_state()
+        if state != None and path in state.deleted:
+            raise FileNotFoundError(path)
+        if state != None and path in state.files:
+            return state.files[path]
+        with open(path, 'r') as file:
+            data = json.load(file)
+        if state != None:
+            state.files[path] = data
+        return data
+
+    def _write_file(self, path: str, data: Any) -> None:
+        state = self._transaction_state()
+        if state == None:
+            with self.transaction():
+                self._write_file(path, data)
+            return
+        state.files[path] = data
+        state.dirty.add(path)
+        state.deleted.discard(path)
+
+    def _delete_file(self, path: str) -> None:
+        state = self._transaction_state()
+        state.files.pop(path, None)
+        state.dirty.discard(path)
+        state.deleted.add(path)
+
+    def _dump_file(self, path: str, data: Any, sync: bool = False) -> None:
+        indent = None if path == self.version_index_file else 4
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(data, file, indent=indent)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def _apply_journal(self, journal: dict[str, Any]) -> None:
+        if len(journal['log']) > 0:
+            # replaying a journal must not append its entries twice
+            self.operation_log.append(journal['log'], truncate_to=journal['log_size'])
+        for name, data in journal['files'].items():
+            self._dump_file(os.path.join(self.meta_dir, name), data)
+        for name in journal['deleted']:
+            path = os.path.join(self.meta_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _commit(self, state: _TransactionState) -> None:
+        if len(state.dirty) == 0 and len(state.deleted) == 0 and len(state.log_lines) == 0:
+            return
+        log_size = os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0
+        journal = {'files': {os.path.relpath(path, self.meta_dir): state.files[path] for path in state.dirty},
+                   'deleted': [os.path.relpath(path, self.meta_dir) for path in state.deleted],
+                   'log': state.log_lines, 'log_size': log_size}
+        # the journal is the commit point: once it is on disk the transaction is replayed after a crash
+        with open(self.transaction_file + '.tmp', 'w') as file:
+            json.dump(journal, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.transaction_file + '.tmp', self.transaction_file)
+        self._apply_journal(journal)
+        os.remove(self.transaction_file)
+        if len(journal['log']) > 0:
+            self.operation_log.rotate_if_full()
+
+    def _recover_transaction(self) -> None:
+        if os.path.exists(self.transaction_file):
+            with open(self.transaction_file, 'r') as file:
+                journal = json.load(file)
+            self._apply_journal(journal)
+            os.remove(self.transaction_file)
+
+    def _migrate_active_log(self) -> None:
+        '''Databases created before per process records keep every active process in active_log.json.'''
+        if not os.path.exists(self.active_file):
+            return
+        os.makedirs(self.active_dir, exist_ok=True)
+        with open(self.active_file, 'r') as file:
+            active_logs = json.load(file)
+        for process_id, log in active_logs.items():
+            self._dump_file(self._process_file(process_id), log, sync=True)
+        os.remove(self.active_file)
+
+    @contextmanager
+    def transaction(self) -> Iterator['MetaDataStore']:
+        '''
+        Groups metadata updates under one lock acquisition. Files are read at most once, changes are applied
+        in memory and committed together with a single fsync'd journal write when the outermost transaction exits.
+        Nothing is written if the block raises.
+        '''
+        if self._transaction_state() != None:
+            yield self
+            return
+        with self.lock:
+            self._recover_transaction()
+            self._migrate_active_log()
+            state = _TransactionState()
+            self.local.transaction = state
+            try:
+                yield self
+                self._commit(state)
+            finally:
+                self.local.transaction = None
 
     def _save_column_history(self, columns_history: ColumnHistoryDict) -> None:
-        with open(self.column_history_file, 'w') as f:
-            json.dump(columns_history, f, indent=4)
+        self._write_file(self.column_history_file, columns_history)
     
     def _save_table_history(self, table_history: TableHistoryDict):
-        with open(self.table_history_file, 'w') as f:
-            json.dump(table_history, f, indent=4)        
+        self._write_file(self.table_history_file, table_history)
     
     def _save_table_multiple(self, table_multiples: TableMultipleDict):
-        with open(self.table_multiple_file, 'w') as f:
-            json.dump(table_multiples, f, indent=4)  
-
-    def _get_active_log(self) -> ActiveProcessDict: 
-        with open(self.active_file, 'r') as file:
-            data = json.load(file)
-            temp_logs = _deserialize_active_log(data) 
-            return temp_logs
+        self._write_file(self.table_multiple_file, table_multiples)
+
+    def _save_version_index(self, version_index: VersionIndexDict) -> None:
+        self._write_file(self.version_index_file, version_index)
+
+    def _process_file(self, process_id: str) -> str:
+        return os.path.join(self.active_dir, process_id + '.json')
+
+    def _get_process(self, process_id: str) -> ProcessLog:
+        try:
+            return ProcessLog.from_dict(self._read_file(self._process_file(process_id)))
+        except FileNotFoundError:
+            raise KeyError(process_id)
+
+    def _save_process(self, log: ProcessLog) -> None:
+        self._write_file(self._process_file(log.process_id), log.to_dict())
+
+    def _get_active_log(self) -> ActiveProcessDict:
+        state = self._transaction_state()
+        paths = {os.path.join(self.active_dir, name) for name in os.listdir(self.active_dir) if name.endswith('.json')}
+        if state != None:
+            paths |= {path for path in state.dirty if os.path.dirname(path) == self.active_dir}
+            paths -= state.deleted
+        logs = [ProcessLog.from_dict(self._read_file(path)) for path in paths]
+        logs.sort(key=lambda log: log.start_time)
+        return {log.process_id: log for log in logs}
+
+    @contextmanager
+    def _process_update(self, process_id: str) -> Iterator[ProcessLog]:
+        '''
+        Read-modify-write of one active process record. Outside of a transaction only that record is
+        rewritten (atomic rename) and LOG.lock is not taken, a process is only updated by its owner.
+        '''
+        path = self._process_file(process_id)
+        if self._transaction_state() != None or not os.path.exists(path):
+            with self.transaction():
+                log = self._get_process(process_id)
+                yield log
+                self._save_process(log)
+            return
+        with open(path, 'r') as file:
+            log = ProcessLog.from_dict(json.load(file))
+        yield log
+        self._dump_file(path, log.to_dict(), sync=True)
 
     def _get_column_history(self) -> ColumnHistoryDict:
-        with open(self.column_history_file, 'r') as file:
-            columns_history = json.load(file)
-            return columns_history
+        return self._read_file(self.column_history_file)
     
     def _get_table_history(self) -> TableHistoryDict:
-        with open(self.table_history_file, 'r') as file:
-            table_history = json.load(file)
-            return table_history
+        return self._read_file(self.table_history_file)
     
     def _get_table_multiple(self) -> TableMultipleDict:
-        with open(self.table_multiple_file, 'r') as file:
-            table_multiples = json.load(file)
-            return table_multiples
+        return self._read_file(self.table_multiple_file)
+
+    def _get_version_index(self) -> VersionIndexDict:
+        state = self._transaction_state()
+        if (state == None or self.version_index_file not in state.files) and not os.path.exists(self.version_index_file):
+            # databases created before the index existed
+            version_index = _build_version_index(self._get_table_history(), self._get_column_history())
+            self._save_version_index(version_index)
+            return version_index
+        return self._read_file(self.version_index_file)
     
     def _write_to_log(self, log_entry: ProcessLog) -> None:
         process_id = log_entry.process_id
         self._update_process_internal(process_id, 'write_log')
         log_entry.log_time = time.time()
-        log_entry = asdict(log_entry)
-        with open(self.log_file, 'a') as file:
-            file.write(json.dumps(log_entry) + '\n')
+        self._transaction_state().log_lines.append(json.dumps(asdict(log_entry)) + '\n')
         self._delete_process_internal(process_id)
         
 
     def __init__(self, db_dir: str) -> None:
         self.db_dir = db_dir
         meta_dir = os.path.join(db_dir, 'metadata')
-        self.log_file = os.path.join(meta_dir, 'log.txt')
+        self.meta_dir = meta_dir
+        self.operation_log = OperationLog(meta_dir)
+        self.log_file = self.operation_log.log_file
         self.column_history_file = os.path.join(meta_dir, 'columns_history.json')
         self.table_history_file = os.path.join(meta_dir, 'tables_history.json')
         self.table_multiple_file = os.path.join(meta_dir, 'tables_multiple.json')
         self.active_file = os.path.join(meta_dir, 'active_log.json')
+        self.active_dir = os.path.join(meta_dir, ACTIVE_DIR)
+        self.version_index_file = os.path.join(meta_dir, 'version_index.json')
+        self.transaction_file = os.path.join(meta_dir, TRANSACTION_FILE)
+        self.local = threading.local()
         meta_lock = os.path.join(meta_dir, 'LOG.lock') 
         self.lock = FileLock(meta_lock)
+        if os.path.exists(self.active_file):
+            with self.transaction():
+                pass
 
     def _setup_table_operation(self, log: ProcessLog) -> None:
         table_name = log.table_name
@@ -162,6 +351,9 @@ class MetaDataStore:
         table_multiples = self._get_table_multiple()
         table_multiples[table_name] = log.data['allow_multiple']
         self._save_table_multiple(table_multiples)
+        version_index = self._get_version_index()
+        version_index[table_name] = {'table': [], 'columns': {}}
+        self._save_version_index(version_index)
 
     def _setup_instance_operation(self, log: ProcessLog) -> None:
         "Nothing happens -> temp instance shouldn't impact metadata"
@@ -176,11 +368,15 @@ class MetaDataStore:
         column_history = self._get_column_history()
         if table_name in column_history:
             del column_history[table_name]
-        self._save_column_history(table_name)
+        self._save_column_history(column_history)
         table_multiples = self._get_table_multiple()
         if table_name in table_multiples:
             del table_multiples[table_name]
         self._save_table_multiple(table_multiples)
+        version_index = self._get_version_index()
+        if table_name in version_index:
+            del version_index[table_name]
+        self._save_version_index(version_index)
 
     def _delete_instance_operation(self, log: ProcessLog) -> None:
         table_history = self._get_table_history()
@@ -193,15 +389,25 @@ class MetaDataStore:
             del column_history[table_name][instance_id]
         self._save_table_history(table_history)
         self._save_column_history(column_history)
+        version_index = self._get_version_index()
+        if table_name in version_index:
+            table_index = version_index[table_name]
+            table_index['table'] = [v for v in table_index['table'] if v[1] != instance_id]
+            for column in table_index['columns']:
+                table_index['columns'][column] = [v for v in table_index['columns'][column] if v[1] != instance_id]
+            self._save_version_index(version_index)
 
     def _execute_operation(self, log: ProcessLog) -> None:
         table_name = log.table_name
         table_time = log.data['start_time']
         instance_id = log.data['perm_instance_id']
-        changed_columns = log.data['to_change_columns']
+        # columns of prompts that recomputed no rows keep their version
+        changed_columns = [column for column in log.data['to_change_columns']
+                           if column not in log.data.get('unchanged_columns', [])]
         gen_columns = log.data['gen_columns']
         all_columns = log.data['all_columns']
         prev_instance_id = log.data['origin']
+        version_index = self._get_version_index()
         table_history = self._get_table_history()
         table_history[table_name][instance_id] = table_time
         self._save_table_history(table_history)
@@ -213,14 +419,19 @@ class MetaDataStore:
             else:
                 columns_history[table_name][instance_id][column] = columns_history[table_name][prev_instance_id][column]
         self._save_column_history(columns_history)
+        table_index = version_index.setdefault(table_name, {'table': [], 'columns': {}})
+        _insert_version(table_index['table'], table_time, instance_id)
+        for column, column_time in columns_history[table_name][instance_id].items():
+            _insert_version(table_index['columns'].setdefault(column, []), column_time, instance_id)
+        self._save_version_index(version_index)
 
     def _restart_operation(self, log: ProcessLog) -> None:
         "Nothing Happens For Now"
         pass
 
     def write_to_log(self, process_id, success = True):
-        with self.lock:
-            log = self._get_active_log()[process_id]
+        with self.transaction():
+            log = self._get_process(process_id)
             log.success = success
             if log.operation == 'setup_table': 
                 self._setup_table_operation(log)
@@ -239,51 +450,58 @@ class MetaDataStore:
             self._write_to_log(log)
     
     def start_new_process(self, author:str, operation: str, table_name:str, instance_id:str = '', start_time: Optional[float] = None, data:dict[str, Any] = {}) -> float:
-        with self.lock:
-            process_id = str(uuid.uuid4())
-            active_processes = self._get_active_log()
-            if not start_time:
-                start_time = time.time()
-            restarts = []
-            active_processes[process_id] = ProcessLog(process_id, author, start_time, start_time, table_name, instance_id, restarts, operation, [], [], data, None)
-            self._save_active_log(active_processes)
-            return process_id
+        process_id = str(uuid.uuid4())
+        if not start_time:
+            start_time = time.time()
+        restarts = []
+        log = ProcessLog(process_id, author, start_time, start_time, table_name, instance_id, restarts, operation, [], [], data, None,
+                         os.getpid(), socket.gethostname())
+        if self._transaction_state() != None:
+            self._save_process(log)
+        else:
+            # a new record can't conflict with anyone else's
+            self._dump_file(self._process_file(process_id), log.to_dict(), sync=True)
+        return process_id
     
     def update_process_data(self, process_id:str, data:dict):
-        with self.lock:
-            active_processes = self._get_active_log()
-            active_processes[process_id].log_time = time.time()
-            active_processes[process_id].data.update(data)
-            self._save_active_log(active_processes)
+        with self._process_update(process_id) as log:
+            log.log_time = time.time()
+            log.data.update(data)
     
     def _update_process_internal(self,  process_id:str, step: str):
-        active_processes = self._get_active_log()
-        active_processes[process_id].complete_steps.append(step)
-        active_processes[process_id].step_times.append(time.time())
-        active_processes[process_id].log_time = time.time()
-        self._save_active_log(active_processes)
+        with self._process_update(process_id) as log:
+            log.complete_steps.append(step)
+            log.step_times.append(time.time())
+            log.log_time = time.time()
     
     def update_process_step(self, process_id:str, step: str):
-        with self.lock:
-            self._update_process_internal(process_id, step)
+        self._update_process_internal(process_id, step)
     
     def update_process_restart(self, author:str, process_id:str) -> ProcessLog:
-        with self.lock:
-            restart_time = time.time()
-            active_processes = self._get_active_log()
-            active_processes[process_id].restarts.append((author, restart_time))
-            active_processes[process_id].log_time = time.time()
-            self._save_active_log(active_processes)
-            return active_processes[process_id]
+        restart_time = time.time()
+        with self._process_update(process_id) as log:
+            log.restarts.append((author, restart_time))
+            log.log_time = time.time()
+            log.pid = os.getpid()
+            log.host = socket.gethostname()
+        return log
     
     def _delete_process_internal(self, process_id: str):
-        active_processes = self._get_active_log()
-        del active_processes[process_id]
-        self._save_active_log(active_processes)
+        self._delete_file(self._process_file(process_id))
         
+    def query_logs(self, table_name: Optional[str] = None, instance_id: Optional[str] = None,
+                   operation: Optional[str] = None, since: Optional[float] = None,
+                   until: Optional[float] = None) -> list[ProcessLog]:
+        '''
+        Finished operations from the log, filtered on table, instance (temporary, materialized or deleted),
+        operation and since <= log_time < until. Only reads the log segments that can match.
+        '''
+        entries = self.operation_log.query(table_name, instance_id, operation, since, until)
+        return [ProcessLog.from_dict(entry) for entry in entries]
+
     def get_all_tables(self) -> list[str]:
-        with self.lock:
-            tables = list[self._get_table_history().keys()]
+        with self.transaction():
+            tables = list(self._get_table_history().keys())
         return tables
 
     def _get_multiple_internal(self, table_name):
@@ -291,12 +509,12 @@ class MetaDataStore:
         return allow_multiples[table_name]
     
     def get_table_multiple(self, table_name:str):
-        with self.lock:
+        with self.transaction():
             return self._get_multiple_internal(table_name)
 
     def get_table_version_update(self, instance_id:str, table_name:str,
                                  before_time: Optional[int] = None):
-        with self.lock:
+        with self.transaction():
             table_history = self._get_table_history() 
             vtime =  table_history[table_name][instance_id]
             if before_time == None or vtime < before_time:
@@ -306,7 +524,7 @@ class MetaDataStore:
 
     def get_column_version_update(self, column_name, instance_id:str, table_name:str,
                                   before_time: Optional[int] = None):
-        with self.lock:
+        with self.transaction():
             column_history = self._get_column_history() 
             vtime = column_history[table_name][instance_id][column_name]
             if vtime < before_time:
@@ -319,36 +537,49 @@ class MetaDataStore:
         Returns 0 when we didn't find any tables that meet conditions.
         Return -1 when the table was last updated after before_times and it can only have one active version.
         '''
-        with self.lock:
-            table_history = self._get_table_history() 
-            max_t = 0
-            max_id = 0
-            for instance_id, t in table_history[table_name].items():
-                if t > max_t and (before_time == None or t < before_time):
-                    max_t = t
-                    max_id = instance_id
-            return max_t, max_id
+        with self.transaction():
+            version_index = self._get_version_index()
+            return _last_version_before(version_index[table_name]['table'], before_time)
     
     def get_last_column_update(self, table_name:str, column:str, before_time: Optional[int] = None) -> int:
         '''
         Returns 0 when we didn't find any tables that meet conditions.
         Return -1 when the table was last updated after before_times and it can only have one active version.
         '''
-        with self.lock:
+        with self.transaction():
+            version_index = self._get_version_index()
+            return _last_version_before(version_index[table_name]['columns'].get(column, []), before_time)
+
+    def get_dependency_versions(self, dependencies: list[Dependency],
+                                before_time: Optional[float] = None) -> list[tuple[bool, float, str]]:
+        '''
+        Resolves a batch of dependencies with a single locked read. Returns (allow_multiple, mat_time, instance_id)
+        per dependency, mat_time is 0 when the version was not materialized before before_time.
+        '''
+        with self.transaction():
+            table_multiples = self._get_table_multiple()
+            table_history = self._get_table_history()
             columns_history = self._get_column_history()
-            max_t = 0
-            max_id = 0
-            for instance_id in columns_history[table_name]:
-                if column in columns_history[table_name][instance_id]:
-                    t = columns_history[table_name][instance_id][column]
-                    if t >= max_t and (before_time == None or t < before_time):
-                        max_t = t
-                        max_id = instance_id
-            return max_t, max_id
+            version_index = self._get_version_index()
+        results = []
+        for table, column, instance in dependencies:
+            if instance != None:
+                if column != None:
+                    vtime = columns_history[table][instance][column]
+                else:
+                    vtime = table_history[table][instance]
+                if before_time != None and vtime >= before_time:
+                    vtime = 0
+            elif column != None:
+                vtime, instance = _last_version_before(version_index[table]['columns'].get(column, []), before_time)
+            else:
+                vtime, instance = _last_version_before(version_index[table]['table'], before_time)
+            results.append((table_multiples[table], vtime, instance))
+        return results
 
 
     def teminate_previous_restarts(self):
-        with self.lock:
+        with self.transaction():
             active_logs = self._get_active_log()
             ids = []
             for process_id, process in active_logs.items():
@@ -359,23 +590,35 @@ class MetaDataStore:
                 self._write_to_log(active_logs[id])
 
     def get_process_ids(self) -> list[tuple[str, str]]:
-        with self.lock:
+        with self.transaction():
             active_logs = self._get_active_log()
             ids = []
             for id, process in active_logs.items():
                 ids.append((id, process.operation))
             return ids
         
+    def get_active_processes(self) -> ActiveProcessDict:
+        with self.transaction():
+            return self._get_active_log()
+        
     def print_active_logs(self) -> None:
-        with self.lock:
+        with self.transaction():
             active_logs = self._get_active_log()
-            pprint(active_logs)
+            pprint.pprint(active_logs)
         
     def write_to_log_after_restart(self):
-        with self.lock:
+        with self.transaction():
             active_logs = self._get_active_log()
             for process_id, process in active_logs.items():
                 if 'write_log' in process.complete_steps:
                     self._write_to_log(process)
 
-    
\ No newline at end of file
+    
+
+
+def get_metadata_store(db_dir: str) -> MetaDataStore:
+    '''Databases with a metadata.db use the sqlite store, older ones keep their json files.'''
+    if os.path.exists(os.path.join(db_dir, 'metadata', SQLITE_FILE)):
+        from auto_data_table.sqlite_meta_operations import SQLiteMetaDataStore
+        return SQLiteMetaDataStore(db_dir)
+    return MetaDataStore(db_dir)
@@ -0,0 +1,143 @@
+import os
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from auto_data_table import file_operations
+from auto_data_table import table_operations
+from auto_data_table.meta_operations import MetaDataStore, get_metadata_store
+from auto_data_table.prompt_execution import prompt_parser
+
+DEFAULT_PARALLEL_TABLES = 4
+
+# pipeline status of a table
+EXECUTED = 'executed'
+SKIPPED = 'skipped' # inputs and prompts unchanged since the last materialized version
+FAILED = 'failed'
+BLOCKED = 'blocked' # an upstream table failed
+NO_INSTANCE = 'no_instance' # nothing set up to execute
+
+
+def _get_pending_instance(table_name: str, db_dir: str) -> Optional[str]:
+    table_dir = os.path.join(db_dir, table_name)
+    instances = [item for item in os.listdir(table_dir)
+                 if item.startswith('TEMP') and os.path.isdir(os.path.join(table_dir, item, 'prompts'))]
+    if len(instances) == 0:
+        return None
+    if len(instances) > 1:
+        raise ValueError(f'Table {table_name} has several instances in progress {instances}, pass the one to execute.')
+    return instances[0]
+
+
+def _get_upstream_tables(table_name: str, instance_id: str, db_dir: str) -> set[str]:
+    '''Tables whose latest version the instance reads, explicit versions don't have to wait for anything.'''
+    upstream = set()
+    prompts = file_operations.get_prompts(instance_id, table_name, db_dir)
+    for pname, prompt in prompts.items():
+        if pname == 'description' or not isinstance(prompt, dict):
+            continue
+        for dep in prompt.get('dependencies', []):
+            table, _, instance = prompt_parser.parse_string(dep)
+            if table != 'self' and instance == None:
+                upstream.add(table)
+        for table in prompt.get('table_arguments', {}).values():
+            table, _, instance = prompt_parser.parse_string(table)
+            if instance == None:
+                upstream.add(table)
+    upstream.discard(table_name)
+    return upstream
+
+
+def _is_unchanged(table_name: str, instance_id: str, db_metadata: MetaDataStore, db_dir: str) -> bool:
+    '''
+    True if the last materialized version ran the same prompts on the versions of its dependencies that
+    are the latest ones now. Tables without dependencies on other tables (e.g. generators that read files)
+    have no tracked inputs and are never unchanged.
+    '''
+    _, last_instance = db_metadata.get_last_table_update(table_name)
+    if last_instance == 0:
+        return False
+    prompts = file_operations.get_prompts(instance_id, table_name, db_dir)
+    last_prompts = file_operations.get_prompts(last_instance, table_name, db_dir)
+    prompts.pop('description', None)
+    last_prompts.pop('description', None)
+    if prompts != last_prompts:
+        return False
+    runs = [log for log in db_metadata.query_logs(table_name, last_instance, 'execute_table')
+            if log.success != False and log.data.get('perm_instance_id') == last_instance]
+    if len(runs) == 0:
+        return False
+    latest_deps = set()
+    tracked = False
+    for deps in runs[-1].data['external_deps'].values():
+        for table, column, version, _, latest in deps:
+            tracked = True
+            if latest:
+                latest_deps.add((table, column, version))
+    if not tracked:
+        return False
+    latest_deps = sorted(latest_deps, key=str)
+    versions = db_metadata.get_dependency_versions([(table, column, None) for table, column, _ in latest_deps])
+    for (_, _, version), (_, _, current_version) in zip(latest_deps, versions):
+        if version != current_version:
+            return False
+    return True
+
+
+def run_pipeline(table_names: list[str], db_dir: str, author: str, instance_ids: dict[str, str] = {},
+                 parallel_tables: int = DEFAULT_PARALLEL_TABLES,
+                 thread_budget: int = table_operations.DEFAULT_THREAD_BUDGET) -> dict[str, str]:
+    '''
+    Executes the in progress instance of every table (or the one in instance_ids) in the order of the
+    dependencies between them. Independent tables run at the same time, a table starts as soon as the tables
+    it reads are materialized, and is skipped (its instance is deleted) if its prompts and the versions it would
+    read are unchanged. Returns the status of each table.
+    '''
+    db_metadata = get_metadata_store(db_dir)
+    instances = {}
+    upstream = {}
+    for table_name in table_names:
+        if table_name in instance_ids:
+            instances[table_name] = instance_ids[table_name]
+        else:
+            instances[table_name] = _get_pending_instance(table_name, db_dir)
+        if instances[table_name] == None:
+            upstream[table_name] = set()
+        else:
+            upstream[table_name] = _get_upstream_tables(table_name, instances[table_name], db_dir) & set(table_names)
+
+    status = {}
+    pending = list(table_names)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(parallel_tables, 1)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            resolved = False
+            for table_name in list(pending):
+                if any(table not in status for table in upstream[table_name]):
+                    continue
+                pending.remove(table_name)
+                resolved = True
+                if any(status[table] in (FAILED, BLOCKED) for table in upstream[table_name]):
+                    status[table_name] = BLOCKED
+                elif instances[table_name] == None:
+                    status[table_name] = NO_INSTANCE
+                elif _is_unchanged(table_name, instances[table_name], db_metadata, db_dir):
+                    # the instance would be the same as the last one, the next run sets up a new one
+                    table_operations.delete_table_instance(instances[table_name], table_name, db_dir, author)
+                    status[table_name] = SKIPPED
+                else:
+                    future = executor.submit(table_operations.execute_table, table_name, db_dir, author,
+                                             instances[table_name], thread_budget=thread_budget)
+                    running[future] = table_name
+            if len(running) == 0:
+                if not resolved:
+                    raise ValueError(f'Cycle detected between tables {pending}.')
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_name = running.pop(future)
+                if future.exception() != None:
+                    print(f'Table {table_name} failed: {future.exception()!r}')
+                    status[table_name] = FAILED
+                else:
+                    status[table_name] = EXECUTED
+    return {table_name: status[table_name] for table_name in table_names}
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import hashlib
+from typing import Any, Optional
+import pandas as pd
+
+from auto_data_table.prompt_execution.prompt_parser_table import PromptTemplate, compile_template
+
+FINGERPRINT_DIR = 'fingerprints'
+
+# prompt values that are rendered per row and passed to the function or model
+INPUT_FIELDS = {
+    'code': ['arguments'],
+    'llm': ['context_files', 'context_msgs', 'instructions', 'questions'],
+}
+
+# prompt settings that don't change what a row computes
+EXECUTION_FIELDS = ['n_threads', 'compact_every', 'executor', 'chunk_size', 'batch_size', 'memoize', 'memo_size',
+                    'checkpoint_interval', 'engine', 'max_requests']
+
+# row key (json of the generator columns) -> fingerprint of the prompt's inputs for that row
+Fingerprints = dict[str, str]
+
+
+def _fingerprint_path(pname: str, instance_id: str, table_name: str, db_dir: str) -> str:
+    return os.path.join(db_dir, table_name, instance_id, FINGERPRINT_DIR, pname + '.json')
+
+
+def hash_table(df: pd.DataFrame) -> str:
+    try:
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    except TypeError:
+        # unhashable cells (lists, dicts)
+        hashes = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes() + json.dumps(list(df.columns), default=str).encode()).hexdigest()
+
+
+def get_row_keys(df: pd.DataFrame, key_columns: list[str]) -> pd.Series:
+    '''Rows are identified by the generator columns, positions change when the generator adds rows.'''
+    values = df[key_columns].astype(object).where(df[key_columns].notna(), None).to_numpy().tolist()
+    return pd.Series([json.dumps(row, default=str) for row in values], index=df.index)
+
+
+def get_row_fingerprints(prompt: dict[str, Any], cache: dict, key_columns: list[str]) -> Fingerprints:
+    '''
+    Fingerprint of everything a row of the prompt is computed from: the prompt itself, the whole tables it
+    reads as table_arguments and its rendered inputs for the row. Rows whose inputs can't be resolved are left out.
+    '''
+    base = hashlib.sha256(repr({k: v for k, v in prompt.items() if k not in EXECUTION_FIELDS}).encode())
+    for table in sorted(prompt.get('table_arguments', {}).values()):
+        match = re.match(r"^(\w+)(?:\((\w+)\))?$", table)
+        table_key = match.group(1) if match.group(2) == None else (match.group(1), match.group(2))
+        base.update(hash_table(cache[table_key]).encode())
+    rendered = []
+    for field in INPUT_FIELDS.get(prompt['type'], []):
+        if field in prompt:
+            template = prompt[field] if isinstance(prompt[field], PromptTemplate) else compile_template(prompt[field])
+            rendered.append(template.render(cache))
+    keys = get_row_keys(cache['self'], key_columns)
+    fingerprints = {}
+    for index, key in keys.items():
+        try:
+            values = [field_values.get(index) for field_values in rendered]
+        except IndexError:
+            continue
+        row_hash = base.copy()
+        row_hash.update(json.dumps(values, sort_keys=True, default=str).encode())
+        fingerprints[key] = row_hash.hexdigest()
+    return fingerprints
+
+
+def load_fingerprints(pname: str, instance_id: str, table_name: str, db_dir: str) -> Optional[Fingerprints]:
+    '''None when the prompt has no fingerprints, e.g. instances executed before they were recorded.'''
+    path = _fingerprint_path(pname, instance_id, table_name, db_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_fingerprints(fingerprints: Fingerprints, pname: str, instance_id: str, table_name: str, db_dir: str) -> None:
+    path = _fingerprint_path(pname, instance_id, table_name, db_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(fingerprints, file)
+    os.replace(path + '.tmp', path)
+
+
+def clear_changed_rows(df: pd.DataFrame, columns: list[str], key_columns: list[str],
+                       fingerprints: Fingerprints, prev_fingerprints: Fingerprints, done_rows: set[int] = set()) -> int:
+    '''
+    Clears the prompt's columns in rows whose fingerprint changed or is new, so only they are executed again.
+    done_rows were already executed with the current inputs (checkpoints of an interrupted execution).
+    Returns the number of rows that differ from prev_fingerprints, including removed ones.
+    '''
+    keys = get_row_keys(df, key_columns)
+    changed = pd.Series([fingerprints.get(key) == None or fingerprints.get(key) != prev_fingerprints.get(key)
+                         for key in keys], index=df.index, dtype=bool)
+    n_changed = int(changed.sum()) + len(set(prev_fingerprints) - set(keys))
+    to_clear = changed & pd.Series([position not in done_rows for position in range(len(df))], index=df.index)
+    columns = [column for column in columns if column in df.columns]
+    if to_clear.any() and len(columns) > 0:
+        for column in columns:
+            if df[column].dtype != object:
+                df[column] = df[column].astype(object)
+        df.loc[to_clear, columns] = pd.NA
+    return n_changed
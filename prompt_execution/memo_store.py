@@ -0,0 +1,154 @@
+import os
+import json
+import pickle
+import hashlib
+import threading
+from typing import Any
+import numpy as np
+import pandas as pd
+
+from auto_data_table.prompt_execution.fingerprints import hash_table
+
+MEMO_DIR = '__memo__'
+MEMO_STATS = 'stats.log'
+DEFAULT_MEMO_SIZE = 1 << 30 # bytes
+
+
+def get_memo_dir(db_dir: str) -> str:
+    return os.path.join(db_dir, 'code_functions', MEMO_DIR)
+
+
+def get_function_key(code_file: str, function_name: str) -> str:
+    '''Identifies the function by the contents of its code file, a copy of the file in another place shares results.'''
+    with open(code_file, 'rb') as file:
+        source = file.read()
+    return hashlib.sha256(source + b'\0' + function_name.encode()).hexdigest()
+
+
+def get_tables_key(table_args: dict[str, pd.DataFrame]) -> str:
+    '''Hash of the table_arguments, computed once per execution and shared by the calls.'''
+    tables = hashlib.sha256()
+    for tname in sorted(table_args):
+        tables.update(tname.encode())
+        tables.update(hash_table(table_args[tname]).encode())
+    return tables.hexdigest()
+
+
+def _encode_argument(value: Any) -> Any:
+    '''Arguments json can't encode. Arrays and pandas objects are hashed from their data, their repr is truncated.'''
+    if isinstance(value, pd.DataFrame):
+        return {'frame': hash_table(value)}
+    if isinstance(value, (pd.Series, pd.Index)):
+        return {'series': hash_table(pd.Series(value).to_frame()), 'dtype': str(value.dtype)}
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            data = hash_table(pd.DataFrame({'values': value.ravel()}))
+        else:
+            data = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return {'array': data, 'dtype': str(value.dtype), 'shape': list(value.shape)}
+    return repr(value)
+
+
+def get_call_key(function_key: str, args: dict[str, Any], tables_key: str = '') -> str:
+    call = hashlib.sha256(function_key.encode())
+    call.update(json.dumps(args, sort_keys=True, default=_encode_argument).encode())
+    call.update(tables_key.encode())
+    return call.hexdigest()
+
+
+def get_memo_stats(db_dir: str) -> dict[str, dict[str, int]]:
+    '''Hits, misses and evictions of every memoized function, summed over all executions.'''
+    stats = {}
+    path = os.path.join(get_memo_dir(db_dir), MEMO_STATS)
+    if not os.path.exists(path):
+        return stats
+    with open(path, 'r') as file:
+        for line in file:
+            record = json.loads(line)
+            counts = stats.setdefault(record.pop('function'), {'hits': 0, 'misses': 0, 'evicted': 0})
+            for name, count in record.items():
+                counts[name] += count
+    return stats
+
+
+class MemoStore:
+    """
+    Results of memoize: true prompts in <db>/code_functions/__memo__, one pickle per function call keyed by
+    the hash of the code file and the call's arguments, so every instance and table of the database reuses them.
+    Once the store is larger than max_size the least recently used results are removed.
+    """
+    def __init__(self, db_dir: str, max_size: int = DEFAULT_MEMO_SIZE):
+        self.memo_dir = get_memo_dir(db_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.memo_dir, key[:2], key + '.pkl')
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            # mtime orders the results for eviction
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self.lock:
+                self.misses += 1
+            return False, None
+        with self.lock:
+            self.hits += 1
+        return True, value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        try:
+            data = pickle.dumps(value)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # results that can't be stored are computed every time
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def evict(self) -> int:
+        '''Removes the least recently used results until the store fits in max_size.'''
+        if not os.path.isdir(self.memo_dir):
+            return 0
+        entries = []
+        for entry in os.scandir(self.memo_dir):
+            if not entry.is_dir():
+                continue
+            for item in os.scandir(entry.path):
+                if item.name.endswith('.pkl'):
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self.lock:
+            self.evicted += evicted
+        return evicted
+
+    def record_stats(self, function_name: str) -> None:
+        '''Appends the counters of this execution to the stats log, appends of one line don't interleave.'''
+        os.makedirs(self.memo_dir, exist_ok=True)
+        record = {'function': function_name, 'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted}
+        with open(os.path.join(self.memo_dir, MEMO_STATS), 'a') as file:
+            file.write(json.dumps(record) + '\n')
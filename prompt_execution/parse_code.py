@@ -1,28 +1,108 @@
 import os
+import sys
+import math
+import types
+import marshal
+import hashlib
+import tempfile
+import threading
+import multiprocessing
 from typing import Optional, Any, Callable, Union
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import pandas as pd
+import pyarrow as pa
 import re
 
 from auto_data_table import file_operations
 from auto_data_table.prompt_execution import prompt_parser 
+from auto_data_table.prompt_execution import memo_store
 
-def load_function_from_file(file_path:str, function_name:str) -> tuple[Callable, Any]:
-    # Define a namespace to execute the file in
-    namespace = {}
-    # Read and execute the file
-    with open(file_path, 'r') as file:
-        exec(file.read(), namespace)
+MODULE_CACHE_DIR = '__cache__'
+
+# (absolute path, content hash) -> namespace the file was executed in, shared by all prompts of the process
+_modules: dict[tuple[str, str], dict[str, Any]] = {}
+_modules_lock = threading.RLock()
+
+def _prune_module_cache(cache_dir: str, prefix: str, cache_file: str) -> None:
+    '''Removes the bytecode of earlier versions of the code file.'''
+    for item in os.listdir(cache_dir):
+        if item.startswith(prefix) and item.endswith('.bin') and item != cache_file:
+            try:
+                os.remove(os.path.join(cache_dir, item))
+            except FileNotFoundError:
+                pass
+
+def _compile_module(file_path: str, source: bytes, digest: str, cache_dir: Optional[str]) -> types.CodeType:
+    '''
+    Bytecode of a code file, marshalled to cache_dir/<name>.<path hash>.<python>.<hash>.bin for later runs.
+    Only the bytecode of the last version of each file is kept.
+    '''
+    cache_path = None
+    if cache_dir != None:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        path_hash = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()[:16]
+        prefix = f'{name}.{path_hash}.{sys.implementation.cache_tag}.'
+        cache_file = f'{prefix}{digest}.bin'
+        cache_path = os.path.join(cache_dir, cache_file)
+        try:
+            with open(cache_path, 'rb') as file:
+                return marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    code = compile(source, file_path, 'exec')
+    if cache_path != None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            marshal.dump(code, file)
+        os.replace(temp_path, cache_path)
+        _prune_module_cache(cache_dir, prefix, cache_file)
+    return code
+
+def load_function_from_file(file_path:str, function_name:str, cache_dir: Optional[str] = None) -> tuple[Callable, Any]:
+    '''
+    Code files are executed once per process and content: the namespace is reused until the file changes.
+    With a cache_dir the compiled bytecode is kept on disk as well.
+    '''
+    with open(file_path, 'rb') as file:
+        source = file.read()
+    digest = hashlib.sha256(source).hexdigest()
+    key = (os.path.abspath(file_path), digest)
+    with _modules_lock:
+        if key not in _modules:
+            # Define a namespace to execute the file in
+            namespace = {'__file__': os.path.abspath(file_path)}
+            exec(_compile_module(file_path, source, digest, cache_dir), namespace)
+            _modules[key] = namespace
+        namespace = _modules[key]
     # Retrieve the function from the namespace 
     if function_name in namespace:
         return namespace[function_name], namespace
     else:
         raise AttributeError(f"Function '{function_name}' not found in '{file_path}'")
 
+def _get_code_file(prompt: prompt_parser.Prompt, db_dir: str) -> str:
+    if prompt['is_global']:
+        return os.path.join('./code_functions/', prompt['code_file'])
+    return os.path.join(db_dir, 'code_functions', prompt['code_file'])
 
+def _get_module_cache_dir(db_dir: str) -> str:
+    return os.path.join(db_dir, 'code_functions', MODULE_CACHE_DIR)
 
-def _execute_code_from_prompt(index: int, prompt:prompt_parser.Prompt, funct:Callable,  cache: prompt_parser.Cache) -> tuple[Any]:
-    df = cache['self']
+
+
+def _get_table_arguments(prompt: prompt_parser.Prompt, cache: prompt_parser.Cache) -> dict[str, pd.DataFrame]:
+    table_args = {}
+    for tname, table in prompt.get('table_arguments', {}).items():
+        match = re.match(r"^(\w+)(?:\((\w+)\))?$", table)
+        table_args[tname] = cache[match.group(1) if match.group(2) == None else (match.group(1), match.group(2))]
+    return table_args
+
+def _execute_code_from_prompt(index: int, prompt:prompt_parser.Prompt, funct:Callable,  cache: prompt_parser.Cache,
+                              arguments: prompt_parser.RenderedTemplate, df: pd.DataFrame,
+                              checkpoint: Optional[file_operations.RowCheckpoint] = None) -> tuple[Any]:
+    if checkpoint != None and checkpoint.is_done(index):
+        return tuple(df.loc[index, prompt['changed_columns']])
     empty = False
     current_values = []
     for col in prompt['changed_columns']:
@@ -35,94 +115,242 @@ def _execute_code_from_prompt(index: int, prompt:prompt_parser.Prompt, funct:Cal
     if not empty:
         return tuple(current_values)
     
-    args = prompt_parser.get_table_value(prompt['arguments'], index, cache)
-    #print(args)
-    table_args = {} 
-    if 'table_arguments' in prompt:
-        for tname, table in prompt['table_arguments'].items():
-            match = re.match(r"^(\w+)(?:\((\w+)\))?$", table)
-            table_name = match.group(1)
-            instance_id = match.group(2)
-            if instance_id != None:
-                table_key = table_name
-            else:
-                table_key = (table_name,instance_id)
-            table_args[tname] = cache[table_key]
-    args = args | table_args
-    results = funct(**args)
-    return tuple(results)
+    args = arguments.get(index)
+    args = args | _get_table_arguments(prompt, cache)
+    results = tuple(funct(**args))
+    if checkpoint != None:
+        checkpoint.add([index], {col: [value] for col, value in zip(prompt['changed_columns'], results)})
+    return results
+
+# per worker process: table_arguments, loaded once for all chunks
+_worker_tables: dict[str, pd.DataFrame] = {}
+
+def _write_arrow(table: pa.Table, path: str) -> None:
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def _read_arrow(path: str) -> pa.Table:
+    # buffers point into the mapped file, nothing is copied until rows are converted
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+def _execute_code_chunk(code_file: str, function_name: str, cache_dir: str, args_path: Optional[str], start: int,
+                        stop: int, table_arg_paths: dict[str, str]) -> list[list[Any]]:
+    '''Runs in a worker process, returns the results of rows start to stop column-wise.'''
+    funct, _ = load_function_from_file(code_file, function_name, cache_dir)
+    if args_path == None:
+        rows = [{} for _ in range(stop - start)]
+    else:
+        rows = _read_arrow(args_path).slice(start, stop - start).to_pylist()
+    table_args = {}
+    for tname, path in table_arg_paths.items():
+        if path not in _worker_tables:
+            _worker_tables[path] = _read_arrow(path).to_pandas()
+        table_args[tname] = _worker_tables[path]
+    results = [tuple(funct(**(row | table_args))) for row in rows]
+    return [list(column) for column in zip(*results)]
+
+def _execute_code_in_processes(prompt: prompt_parser.Prompt, code_file: str, cache_dir: str, cache: prompt_parser.Cache,
+                               arguments: prompt_parser.RenderedTemplate, df: pd.DataFrame, n_processes: int,
+                               checkpoint: Optional[file_operations.RowCheckpoint] = None) -> list[tuple[Any]]:
+    '''
+    executor: process. Rows with missing values are split into chunks that run in a process pool. Arguments
+    and table_arguments are written once as Arrow IPC files that the workers memory map, instead of
+    being pickled per row, and each chunk sends its results back as columns.
+    '''
+    changed_columns = prompt['changed_columns']
+    results = [tuple(row) for row in df[changed_columns].itertuples(index=False)]
+    todo = [i for i, empty in enumerate(df[changed_columns].isna().any(axis=1))
+            if empty and (checkpoint == None or not checkpoint.is_done(i))]
+    if len(todo) == 0:
+        return results
+    chunk_size = prompt.get('chunk_size', max(1, math.ceil(len(todo) / (n_processes * 4))))
+    with tempfile.TemporaryDirectory(prefix='udf_') as temp_dir:
+        args_path = None
+        rows = [arguments.get(i) for i in todo]
+        table_arg_paths = {}
+        try:
+            if any(len(row) > 0 for row in rows):
+                args_path = os.path.join(temp_dir, 'arguments.arrow')
+                _write_arrow(pa.Table.from_pylist(rows), args_path)
+            for tname, table in _get_table_arguments(prompt, cache).items():
+                table_arg_paths[tname] = os.path.join(temp_dir, tname + '.arrow')
+                _write_arrow(pa.Table.from_pandas(table, preserve_index=False), table_arg_paths[tname])
+        except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
+            raise ValueError(f'Arguments of {prompt["function"]} have mixed types, use executor: thread') from e
+        # prompts of a table run in threads, forking those isn't safe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_processes, mp_context=context) as executor:
+            chunks = [(start, min(start + chunk_size, len(todo))) for start in range(0, len(todo), chunk_size)]
+            futures = {executor.submit(_execute_code_chunk, os.path.abspath(code_file), prompt['function'],
+                                       os.path.abspath(cache_dir), args_path, start, stop, table_arg_paths): (start, stop)
+                       for start, stop in chunks}
+            # in order of completion, chunks finished before a failing one are still checkpointed
+            for future in as_completed(futures):
+                start, stop = futures[future]
+                columns = future.result()
+                for position, row in zip(range(start, stop), zip(*columns)):
+                    results[todo[position]] = row
+                if checkpoint != None:
+                    checkpoint.add(todo[start:stop], dict(zip(changed_columns, columns)))
+    return results
+
+def _execute_code_in_batches(prompt: prompt_parser.Prompt, funct: Callable, cache: prompt_parser.Cache,
+                             arguments: prompt_parser.RenderedTemplate, df: pd.DataFrame, n_threads: int,
+                             checkpoint: Optional[file_operations.RowCheckpoint] = None) -> list[pd.Series]:
+    '''
+    is_batch: true. The function is called with chunks of batch_size rows (default all of them), arguments are
+    Series over the chunk, and returns one array per changed column (or a frame with the changed columns).
+    Only rows with missing values are passed.
+    '''
+    changed_columns = prompt['changed_columns']
+    columns = [df[col].astype(object) for col in changed_columns]
+    todo = [index for index in df.index[df[changed_columns].isna().any(axis=1)]
+            if checkpoint == None or not checkpoint.is_done(index)]
+    if len(todo) == 0:
+        return columns
+    batch_size = prompt.get('batch_size', len(todo))
+    chunks = [todo[start:start + batch_size] for start in range(0, len(todo), batch_size)]
+    table_args = _get_table_arguments(prompt, cache)
+
+    def execute_chunk(chunk: list) -> list:
+        results = funct(**(arguments.get_columns(chunk) | table_args))
+        if isinstance(results, pd.DataFrame):
+            results = [results[col] for col in changed_columns]
+        results = list(results)
+        if len(results) != len(changed_columns) or any(len(values) != len(chunk) for values in results):
+            raise ValueError(f'{prompt["function"]} has to return {len(changed_columns)} arrays of {len(chunk)} values')
+        return results
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for chunk, results in zip(chunks, executor.map(execute_chunk, chunks)):
+            for column, values in zip(columns, results):
+                column.loc[chunk] = list(values)
+            if checkpoint != None:
+                checkpoint.add(chunk, {col: list(values) for col, values in zip(changed_columns, results)})
+    return [column.infer_objects() for column in columns]
 
 def _execute_single_code_from_prompt(prompt:prompt_parser.Prompt, funct:Callable, 
-                                     cache:  prompt_parser.Cache) -> Any:
-    args = prompt_parser.get_table_value(prompt['arguments'], None, cache)
-    table_args = {} 
-    if 'table_arguments' in prompt:
-        for tname, table in prompt['table_arguments'].items():
-            match = re.match(r"^(\w+)(?:\((\w+)\))?$", table)
-            table_name = match.group(1)
-            instance_id = match.group(2)
-            if instance_id == None:
-                table_key = table_name
-            else:
-                table_key = (table_name,instance_id)
-            table_args[tname] = cache[table_key]
-    args = args | table_args
+                                     cache:  prompt_parser.Cache, args: Optional[dict] = None) -> Any:
+    if args == None:
+        args = prompt_parser.get_table_value(prompt['arguments'], None, cache)
+    args = args | _get_table_arguments(prompt, cache)
 
     results = funct(**args)
     return results
 
+def _get_memoized_rows(prompt: prompt_parser.Prompt, memo: memo_store.MemoStore, function_key: str,
+                       cache: prompt_parser.Cache, arguments: prompt_parser.RenderedTemplate,
+                       df: pd.DataFrame, checkpoint: Optional[file_operations.RowCheckpoint] = None) -> dict[Any, str]:
+    '''
+    memoize: true. Fills rows with missing values from the memo store and returns the call keys of the rest.
+    Rows whose arguments can't be rendered are left to fail in the execution.
+    '''
+    changed_columns = prompt['changed_columns']
+    tables_key = memo_store.get_tables_key(_get_table_arguments(prompt, cache))
+    misses = {}
+    for index in df.index[df[changed_columns].isna().any(axis=1)]:
+        if checkpoint != None and checkpoint.is_done(index):
+            continue
+        try:
+            key = memo_store.get_call_key(function_key, arguments.get(index), tables_key)
+        except IndexError:
+            continue
+        found, values = memo.get(key)
+        if found:
+            df.loc[index, changed_columns] = list(values)
+        else:
+            misses[index] = key
+    return misses
+
 def execute_code_from_prompt(prompt:prompt_parser.Prompt, cache:  prompt_parser.Cache,
                              instance_id: str,
-                             table_name:str, db_dir:str) -> None:
+                             table_name:str, db_dir:str,
+                             write_lock: Optional[threading.RLock] = None,
+                             checkpoint: Optional[file_operations.RowCheckpoint] = None) -> pd.DataFrame:
+    '''
+    write_lock guards the current table when other prompts of the table run at the same time. With a
+    checkpoint, finished rows of UDFs are written periodically and rows it has as done are not executed again.
+    '''
+    if write_lock == None:
+        write_lock = threading.RLock()
     is_udf = prompt['is_udf']
-    is_global = prompt['is_global']
-    code_file = prompt['code_file']
     prompt_function = prompt['function']
     if 'n_threads' in prompt:
         n_threads = prompt['n_threads']
     else:
         n_threads = 1   
     
-    if is_global:
-        code_file = os.path.join('./code_functions/', code_file)
-    else:
-        code_file = os.path.join(db_dir, 'code_functions')
-        code_file = os.path.join(code_file, code_file)
-    
-    funct, namespace = load_function_from_file(code_file, prompt_function)
+    code_file = _get_code_file(prompt, db_dir)
+    cache_dir = _get_module_cache_dir(db_dir)
+    funct, namespace = load_function_from_file(code_file, prompt_function, cache_dir)
+    memo = None
+    if prompt.get('memoize', False):
+        memo = memo_store.MemoStore(db_dir, prompt.get('memo_size', memo_store.DEFAULT_MEMO_SIZE))
+        function_key = memo_store.get_function_key(code_file, prompt_function)
     df = cache['self']
     if is_udf:
         indices = list(range(len(df)))
-        with ThreadPoolExecutor(max_workers=n_threads) as executor: 
-            results = list(
-                executor.map(
-                    lambda i: _execute_code_from_prompt(i, prompt, funct, cache),
-                    indices
+        with write_lock:
+            arguments = prompt_parser.render_table_values(prompt['arguments'], cache)
+            current = df[prompt['changed_columns']].copy()
+        if memo != None:
+            current = current.astype(object)
+            misses = _get_memoized_rows(prompt, memo, function_key, cache, arguments, current, checkpoint)
+        if prompt.get('is_batch', False):
+            columns = _execute_code_in_batches(prompt, funct, cache, arguments, current, n_threads, checkpoint)
+        elif prompt.get('executor', 'thread') == 'process':
+            # n_threads is the number of worker processes
+            columns = list(zip(*_execute_code_in_processes(prompt, code_file, cache_dir, cache, arguments, current, n_threads,
+                                                          checkpoint)))
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor: 
+                results = list(
+                    executor.map(
+                        lambda i: _execute_code_from_prompt(i, prompt, funct, cache, arguments, current, checkpoint),
+                        indices
+                    )
                 )
-            )
-            for col, values in zip(prompt['changed_columns'], zip(*results)):
+            columns = list(zip(*results))
+        if memo != None:
+            for index, key in misses.items():
+                position = current.index.get_loc(index)
+                memo.put(key, tuple(values.iloc[position] if isinstance(values, pd.Series) else values[position]
+                                    for values in columns))
+        with write_lock:
+            for col, values in zip(prompt['changed_columns'], columns):
                 df[col] = values
+            file_operations.write_table(df, instance_id, table_name, db_dir)
     else:
-        results = _execute_single_code_from_prompt(prompt, funct, cache)
-        for col, values in prompt['changed_columns']:
-            df[col] = results[col]
-    file_operations.write_table(df, instance_id, table_name, db_dir)
+        with write_lock:
+            arguments = prompt_parser.get_table_value(prompt['arguments'], None, cache)
+        if memo != None:
+            key = memo_store.get_call_key(function_key, arguments,
+                                          memo_store.get_tables_key(_get_table_arguments(prompt, cache)))
+            found, results = memo.get(key)
+            if not found:
+                results = _execute_single_code_from_prompt(prompt, funct, cache, arguments)
+                memo.put(key, results)
+        else:
+            results = _execute_single_code_from_prompt(prompt, funct, cache, arguments)
+        with write_lock:
+            for col, values in prompt['changed_columns']:
+                df[col] = results[col]
+            file_operations.write_table(df, instance_id, table_name, db_dir)
+    if memo != None:
+        memo.evict()
+        memo.record_stats(prompt_function)
+    return df
 
 
 def execute_gen_table_from_prompt(prompt:prompt_parser.Prompt, cache: prompt_parser.Cache, 
-                                  instance_id:str, table_name:str, db_dir: str) -> None:
-    is_global = prompt['is_global']
-    code_file = prompt['code_file']
+                                  instance_id:str, table_name:str, db_dir: str) -> pd.DataFrame:
     prompt_function = prompt['function']
-    
-    if is_global:
-        code_file = os.path.join('./code_functions/', code_file)
-    else:
-        code_file = os.path.join(db_dir, 'code_functions')
-        code_file = os.path.join(code_file, code_file)
-    funct, namespace = load_function_from_file(code_file, prompt_function)
+    code_file = _get_code_file(prompt, db_dir)
+    funct, namespace = load_function_from_file(code_file, prompt_function, _get_module_cache_dir(db_dir))
     results = _execute_single_code_from_prompt(prompt, funct, cache)
     columns = list(cache['self'].columns)
     df = pd.merge(results, cache['self'], how='left', on=prompt['changed_columns'])
     df = df[columns]
     file_operations.write_table(df, instance_id, table_name, db_dir)
+    return df
@@ -1,54 +1,61 @@
 import string
 import random
+import asyncio
 import threading
-from typing import Optional
+from typing import Optional, Any, Generator
 import openai
 import ast
+import pandas as pd
 from concurrent.futures import ThreadPoolExecutor
 
 from auto_data_table import file_operations
-from auto_data_table.llm_functions.open_ai_thread import Open_AI_Thread, add_open_ai_secret
+from auto_data_table.llm_functions.open_ai_thread import Open_AI_Thread, Async_Open_AI_Thread, add_open_ai_secret
 from auto_data_table.prompt_execution import prompt_parser 
 from auto_data_table.prompt_execution import llm_prompts
 
 
-def _execute_llm(index: int, prompt: dict, client: Optional[openai.OpenAI], 
-                 lock: threading.Lock, cache: prompt_parser.Cache, 
-                 instance_id:str, table_name:str, db_dir: str) -> None:
-    df = cache['self']
+def _is_row_to_change(index: int, prompt: dict, df: pd.DataFrame) -> bool:
     to_change = False
     for i, column in enumerate(prompt['changed_columns']):
-        if df.at[index, column] == '':
+        value = df.at[index, column]
+        if pd.isna(value) or value == '':
             to_change = True
-    if not to_change:
-        return 
+    return to_change
+
+def _get_thread_settings(index: int, prompt: dict, rendered: dict[str, prompt_parser.RenderedTemplate]) -> tuple[str, str, bool]:
     # get open_ai file keys
     name = prompt['name'] + str(index) + ''.join(random.choices(string.ascii_letters, k=5))
-    prompt['context_files'] = prompt_parser.get_table_value(prompt['context_files'], index,cache)
-    prompt['context_msgs'] = prompt_parser.get_table_value(prompt['context_msgs'], index, cache)
-    prompt['instructions'] = prompt_parser.get_table_value(prompt['instructions'], index,cache)
-    prompt['questions'] = prompt_parser.get_table_value(prompt['questions'], index, cache)
+    instructions = rendered['instructions'].get(index)
+    uses_files = len(rendered['context_files'].get(index)) > 0
+    return name, instructions, uses_files
 
-    uses_files = len(prompt['context_files']) > 0
-    thread = Open_AI_Thread(name, prompt['model'], prompt['temperature'], prompt['retry'],
-                            prompt['instructions'], client=client, uses_files = uses_files)
+def _llm_conversation(index: int, prompt: dict, 
+                      rendered: dict[str, prompt_parser.RenderedTemplate]) -> Generator[Optional[tuple], Optional[str], dict[str, Any]]:
+    '''
+    Messages and queries of one row, shared by the engines so they give the same results. Yields
+    (message, file_ids) to add a message and None to run a query, which is sent back the answer.
+    Returns the values of the changed columns.
+    '''
+    context_files = rendered['context_files'].get(index)
+    context_msgs = rendered['context_msgs'].get(index)
+    questions = rendered['questions'].get(index)
 
-    if isinstance(prompt['context_msgs'], list):
-        for i, cfile in enumerate(prompt['context_files']):
-            thread.add_message(message = prompt['context_msgs'][i],  file_ids = [cfile])
+    if isinstance(context_msgs, list):
+        for i, cfile in enumerate(context_files):
+            yield context_msgs[i], [cfile]
     else:
-        thread.add_message(prompt['context_msgs'], file_ids = prompt['context_files'])
+        yield context_msgs, context_files
 
     if prompt['output_type'] == 'category' and 'category_definition' in prompt:
-        thread.add_message(prompt['category_definition'])
+        yield prompt['category_definition'], None
 
     # parse and add questions
     results = []
-    for question in prompt['questions']:
+    for question in questions:
         if prompt['output_type'] == 'category':
             question = question.replace('CATEGORIES', prompt['category_names'])        
-        thread.add_message(question)        
-        result = thread.run_query()
+        yield question, None        
+        result = yield None
         results.append(result)            
     
     # deal with output_types:
@@ -57,15 +64,15 @@ def _execute_llm(index: int, prompt: dict, client: Optional[openai.OpenAI],
     elif prompt['output_type'] == 'entity':
         msg = llm_prompts.ENTITY_MSG
         msg = msg.replace('ENTITY_NAME', prompt['entity_name'])
-        thread.add_message(message = msg)
-        result = thread.run_query()
+        yield msg, None
+        result = yield None
         results.append(result)
     elif prompt['output_type'] == 'entity_list':
         msg = llm_prompts.ENTITY_LIST_MSG
         msg = msg.replace('ENTITY_NAME', prompt['entity_name'])
-        thread.add_message(message = msg)
+        yield msg, None
         for i in range(prompt['retry']):
-            result = thread.run_query()
+            result = yield None
             try:
                 result = ast.literal_eval(result)
                 break
@@ -76,32 +83,103 @@ def _execute_llm(index: int, prompt: dict, client: Optional[openai.OpenAI],
     elif prompt['output_type'] == 'category':
         msg = llm_prompts.CATEGORY_MSG
         msg = msg.replace('CATEGORIES', prompt['category_names'])
-        thread.add_message(message = msg)
-        result = thread.run_query()
+        yield msg, None
+        result = yield None
         results.append(result)
     else:
         raise ValueError('Output type not supported')
     
-    with lock:
-        for i, column in enumerate(prompt['changed_columns']):
-            df.at[index, column]= results[i]
-        file_operations.write_table(df, instance_id, table_name, db_dir)
+    return {column: results[i] for i, column in enumerate(prompt['changed_columns'])}
+
+def _execute_llm(index: int, prompt: dict, client: Optional[openai.OpenAI], 
+                 delta_log: file_operations.TableDeltaLog, cache: prompt_parser.Cache,
+                 rendered: dict[str, prompt_parser.RenderedTemplate], df: pd.DataFrame) -> None:
+    if not _is_row_to_change(index, prompt, df):
+        return 
+    name, instructions, uses_files = _get_thread_settings(index, prompt, rendered)
+    thread = Open_AI_Thread(name, prompt['model'], prompt['temperature'], prompt['retry'],
+                            instructions, client=client, uses_files = uses_files)
+    conversation = _llm_conversation(index, prompt, rendered)
+    try:
+        step = next(conversation)
+        while True:
+            if step == None:
+                step = conversation.send(thread.run_query())
+            else:
+                thread.add_message(step[0], file_ids = step[1])
+                step = next(conversation)
+    except StopIteration as stop:
+        values = stop.value
+    delta_log.append(index, values)
+
+async def _execute_llm_async(index: int, prompt: dict, client: openai.AsyncOpenAI, 
+                             delta_log: file_operations.TableDeltaLog, cache: prompt_parser.Cache,
+                             rendered: dict[str, prompt_parser.RenderedTemplate], df: pd.DataFrame) -> None:
+    if not _is_row_to_change(index, prompt, df):
+        return 
+    name, instructions, uses_files = _get_thread_settings(index, prompt, rendered)
+    thread = await Async_Open_AI_Thread.create(name, prompt['model'], prompt['temperature'], prompt['retry'],
+                                               instructions, client=client, uses_files = uses_files)
+    conversation = _llm_conversation(index, prompt, rendered)
+    try:
+        step = next(conversation)
+        while True:
+            if step == None:
+                step = conversation.send(await thread.run_query())
+            else:
+                await thread.add_message(step[0], file_ids = step[1])
+                step = next(conversation)
+    except StopIteration as stop:
+        values = stop.value
+    # append fsyncs and compacts under the table's write lock, the other requests keep running meanwhile
+    await asyncio.to_thread(delta_log.append, index, values)
+
+DEFAULT_MAX_REQUESTS = 256
+
+async def _execute_llm_rows_async(indices: list[int], prompt: dict, delta_log: file_operations.TableDeltaLog,
+                                  cache: prompt_parser.Cache, rendered: dict[str, prompt_parser.RenderedTemplate],
+                                  df: pd.DataFrame, max_requests: int) -> None:
+    semaphore = asyncio.Semaphore(max_requests)
+    async with openai.AsyncOpenAI() as client:
+        async def execute_row(index: int) -> None:
+            async with semaphore:
+                await _execute_llm_async(index, prompt, client, delta_log, cache, rendered, df)
+        await asyncio.gather(*(execute_row(index) for index in indices))
 
 def execute_llm_from_prompt(prompt:dict, cache: prompt_parser.Cache,
                             instance_id:str,
-                            table_name:str, db_dir:str) -> None:
-    '''Only support OpenAI Thread prompts for now'''
+                            table_name:str, db_dir:str,
+                            write_lock: Optional[threading.RLock] = None) -> pd.DataFrame:
+    '''
+    Only support OpenAI Thread prompts for now. write_lock guards the current table when other prompts
+    of the table run at the same time. Rows run on n_threads threads, or with engine: async as up to
+    max_requests concurrent requests of the async client in one event loop.
+    '''
     key_file =  prompt['open_ai_key']
-    n_threads = prompt['n_threads']
+    engine = prompt.get('engine', 'thread')
     
     with open(key_file, 'r') as f:
         secret = f.read()
         add_open_ai_secret(secret)
-    client = openai.OpenAI()
-    indices = list(range(len(cache[table_name])))
-    lock = threading.Lock()
-    with ThreadPoolExecutor(max_workers=n_threads) as executor:
-        executor.map(
-            lambda i: _execute_llm(i, prompt, client, lock, cache, instance_id, table_name, db_dir),
-            indices
-        )
\ No newline at end of file
+    compact_every = prompt.get('compact_every', 100)
+    indices = list(range(len(cache['self'])))
+    delta_log = file_operations.TableDeltaLog(cache['self'], instance_id, table_name, db_dir, compact_every,
+                                              lock=write_lock)
+    with delta_log.lock:
+        rendered = {field: prompt_parser.render_table_values(prompt[field], cache)
+                    for field in ['context_files', 'context_msgs', 'instructions', 'questions']}
+        current = cache['self'][prompt['changed_columns']].copy()
+    if engine == 'async':
+        max_requests = prompt.get('max_requests', DEFAULT_MAX_REQUESTS)
+        asyncio.run(_execute_llm_rows_async(indices, prompt, delta_log, cache, rendered, current, max_requests))
+    elif engine == 'thread':
+        client = openai.OpenAI()
+        with ThreadPoolExecutor(max_workers=prompt['n_threads']) as executor:
+            list(executor.map(
+                lambda i: _execute_llm(i, prompt, client, delta_log, cache, rendered, current),
+                indices
+            ))
+    else:
+        raise ValueError(f'LLM engine {engine} not supported')
+    delta_log.compact()
+    return cache['self']
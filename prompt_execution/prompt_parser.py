@@ -1,15 +1,24 @@
 
-from typing import Any, Union
-import file_operations
-from meta_operations import MetaDataStore
+from typing import Any, Union, Optional
+import os
+import hashlib
+import pickle
+import yaml
+from auto_data_table import file_operations
+from auto_data_table.meta_operations import MetaDataStore
 from collections import deque 
-from auto_data_table.prompt_execution.prompt_parser_table import parse_prompt_from_yaml, parse_obj_from_prompt
+from auto_data_table.prompt_execution import fingerprints
+from auto_data_table.prompt_execution.prompt_parser_table import parse_prompt_from_yaml, parse_obj_from_prompt, get_table_references, compile_template, PromptTemplate, RenderedTemplate
 import pandas as pd
 import copy 
 import re
 
 Prompt = dict[Any]
-Cache = dict[Union[str, tuple[str, str]], pd.DataFrame]
+CacheKey = Union[str, tuple[str, str]]
+Cache = dict[CacheKey, pd.DataFrame]
+
+PROMPT_CACHE_DIR = 'prompt_cache'
+PROMPT_PLAN_VERSION = 2 # bump when the compiled format changes, old cache entries are then ignored
 
 def get_changed_columns(prompt: Prompt) -> list[str]:
     if prompt['type'] == 'code':
@@ -29,10 +38,103 @@ def convert_reference(prompt: Prompt) -> Prompt:
     return parse_prompt_from_yaml(prompt)
 
 
+def compile_prompt(prompt: Prompt) -> Prompt:
+    '''Like convert_reference, but every value that reads tables is compiled to a PromptTemplate.'''
+    compiled = {}
+    for key, value in parse_prompt_from_yaml(prompt).items():
+        if len(get_table_references(value)) > 0:
+            value = compile_template(value)
+        compiled[key] = value
+    if prompt.get('type') in ('code', 'llm') and 'parsed_changed_columns' not in compiled:
+        compiled['parsed_changed_columns'] = get_changed_columns(prompt)
+    return compiled
+
+
+def _prune_prompt_cache(cache_dir: str, source: str, cache_file: str) -> None:
+    '''Removes the entries of earlier versions of the prompt file, and entries of the old <hash>.pkl format.'''
+    for item in os.listdir(cache_dir):
+        stale = item.startswith(source + '.') or item.count('.') == 1
+        if stale and item.endswith('.pkl') and item != cache_file:
+            try:
+                os.remove(os.path.join(cache_dir, item))
+            except FileNotFoundError:
+                pass
+
+def compile_prompts(instance_id: str, table_name: str, db_dir: str) -> dict[str, Prompt]:
+    '''
+    Compiled prompts of a table instance, without the description. Compiled prompts are cached in
+    <db>/metadata/prompt_cache/<table>.<prompt>.<hash>.pkl by the content hash of their prompt file, only
+    the entry of the last compiled version of each prompt is kept.
+    '''
+    cache_dir = os.path.join(db_dir, 'metadata', PROMPT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    prompts = {}
+    for name, prompt_path in file_operations.get_prompt_paths(instance_id, table_name, db_dir).items():
+        if name == 'description':
+            continue
+        with open(prompt_path, 'rb') as file:
+            content = file.read()
+        digest = hashlib.sha256(str(PROMPT_PLAN_VERSION).encode() + b'\n' + content).hexdigest()
+        source = f'{table_name}.{name}'
+        cache_file = f'{source}.{digest}.pkl'
+        cache_path = os.path.join(cache_dir, cache_file)
+        try:
+            with open(cache_path, 'rb') as file:
+                prompts[name] = pickle.load(file)
+            continue
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        prompts[name] = compile_prompt(yaml.safe_load(content))
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(prompts[name], file)
+        os.replace(temp_path, cache_path)
+        _prune_prompt_cache(cache_dir, source, cache_file)
+    return prompts
+
+
 def get_table_value(item: Any, index: int, cache:dict[str, pd.DataFrame]) -> str:
     return parse_obj_from_prompt(item, index, cache)
 
 
+def render_table_values(item: Any, cache: Cache) -> RenderedTemplate:
+    '''Renders item for every row of the current table at once, rows are then read with .get(index).'''
+    if not isinstance(item, PromptTemplate):
+        item = compile_template(item)
+    return item.render(cache)
+
+
+def get_dependency_columns(prompt: Prompt, external_deps: list) -> dict[CacheKey, Optional[list[str]]]:
+    '''
+    Columns a converted prompt reads from each external table, keyed like the table cache.
+    None means the whole table is needed (table level dependencies and table_arguments).
+    '''
+    columns = {}
+    for table, column, instance, _, latest in external_deps:
+        key = table if latest else (table, instance)
+        if column == None:
+            columns[key] = None
+        elif key not in columns:
+            columns[key] = [column]
+        elif columns[key] != None and column not in columns[key]:
+            columns[key].append(column)
+
+    for ref in get_table_references(prompt):
+        key = ref.table if ref.instance_id == None else (ref.table, ref.instance_id)
+        if key not in columns or columns[key] == None:
+            continue
+        for column in [ref.column] + list(ref.key.keys()):
+            if column not in columns[key]:
+                columns[key].append(column)
+
+    if 'table_arguments' in prompt:
+        for table in prompt['table_arguments'].values():
+            match = re.match(r"^(\w+)(?:\((\w+)\))?$", table)
+            key = match.group(1) if match.group(2) == None else (match.group(1), match.group(2))
+            columns[key] = None
+    return columns
+
+
 def _topological_sort(items: list, dependencies: dict) -> list:
     # Step 1: Build the graph based on parent -> child dependencies
     graph = {item: [] for item in items}
@@ -93,6 +195,7 @@ def _parse_dependencies(prompts:dict[Prompt], table_generator:str,
     internal_prompt_deps = {}
     internal_deps = {}
     gen_columns = prompts[table_generator]['parsed_changed_columns']
+    to_resolve = []
     for pname in prompts:
         external_deps[pname] = set()
         if pname != table_generator:
@@ -104,38 +207,38 @@ def _parse_dependencies(prompts:dict[Prompt], table_generator:str,
 
         for dep in prompts[pname]['dependencies']:
             table, column, instance = parse_string(dep)
-            if instance == None:
-                latest = True
-            else:
-                latest = False
             if table == 'self':
                 internal_deps[pname].add(column) #TODO check this
                 for pn in prompts:
                     if column in prompts[pn]['parsed_changed_columns']:
                         internal_prompt_deps[pname].add(pn)
                 continue
-            elif not db_metadata.get_table_multiple(table) and instance != None:
-                raise ValueError(f"Table dependency ({table}, {column}, {instance}) for prompt {pname} doesn't have versions.")
-            elif column != None:
-                if instance != None:
-                    mat_time = db_metadata.get_column_version_update(column, instance, table, start_time)
-                else:
-                    instance, mat_time = db_metadata.get_last_column_update(table, column, start_time)
-                if mat_time == 0:
-                    raise ValueError('Table dependency ({table}, {column}, {instance}) for prompt {pname} not materialized at {start_time}')
-            else:
-                if instance != None:
-                    mat_time = db_metadata.get_table_version_update(instance, table, start_time)
-                else:
-                    instance, mat_time = db_metadata.get_last_table_update(table, start_time)   
-                if mat_time == 0:
-                    raise ValueError('Table dependency ({table}, {column}, {instance}) for prompt {pname} not materialized at {start_time}')
-            external_deps[pname].add((table, column, instance, mat_time, latest))
+            to_resolve.append((pname, (table, column, instance)))
+
+    # all version lookups in one read of the metadata
+    versions = db_metadata.get_dependency_versions([dep for _, dep in to_resolve], start_time)
+    for (pname, (table, column, instance)), (allow_multiple, mat_time, version) in zip(to_resolve, versions):
+        latest = instance == None
+        if not allow_multiple and instance != None:
+            raise ValueError(f"Table dependency ({table}, {column}, {instance}) for prompt {pname} doesn't have versions.")
+        if mat_time == 0:
+            raise ValueError(f'Table dependency ({table}, {column}, {instance}) for prompt {pname} not materialized at {start_time}')
+        external_deps[pname].add((table, column, version, mat_time, latest))
+
+    for pname in prompts:
         external_deps[pname] = list(external_deps[pname])
         internal_deps[pname] = list(internal_deps[pname])
         internal_prompt_deps[pname] = list(internal_prompt_deps[pname])
     return internal_prompt_deps, internal_deps, external_deps
 
+def get_prompt_dependencies(prompts: dict[Prompt], top_pnames: list[str], internal_deps: InternalDeps) -> dict[str, list[str]]:
+    '''Prompts each prompt has to wait for: the prompts that change the columns of the table it reads.'''
+    prompt_deps = {}
+    for pname in top_pnames:
+        prompt_deps[pname] = [pn for pn in top_pnames if pn != pname and
+                              any(col in prompts[pn]['parsed_changed_columns'] for col in internal_deps[pname])]
+    return prompt_deps
+
 def parse_prompts(prompts: dict[Prompt], db_metadata: MetaDataStore , start_time:float,table_name:str, db_dir: str):
     metadata = prompts['description']
     del prompts['description']
@@ -149,15 +252,17 @@ def parse_prompts(prompts: dict[Prompt], db_metadata: MetaDataStore , start_time
     top_pnames = _topological_sort(list(prompts.keys()), internal_prompt_deps)
     all_columns = []
     to_change_columns = []
+    # changed columns that are only cleared in the rows whose fingerprint changed
+    incremental_columns = []
     for i, pname in enumerate(top_pnames):
         all_columns += prompts[pname]['parsed_changed_columns']
 
-    if 'prev_name_id' in metadata:
+    if 'origin' in metadata:
         to_execute = []
         prev_start_time = metadata['prev_start_time']
-        prev_name_id = metadata['prev_name_id']
+        prev_name_id = metadata['origin']
         to_execute = [top_pnames[0]] # we always run the generator
-        prev_prompts = file_operations.get_prompts(table_name, db_dir, prev_name_id)
+        prev_prompts = file_operations.get_prompts(prev_name_id, table_name, db_dir)
         for pname in top_pnames[1:]:
             execute = False
             for dep in internal_prompt_deps[pname]:
@@ -173,13 +278,19 @@ def parse_prompts(prompts: dict[Prompt], db_metadata: MetaDataStore , start_time
             if not execute:
                 if pname not in prev_prompts:
                     execute = True
-                elif prev_prompts[pname] != prompts[pname]:
+                elif prev_prompts[pname] != {k: v for k, v in prompts[pname].items() if k != 'parsed_changed_columns'}:
                     execute = True
             if execute:
                 to_execute.append(pname)
+            # with fingerprints the prompt recomputes the rows whose inputs changed or that are new, if there
+            # are none its columns keep their version (recorded as unchanged_columns when it runs)
+            if fingerprints.load_fingerprints(pname, prev_name_id, table_name, db_dir) != None:
+                to_change_columns += prompts[pname]['parsed_changed_columns']
+                incremental_columns += prompts[pname]['parsed_changed_columns']
+            elif execute:
                 to_change_columns += prompts[pname]['parsed_changed_columns']
     else:
         #to_change_columns = all_columns
         for pname in top_pnames[1:]:
             to_change_columns += prompts[pname]['parsed_changed_columns']
-    return top_pnames, to_change_columns, all_columns, internal_deps, external_deps
+    return top_pnames, to_change_columns, incremental_columns, all_columns, internal_deps, external_deps
@@ -1,6 +1,8 @@
 
 from typing import Any, Optional, Union
 import re
+import threading
+import weakref
 from dataclasses import dataclass
 import pandas as pd
 
@@ -17,6 +19,110 @@ class TableString:
     text: str
     references: list[TableReference]
 
+@dataclass
+class Slot:
+    position: int
+
+
+@dataclass
+class PromptTemplate:
+    """
+    A prompt value compiled to a flat plan: its structure with every string or reference replaced by a Slot,
+    the text pieces around the references of each slot (None for a bare reference), and the distinct
+    references, so rendering resolves each reference once for all rows and only fills in slots per row.
+    """
+    structure: Any
+    pieces: list[Optional[list[str]]]
+    slot_references: list[list[int]]
+    references: list[TableReference]
+
+    def render(self, cache: dict, rows: Optional[pd.Index] = None) -> 'RenderedTemplate':
+        '''Renders every row index in rows (default: every row of the current table) in one pass.'''
+        if rows is None:
+            rows = cache['self'].index
+        values = [_resolve_table_reference(ref, rows, cache) for ref in self.references]
+        slot_values = []
+        for pieces, references in zip(self.pieces, self.slot_references):
+            if pieces == None:
+                slot_values.append(values[references[0]].to_dict())
+                continue
+            slot_rows = rows
+            for reference in references:
+                slot_rows = slot_rows.intersection(values[reference].index, sort=False)
+            text = pd.Series(pieces[0], index=slot_rows, dtype=object)
+            for reference, piece in zip(references, pieces[1:]):
+                text = text + values[reference].loc[slot_rows].astype(str) + piece
+            slot_values.append(text.to_dict())
+        return RenderedTemplate(self, slot_values)
+
+    def render_row(self, index: Optional[int], cache: dict) -> Any:
+        '''Renders a single row, or the table level value if index is None.'''
+        values = [_read_table_reference(ref, index=index, cache=cache) for ref in self.references]
+        slot_values = []
+        for pieces, references in zip(self.pieces, self.slot_references):
+            if pieces == None:
+                slot_values.append({index: values[references[0]]})
+                continue
+            text = pieces[0]
+            for reference, piece in zip(references, pieces[1:]):
+                text += str(values[reference]) + piece
+            slot_values.append({index: text})
+        return RenderedTemplate(self, slot_values).get(index)
+
+
+@dataclass
+class RenderedTemplate:
+    template: PromptTemplate
+    slot_values: list[dict[Any, Any]]
+
+    def get(self, index: Optional[int]) -> Any:
+        return self._fill(self.template.structure, index)
+
+    def get_columns(self, rows: list) -> dict[str, Any]:
+        '''
+        For a dict template: every key as a Series over rows, keys without references keep their constant value.
+        '''
+        columns = {}
+        for key, structure in self.template.structure.items():
+            if isinstance(structure, Slot):
+                values = self.slot_values[structure.position]
+                missing = [index for index in rows if index not in values]
+                if len(missing) > 0:
+                    self._fill(structure, missing[0])
+                columns[key] = pd.Series([values[index] for index in rows], index=rows, name=key)
+            elif _has_slots(structure):
+                columns[key] = pd.Series([self._fill(structure, index) for index in rows], index=rows, name=key)
+            else:
+                columns[key] = structure
+        return columns
+
+    def _fill(self, structure: Any, index: Optional[int]) -> Any:
+        if isinstance(structure, Slot):
+            values = self.slot_values[structure.position]
+            if index not in values:
+                references = [self.template.references[i] for i in self.template.slot_references[structure.position]]
+                raise IndexError(f'No row matches {references} for row {index}')
+            return values[index]
+        elif isinstance(structure, dict):
+            return {key: self._fill(value, index) for key, value in structure.items()}
+        elif isinstance(structure, list):
+            return [self._fill(value, index) for value in structure]
+        return structure
+
+def _has_slots(structure: Any) -> bool:
+    if isinstance(structure, Slot):
+        return True
+    elif isinstance(structure, dict):
+        return any(_has_slots(value) for value in structure.values())
+    elif isinstance(structure, list):
+        return any(_has_slots(value) for value in structure)
+    return False
+
+# (id(df), key columns, column) -> column of df indexed by its key columns, kept while df is alive
+_key_indexes: dict[tuple[int, tuple[str, ...], str], pd.Series] = {}
+_key_indexes_lock = threading.Lock()
+_indexed_frames: set[int] = set()
+
 def parse_prompt_from_yaml(data:Any) -> Any:
     if isinstance(data, dict):
         return {k: parse_prompt_from_yaml(v) for k, v in data.items()}
@@ -28,7 +134,9 @@ def parse_prompt_from_yaml(data:Any) -> Any:
         return data
     
 def parse_obj_from_prompt(prompt:Any, index:Optional[int], cache:dict[str, pd.DataFrame]) -> Any:
-    if isinstance(prompt, TableString):
+    if isinstance(prompt, PromptTemplate):
+        prompt_ = prompt.render_row(index, cache)
+    elif isinstance(prompt, TableString):
         prompt_ = prompt.text
         for ref in prompt.references: 
             ref_ = _read_table_reference(ref, index=index, cache= cache)
@@ -50,6 +158,62 @@ def parse_obj_from_prompt(prompt:Any, index:Optional[int], cache:dict[str, pd.Da
         prompt_ = prompt
     return prompt_
 
+def compile_template(prompt: Any) -> PromptTemplate:
+    '''Compiles a parsed prompt value (see parse_prompt_from_yaml).'''
+    template = PromptTemplate(None, [], [], [])
+    ref_positions = {}
+    def add_reference(ref: TableReference) -> int:
+        # references are deduplicated by value, the dataclass isn't hashable
+        if repr(ref) not in ref_positions:
+            ref_positions[repr(ref)] = len(template.references)
+            template.references.append(ref)
+        return ref_positions[repr(ref)]
+    def compile_value(value: Any) -> Any:
+        if isinstance(value, TableString):
+            template.pieces.append(value.text.split('<<>>'))
+            template.slot_references.append([add_reference(ref) for ref in value.references])
+        elif isinstance(value, TableReference):
+            template.pieces.append(None)
+            template.slot_references.append([add_reference(value)])
+        elif isinstance(value, dict):
+            return {key: compile_value(item) for key, item in value.items()}
+        elif isinstance(value, list):
+            return [compile_value(item) for item in value]
+        else:
+            return value
+        return Slot(len(template.pieces) - 1)
+    template.structure = compile_value(prompt)
+    return template
+
+def get_table_references(prompt: Any) -> list[TableReference]:
+    '''All references in a parsed prompt, including the ones nested in keys.'''
+    if isinstance(prompt, PromptTemplate):
+        refs = []
+        for ref in prompt.references:
+            refs += get_table_references(ref)
+        return refs
+    elif isinstance(prompt, TableString):
+        refs = []
+        for ref in prompt.references:
+            refs += get_table_references(ref)
+        return refs
+    elif isinstance(prompt, TableReference):
+        refs = [prompt]
+        for value in prompt.key.values():
+            refs += get_table_references(value)
+        return refs
+    elif isinstance(prompt, dict):
+        refs = []
+        for value in prompt.values():
+            refs += get_table_references(value)
+        return refs
+    elif isinstance(prompt, list):
+        refs = []
+        for value in prompt:
+            refs += get_table_references(value)
+        return refs
+    return []
+
 def _parse_prompt_from_string(val_str: str) -> TableString:
     val_str = val_str.strip()
     if val_str.startswith('<<') and val_str.endswith('>>'):
@@ -79,7 +243,7 @@ def _parse_table_reference(s: str) -> TableReference:
         raise ValueError(f"Invalid TableReference string: {s}")
 
     main_table = m.group(1)
-    main_instance = m.group(2)
+    main_instance = m.group(2)[1:-1] if m.group(2) else None
     main_col = m.group(3)
     inner_content = m.group(5) 
     
@@ -97,7 +261,7 @@ def _parse_table_reference(s: str) -> TableReference:
         key_col = kv_split[0].strip()
         val_str = kv_split[1].strip()
         # Parse the value
-        if val_str.startswith("\'") and  val_str.ends("\'"):
+        if val_str.startswith("\'") and  val_str.endswith("\'"):
             val = val_str[1:-1]
         else:
             val = _parse_table_reference(val_str)
@@ -131,21 +295,86 @@ def _split_top_level_list(s: str) -> list[str]:
     return pairs
 
 
-def _read_table_reference(ref:TableReference, index: Optional[int], cache: dict)-> Union[str, list[str]]:
+def _get_reference_table(ref: TableReference, cache: dict) -> pd.DataFrame:
     if ref.instance_id != None:
-        df = cache[(ref.table, ref.instance_id)]
+        return cache[(ref.table, ref.instance_id)]
+    return cache[ref.table]
+
+
+def _drop_key_indexes(frame_id: int) -> None:
+    with _key_indexes_lock:
+        _indexed_frames.discard(frame_id)
+        for key in [key for key in _key_indexes if key[0] == frame_id]:
+            del _key_indexes[key]
+
+
+def _get_key_index(df: pd.DataFrame, key_columns: list[str], column: str, reusable: bool) -> pd.Series:
+    '''
+    column of df indexed by the key columns, keeping the first of duplicate keys like a query did.
+    reusable indexes are kept until df is garbage collected, so df must not change in the meantime.
+    '''
+    index_key = (id(df), tuple(key_columns), column)
+    if reusable:
+        with _key_indexes_lock:
+            if index_key in _key_indexes:
+                return _key_indexes[index_key]
+    rows = df.drop_duplicates(subset=key_columns, keep='first')
+    if len(key_columns) == 1:
+        index = pd.Index(rows[key_columns[0]])
+    else:
+        index = pd.MultiIndex.from_frame(rows[key_columns])
+    key_index = pd.Series(rows[column].to_list(), index=index, dtype=object)
+    if reusable:
+        with _key_indexes_lock:
+            if id(df) not in _indexed_frames:
+                weakref.finalize(df, _drop_key_indexes, id(df))
+                _indexed_frames.add(id(df))
+            _key_indexes[index_key] = key_index
+    return key_index
+
+
+def _resolve_table_reference(ref: TableReference, rows: pd.Index, cache: dict) -> pd.Series:
+    '''Values of ref for every row index in rows, rows without a match are left out.'''
+    df = _get_reference_table(ref, cache)
+    if len(ref.key) == 0:
+        values = df.loc[rows.intersection(df.index, sort=False), ref.column]
+        return pd.Series(values.to_list(), index=values.index, dtype=object)
+    key_values = []
+    for condition, value in ref.key.items():
+        if isinstance(value, TableReference):
+            value = _resolve_table_reference(value, rows, cache)
+            rows = value.index
+            key_values = [values.loc[rows] for values in key_values]
+            key_values.append(value)
+        else:
+            key_values.append(pd.Series(value, index=rows, dtype=object))
+    # the current table changes between prompts, so only dependency indexes are reused
+    key_index = _get_key_index(df, list(ref.key.keys()), ref.column, reusable=ref.table != 'self')
+    if len(key_values) == 1:
+        keys = pd.Index(key_values[0].to_list(), dtype=object)
     else:
-        df = cache[ref.table]
-    conditions = {}
+        keys = pd.MultiIndex.from_arrays([values.to_list() for values in key_values])
+    positions = key_index.index.get_indexer(keys)
+    # NaN keys never matched a query
+    found = (positions >= 0) & ~pd.concat(key_values, axis=1).isna().any(axis=1).to_numpy()
+    return pd.Series(key_index.to_numpy()[positions[found]], index=rows[found], dtype=object)
+
+
+def _read_table_reference(ref:TableReference, index: Optional[int], cache: dict)-> Union[str, list[str]]:
+    df = _get_reference_table(ref, cache)
     if len(ref.key) == 0:
-        conditions['index'] = index
+        if index not in df.index:
+            raise IndexError(f'No row of {ref.table} matches {ref} for row {index}')
+        return df.at[index, ref.column]
+    key = []
     for condition, value in ref.key.items():
         if isinstance(value, TableReference):
             value = _read_table_reference(value, index = index, cache = cache)
-        conditions[condition] = value
-    query_str = ' & '.join([f'{k} == {repr(v)}' for k, v in conditions.items()])
-    rows = df.query(query_str)
-    result = rows[ref.column].to_list() 
-    return result[0]
-    
-
+        key.append(value)
+    key_index = _get_key_index(df, list(ref.key.keys()), ref.column, reusable=ref.table != 'self')
+    position = -1
+    if not any(pd.isna(value) for value in key):
+        position = key_index.index.get_indexer([key[0] if len(key) == 1 else tuple(key)])[0]
+    if position < 0:
+        raise IndexError(f'No row of {ref.table} matches {ref}')
+    return key_index.iloc[position]
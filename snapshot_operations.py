@@ -0,0 +1,156 @@
+import os
+import socket
+import shutil
+import uuid
+from typing import Optional
+
+from auto_data_table import file_operations
+from auto_data_table.database_lock import process_alive
+
+SNAPSHOT_DIR = 'snapshots'
+TABLE_TOMBSTONE = '__table__'
+
+
+def _table_dir(db_dir: str, table_name: str) -> str:
+    return os.path.join(db_dir, SNAPSHOT_DIR, table_name)
+
+
+def _reader_dir(db_dir: str, table_name: str, instance_id: str) -> str:
+    return os.path.join(_table_dir(db_dir, table_name), 'readers', instance_id)
+
+
+def _tombstone(db_dir: str, table_name: str, instance_id: str = TABLE_TOMBSTONE) -> str:
+    return os.path.join(_table_dir(db_dir, table_name), 'tombstones', instance_id)
+
+
+def _is_retired(db_dir: str, table_name: str, instance_id: str) -> bool:
+    # a tombstone is renamed to <tombstone>.reaping while its files are removed
+    for tombstone in (_tombstone(db_dir, table_name, instance_id), _tombstone(db_dir, table_name)):
+        if os.path.exists(tombstone) or os.path.exists(tombstone + '.reaping'):
+            return True
+    return False
+
+
+def _reader_alive(reader: str) -> bool:
+    host, pid, _ = reader.rsplit('_', 2)
+    return process_alive(host, int(pid))
+
+
+def _active_readers(db_dir: str, table_name: str, instance_id: Optional[str] = None, clean: bool = False) -> int:
+    '''Registered readers of one instance, or of every instance of the table. clean drops readers of dead processes.'''
+    if instance_id == None:
+        readers_dir = os.path.join(_table_dir(db_dir, table_name), 'readers')
+        if not os.path.isdir(readers_dir):
+            return 0
+        return sum(_active_readers(db_dir, table_name, instance, clean) for instance in os.listdir(readers_dir))
+    reader_dir = _reader_dir(db_dir, table_name, instance_id)
+    if not os.path.isdir(reader_dir):
+        return 0
+    count = 0
+    for reader in os.listdir(reader_dir):
+        if clean and not _reader_alive(reader):
+            os.remove(os.path.join(reader_dir, reader))
+            continue
+        count += 1
+    return count
+
+
+def _reap(db_dir: str, table_name: str, instance_id: str = TABLE_TOMBSTONE) -> None:
+    tombstone = _tombstone(db_dir, table_name, instance_id)
+    try:
+        # only one of the concurrent reapers wins the rename
+        os.rename(tombstone, tombstone + '.reaping')
+    except FileNotFoundError:
+        if not os.path.exists(tombstone + '.reaping'):
+            return
+    if instance_id == TABLE_TOMBSTONE:
+        file_operations.delete_table(table_name, db_dir)
+        shutil.rmtree(_table_dir(db_dir, table_name), ignore_errors=True)
+    else:
+        file_operations.delete_table(table_name, db_dir, instance_id)
+        shutil.rmtree(_reader_dir(db_dir, table_name, instance_id), ignore_errors=True)
+        os.remove(tombstone + '.reaping')
+
+
+def retire_instance(db_dir: str, table_name: str, instance_id: Optional[str] = None) -> bool:
+    '''
+    Marks a materialized instance (or the whole table) as deleted. New snapshots of it fail, and its files
+    are removed now if nobody is reading it, otherwise by the last reader. Returns True if it was removed.
+    '''
+    if instance_id == None:
+        instance_id = TABLE_TOMBSTONE
+    tombstone = _tombstone(db_dir, table_name, instance_id)
+    os.makedirs(os.path.dirname(tombstone), exist_ok=True)
+    open(tombstone, 'a').close()
+    # readers register before they check for tombstones, so one of the two sides always sees the other
+    readers = _active_readers(db_dir, table_name, None if instance_id == TABLE_TOMBSTONE else instance_id)
+    if readers > 0:
+        return False
+    _reap(db_dir, table_name, instance_id)
+    return True
+
+
+def is_retirement_pending(db_dir: str, table_name: str) -> bool:
+    return os.path.exists(_tombstone(db_dir, table_name)) or os.path.exists(_tombstone(db_dir, table_name) + '.reaping')
+
+
+def reap_retired_instances(db_dir: str) -> None:
+    '''Removes retired instances whose readers are gone, including readers of processes that died.'''
+    snapshot_dir = os.path.join(db_dir, SNAPSHOT_DIR)
+    if not os.path.isdir(snapshot_dir):
+        return
+    for table_name in os.listdir(snapshot_dir):
+        # readers of dead processes would defer the next delete of the instance they read
+        _active_readers(db_dir, table_name, clean=True)
+        tombstone_dir = os.path.join(snapshot_dir, table_name, 'tombstones')
+        if not os.path.isdir(tombstone_dir):
+            continue
+        for tombstone in os.listdir(tombstone_dir):
+            instance_id = tombstone.removesuffix('.reaping')
+            readers = _active_readers(db_dir, table_name, None if instance_id == TABLE_TOMBSTONE else instance_id, clean=True)
+            if readers == 0 and os.path.isdir(tombstone_dir):
+                if tombstone.endswith('.reaping'):
+                    os.rename(os.path.join(tombstone_dir, tombstone), os.path.join(tombstone_dir, instance_id))
+                _reap(db_dir, table_name, instance_id)
+
+
+class InstanceSnapshot:
+    """
+    Lock free read of a materialized table instance. Materialized instances are never modified, so a reader
+    only registers itself in <db>/snapshots/<table>/readers/<instance> and checks that the instance wasn't
+    deleted. Deletes of an instance with readers are deferred until the last one releases.
+    """
+    def __init__(self, db_dir: str, table_name: str, instance_id: str):
+        self.db_dir = db_dir
+        self.table_name = table_name
+        self.instance_id = instance_id
+        self.reader_file = None
+
+    def acquire(self) -> None:
+        reader_dir = _reader_dir(self.db_dir, self.table_name, self.instance_id)
+        os.makedirs(reader_dir, exist_ok=True)
+        reader_file = os.path.join(reader_dir, f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}')
+        open(reader_file, 'a').close()
+        self.reader_file = reader_file
+        if _is_retired(self.db_dir, self.table_name, self.instance_id):
+            self.release()
+            raise FileNotFoundError(f'Table instance was deleted: {self.table_name}({self.instance_id})')
+
+    def release(self) -> None:
+        if self.reader_file == None:
+            return
+        os.remove(self.reader_file)
+        self.reader_file = None
+        for instance_id in (self.instance_id, TABLE_TOMBSTONE):
+            if not os.path.exists(_tombstone(self.db_dir, self.table_name, instance_id)):
+                continue
+            readers = _active_readers(self.db_dir, self.table_name, None if instance_id == TABLE_TOMBSTONE else instance_id)
+            if readers == 0:
+                _reap(self.db_dir, self.table_name, instance_id)
+
+    def __enter__(self) -> 'InstanceSnapshot':
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
@@ -0,0 +1,405 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import socket
+import pprint
+from contextlib import contextmanager
+from dataclasses import asdict
+from typing import Optional, Union, Any, Iterator
+
+from auto_data_table.meta_operations import MetaDataStore, ProcessLog, SQLITE_FILE, Dependency
+from auto_data_table.log_operations import OperationLog
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS processes (
+    process_id TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    log TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tables (
+    table_name TEXT PRIMARY KEY,
+    allow_multiple INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (table_name, instance_id)
+);
+CREATE INDEX IF NOT EXISTS table_versions_time ON table_versions (table_name, time);
+CREATE TABLE IF NOT EXISTS column_versions (
+    table_name TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (table_name, instance_id, column_name)
+);
+CREATE INDEX IF NOT EXISTS column_versions_time ON column_versions (table_name, column_name, time);
+'''
+
+
+class SQLiteMetaDataStore(MetaDataStore):
+    """
+    MetaDataStore backed by <db>/metadata/metadata.db. Processes, table versions and column versions are
+    indexed rows, writers only hold the database for one short transaction and WAL mode lets readers run
+    next to them. Finished operations still go to the json lines OperationLog (metadata/log.txt).
+    """
+    def __init__(self, db_dir: str) -> None:
+        self.db_dir = db_dir
+        meta_dir = os.path.join(db_dir, 'metadata')
+        self.operation_log = OperationLog(meta_dir)
+        self.log_file = self.operation_log.log_file
+        self.sqlite_file = os.path.join(meta_dir, SQLITE_FILE)
+        self.local = threading.local()
+
+    @staticmethod
+    def setup(db_dir: str) -> None:
+        sqlite_file = os.path.join(db_dir, 'metadata', SQLITE_FILE)
+        conn = sqlite3.connect(sqlite_file, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        conn.close()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        conn = getattr(self.local, 'conn', None)
+        if conn == None:
+            conn = sqlite3.connect(self.sqlite_file, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator['SQLiteMetaDataStore']:
+        '''
+        Groups metadata updates into one sqlite write transaction. Log entries are appended to the
+        OperationLog once the transaction commits.
+        '''
+        if getattr(self.local, 'log_lines', None) != None:
+            yield self
+            return
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        self.local.log_lines = []
+        try:
+            yield self
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            if len(self.local.log_lines) > 0:
+                self.operation_log.append(self.local.log_lines)
+                self.operation_log.rotate_if_full()
+        finally:
+            self.local.log_lines = None
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        with self.transaction():
+            yield self._connection()
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        if getattr(self.local, 'log_lines', None) != None:
+            # reads inside a transaction see its uncommitted writes
+            yield conn
+            return
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('COMMIT')
+
+    def _get_process(self, conn: sqlite3.Connection, process_id: str) -> ProcessLog:
+        row = conn.execute('SELECT log FROM processes WHERE process_id = ?', (process_id,)).fetchone()
+        if row == None:
+            raise KeyError(process_id)
+        return ProcessLog.from_dict(json.loads(row[0]))
+
+    def _save_process(self, conn: sqlite3.Connection, log: ProcessLog) -> None:
+        conn.execute('INSERT OR REPLACE INTO processes (process_id, operation, table_name, log) VALUES (?, ?, ?, ?)',
+                     (log.process_id, log.operation, log.table_name, json.dumps(log.to_dict())))
+
+    def _get_processes(self, conn: sqlite3.Connection) -> dict[str, ProcessLog]:
+        rows = conn.execute('SELECT process_id, log FROM processes ORDER BY rowid').fetchall()
+        return {process_id: ProcessLog.from_dict(json.loads(log)) for process_id, log in rows}
+
+    def _write_log_entry(self, conn: sqlite3.Connection, log_entry: ProcessLog) -> None:
+        log_entry.complete_steps.append('write_log')
+        log_entry.step_times.append(time.time())
+        log_entry.log_time = time.time()
+        self.local.log_lines.append(json.dumps(asdict(log_entry)) + '\n')
+        conn.execute('DELETE FROM processes WHERE process_id = ?', (log_entry.process_id,))
+
+    def _setup_table_operation(self, conn: sqlite3.Connection, log: ProcessLog) -> None:
+        table_name = log.table_name
+        conn.execute('DELETE FROM table_versions WHERE table_name = ?', (table_name,))
+        conn.execute('DELETE FROM column_versions WHERE table_name = ?', (table_name,))
+        conn.execute('INSERT OR REPLACE INTO tables (table_name, allow_multiple) VALUES (?, ?)',
+                     (table_name, int(log.data['allow_multiple'])))
+
+    def _delete_table_operation(self, conn: sqlite3.Connection, log: ProcessLog) -> None:
+        table_name = log.table_name
+        conn.execute('DELETE FROM table_versions WHERE table_name = ?', (table_name,))
+        conn.execute('DELETE FROM column_versions WHERE table_name = ?', (table_name,))
+        conn.execute('DELETE FROM tables WHERE table_name = ?', (table_name,))
+
+    def _delete_instance_operation(self, conn: sqlite3.Connection, log: ProcessLog) -> None:
+        instance_id = log.data['instance_id']
+        table_name = log.table_name
+        conn.execute('DELETE FROM table_versions WHERE table_name = ? AND instance_id = ?', (table_name, instance_id))
+        conn.execute('DELETE FROM column_versions WHERE table_name = ? AND instance_id = ?', (table_name, instance_id))
+
+    def _execute_operation(self, conn: sqlite3.Connection, log: ProcessLog) -> None:
+        table_name = log.table_name
+        table_time = log.data['start_time']
+        instance_id = log.data['perm_instance_id']
+        # columns of prompts that recomputed no rows keep their version
+        changed_columns = [column for column in log.data['to_change_columns']
+                           if column not in log.data.get('unchanged_columns', [])]
+        gen_columns = log.data['gen_columns']
+        all_columns = log.data['all_columns']
+        prev_instance_id = log.data['origin']
+        conn.execute('INSERT OR REPLACE INTO table_versions (table_name, instance_id, time) VALUES (?, ?, ?)',
+                     (table_name, instance_id, table_time))
+        for column in all_columns:
+            if column in changed_columns or column in gen_columns:
+                column_time = table_time
+            else:
+                row = conn.execute('SELECT time FROM column_versions WHERE table_name = ? AND instance_id = ? AND column_name = ?',
+                                   (table_name, prev_instance_id, column)).fetchone()
+                if row == None:
+                    raise KeyError(f'No version for column {column} in {table_name}({prev_instance_id})')
+                column_time = row[0]
+            conn.execute('INSERT OR REPLACE INTO column_versions (table_name, instance_id, column_name, time) VALUES (?, ?, ?, ?)',
+                         (table_name, instance_id, column, column_time))
+
+    def write_to_log(self, process_id, success = True):
+        with self._write() as conn:
+            log = self._get_process(conn, process_id)
+            log.success = success
+            if log.operation == 'setup_table':
+                self._setup_table_operation(conn, log)
+            elif log.operation == 'setup_table_instance':
+                pass
+            elif log.operation == 'delete_table':
+                self._delete_table_operation(conn, log)
+            elif log.operation == 'delete_table_instance':
+                self._delete_instance_operation(conn, log)
+            elif log.operation == 'restart_database':
+                pass
+            elif log.operation == 'execute_table' and success:
+                self._execute_operation(conn, log)
+            else:
+                raise NotImplementedError()
+            self._write_log_entry(conn, log)
+
+    def start_new_process(self, author:str, operation: str, table_name:str, instance_id:str = '', start_time: Optional[float] = None, data:dict[str, Any] = {}) -> float:
+        process_id = str(uuid.uuid4())
+        if not start_time:
+            start_time = time.time()
+        log = ProcessLog(process_id, author, start_time, start_time, table_name, instance_id, [], operation, [], [], data, None,
+                         os.getpid(), socket.gethostname())
+        with self._write() as conn:
+            self._save_process(conn, log)
+        return process_id
+
+    def update_process_data(self, process_id:str, data:dict):
+        with self._write() as conn:
+            log = self._get_process(conn, process_id)
+            log.log_time = time.time()
+            log.data.update(data)
+            self._save_process(conn, log)
+
+    def update_process_step(self, process_id:str, step: str):
+        with self._write() as conn:
+            log = self._get_process(conn, process_id)
+            log.complete_steps.append(step)
+            log.step_times.append(time.time())
+            log.log_time = time.time()
+            self._save_process(conn, log)
+
+    def update_process_restart(self, author:str, process_id:str) -> ProcessLog:
+        with self._write() as conn:
+            log = self._get_process(conn, process_id)
+            log.restarts.append((author, time.time()))
+            log.log_time = time.time()
+            log.pid = os.getpid()
+            log.host = socket.gethostname()
+            self._save_process(conn, log)
+            return log
+
+    def get_all_tables(self) -> list[str]:
+        with self._read() as conn:
+            rows = conn.execute('SELECT table_name FROM tables').fetchall()
+        return [row[0] for row in rows]
+
+    def get_table_multiple(self, table_name:str):
+        with self._read() as conn:
+            row = conn.execute('SELECT allow_multiple FROM tables WHERE table_name = ?', (table_name,)).fetchone()
+        if row == None:
+            raise KeyError(table_name)
+        return bool(row[0])
+
+    def get_table_version_update(self, instance_id:str, table_name:str,
+                                 before_time: Optional[int] = None):
+        with self._read() as conn:
+            row = conn.execute('SELECT time FROM table_versions WHERE table_name = ? AND instance_id = ?',
+                               (table_name, instance_id)).fetchone()
+        if row == None:
+            raise KeyError(f'{table_name}({instance_id})')
+        vtime = row[0]
+        if before_time == None or vtime < before_time:
+            return vtime
+        else:
+            return 0
+
+    def get_column_version_update(self, column_name, instance_id:str, table_name:str,
+                                  before_time: Optional[int] = None):
+        with self._read() as conn:
+            row = conn.execute('SELECT time FROM column_versions WHERE table_name = ? AND instance_id = ? AND column_name = ?',
+                               (table_name, instance_id, column_name)).fetchone()
+        if row == None:
+            raise KeyError(f'{table_name}({instance_id}).{column_name}')
+        vtime = row[0]
+        if before_time == None or vtime < before_time:
+            return vtime
+        else:
+            return 0
+
+    def get_last_table_update(self, table_name:str, before_time: Optional[int] = None) -> Union[int, str]:
+        '''
+        Returns 0 when we didn't find any tables that meet conditions.
+        '''
+        with self._read() as conn:
+            if before_time == None:
+                row = conn.execute('SELECT time, instance_id FROM table_versions WHERE table_name = ? ORDER BY time DESC LIMIT 1',
+                                   (table_name,)).fetchone()
+            else:
+                row = conn.execute('SELECT time, instance_id FROM table_versions WHERE table_name = ? AND time < ? ORDER BY time DESC LIMIT 1',
+                                   (table_name, before_time)).fetchone()
+        if row == None:
+            return 0, 0
+        return row[0], row[1]
+
+    def get_last_column_update(self, table_name:str, column:str, before_time: Optional[int] = None) -> int:
+        '''
+        Returns 0 when we didn't find any tables that meet conditions.
+        '''
+        with self._read() as conn:
+            if before_time == None:
+                row = conn.execute('''SELECT time, instance_id FROM column_versions WHERE table_name = ? AND column_name = ?
+                                      ORDER BY time DESC, rowid DESC LIMIT 1''', (table_name, column)).fetchone()
+            else:
+                row = conn.execute('''SELECT time, instance_id FROM column_versions WHERE table_name = ? AND column_name = ? AND time < ?
+                                      ORDER BY time DESC, rowid DESC LIMIT 1''', (table_name, column, before_time)).fetchone()
+        if row == None:
+            return 0, 0
+        return row[0], row[1]
+
+    def get_dependency_versions(self, dependencies: list[Dependency],
+                                before_time: Optional[float] = None) -> list[tuple[bool, float, str]]:
+        results = []
+        with self._read() as conn:
+            for table, column, instance in dependencies:
+                row = conn.execute('SELECT allow_multiple FROM tables WHERE table_name = ?', (table,)).fetchone()
+                if row == None:
+                    raise KeyError(table)
+                allow_multiple = bool(row[0])
+                if instance != None:
+                    if column != None:
+                        row = conn.execute('SELECT time FROM column_versions WHERE table_name = ? AND instance_id = ? AND column_name = ?',
+                                           (table, instance, column)).fetchone()
+                    else:
+                        row = conn.execute('SELECT time FROM table_versions WHERE table_name = ? AND instance_id = ?',
+                                           (table, instance)).fetchone()
+                    if row == None:
+                        raise KeyError(f'{table}({instance})')
+                    vtime = row[0]
+                    if before_time != None and vtime >= before_time:
+                        vtime = 0
+                else:
+                    if column != None:
+                        query = 'SELECT time, instance_id FROM column_versions WHERE table_name = ? AND column_name = ?'
+                        params = [table, column]
+                    else:
+                        query = 'SELECT time, instance_id FROM table_versions WHERE table_name = ?'
+                        params = [table]
+                    if before_time != None:
+                        query += ' AND time < ?'
+                        params.append(before_time)
+                    row = conn.execute(query + ' ORDER BY time DESC, rowid DESC LIMIT 1', params).fetchone()
+                    vtime, instance = row if row != None else (0, 0)
+                results.append((allow_multiple, vtime, instance))
+        return results
+
+    def teminate_previous_restarts(self):
+        with self._write() as conn:
+            for log in self._get_processes(conn).values():
+                if log.operation == 'restart_database':
+                    log.success = False
+                    self._write_log_entry(conn, log)
+
+    def get_process_ids(self) -> list[tuple[str, str]]:
+        with self._read() as conn:
+            rows = conn.execute('SELECT process_id, operation FROM processes ORDER BY rowid').fetchall()
+        return [(process_id, operation) for process_id, operation in rows]
+
+    def get_active_processes(self) -> dict[str, ProcessLog]:
+        with self._read() as conn:
+            return self._get_processes(conn)
+
+    def print_active_logs(self) -> None:
+        with self._read() as conn:
+            pprint.pprint(self._get_processes(conn))
+
+    def write_to_log_after_restart(self):
+        with self._write() as conn:
+            for log in self._get_processes(conn).values():
+                if 'write_log' in log.complete_steps:
+                    self._write_log_entry(conn, log)
+
+
+def migrate_json_metadata(db_dir: str) -> None:
+    '''One shot migration of the json metadata files of a database to metadata.db.'''
+    meta_dir = os.path.join(db_dir, 'metadata')
+    if os.path.exists(os.path.join(meta_dir, SQLITE_FILE)):
+        raise FileExistsError('Metadata already migrated to sqlite')
+    json_store = MetaDataStore(db_dir)
+    with json_store.transaction():
+        active_logs = json_store._get_active_log()
+        table_history = json_store._get_table_history()
+        columns_history = json_store._get_column_history()
+        table_multiples = json_store._get_table_multiple()
+        temp_file = os.path.join(meta_dir, SQLITE_FILE + '.tmp')
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        conn = sqlite3.connect(temp_file, isolation_level=None)
+        conn.executescript(SCHEMA)
+        conn.execute('BEGIN')
+        for table_name, allow_multiple in table_multiples.items():
+            conn.execute('INSERT INTO tables (table_name, allow_multiple) VALUES (?, ?)', (table_name, int(allow_multiple)))
+        for table_name, instances in table_history.items():
+            for instance_id, t in instances.items():
+                conn.execute('INSERT INTO table_versions (table_name, instance_id, time) VALUES (?, ?, ?)',
+                             (table_name, instance_id, t))
+        for table_name, instances in columns_history.items():
+            for instance_id, columns in instances.items():
+                for column, t in columns.items():
+                    conn.execute('INSERT INTO column_versions (table_name, instance_id, column_name, time) VALUES (?, ?, ?, ?)',
+                                 (table_name, instance_id, column, t))
+        for process_id, log in active_logs.items():
+            conn.execute('INSERT INTO processes (process_id, operation, table_name, log) VALUES (?, ?, ?, ?)',
+                         (process_id, log.operation, log.table_name, json.dumps(log.to_dict())))
+        conn.execute('COMMIT')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        # the database only switches over once the sqlite file is complete
+        os.replace(temp_file, os.path.join(meta_dir, SQLITE_FILE))
@@ -0,0 +1,303 @@
+import os
+import shutil
+import json
+import hashlib
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Optional, Any
+import yaml
+
+DEFAULT_STORAGE = 'chunked'
+STORAGE_FILE = 'storage.yaml'
+CHUNK_DIR = 'chunks'
+CHUNK_GRACE_PERIOD = 3600 # seconds before an unreferenced chunk can be collected
+
+# Row filters are (column, op, value) tuples that are and-ed together (pyarrow's filter format)
+RowFilter = tuple[str, str, Any]
+
+
+def get_read_columns(columns: Optional[list[str]], filters: Optional[list[RowFilter]]) -> Optional[list[str]]:
+    '''Columns to read so the filters can be applied after the read.'''
+    if columns == None:
+        return None
+    read_columns = list(columns)
+    for column, _, _ in filters or []:
+        if column not in read_columns:
+            read_columns.append(column)
+    return read_columns
+
+
+def apply_filters(df: pd.DataFrame, filters: Optional[list[RowFilter]]) -> pd.DataFrame:
+    if not filters:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        if op == '==' or op == '=':
+            mask &= df[column] == value
+        elif op == '!=':
+            mask &= df[column] != value
+        elif op == '<':
+            mask &= df[column] < value
+        elif op == '<=':
+            mask &= df[column] <= value
+        elif op == '>':
+            mask &= df[column] > value
+        elif op == '>=':
+            mask &= df[column] >= value
+        elif op == 'in':
+            mask &= df[column].isin(value)
+        elif op == 'not in':
+            mask &= ~df[column].isin(value)
+        else:
+            raise ValueError(f'Filter operation not supported: {op}')
+    return df[mask].reset_index(drop=True)
+
+
+def _stringify_mixed_columns(df: pd.DataFrame) -> pd.DataFrame:
+    '''Arrow needs one type per column, mixed object columns are stored as text like the csv backend does.'''
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(lambda v: v if isinstance(v, str) else str(v), na_action='ignore')
+    return df
+
+
+class TableStorage:
+    """
+    Storage engine for the data of one table instance. Backends are chosen per table
+    at setup time and stored in <table>/storage.yaml.
+    """
+    name = ''
+    file_name = ''
+
+    def table_path(self, instance_dir: str) -> str:
+        return os.path.join(instance_dir, self.file_name)
+
+    def exists(self, instance_dir: str) -> bool:
+        return os.path.exists(self.table_path(instance_dir))
+
+    def read(self, instance_dir: str, rows: Optional[int] = None, columns: Optional[list[str]] = None,
+             filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
+        raise NotImplementedError()
+
+    def write(self, df: pd.DataFrame, instance_dir: str) -> None:
+        raise NotImplementedError()
+
+    def copy(self, prev_instance_dir: str, instance_dir: str) -> None:
+        shutil.copy2(self.table_path(prev_instance_dir), self.table_path(instance_dir))
+
+    def collect_garbage(self, table_dir: str) -> None:
+        '''Called after an instance of the table is deleted.'''
+        pass
+
+
+class CSVStorage(TableStorage):
+    '''Legacy backend: dtypes are re-inferred on every read.'''
+    name = 'csv'
+    file_name = 'table.csv'
+
+    def read(self, instance_dir: str, rows: Optional[int] = None, columns: Optional[list[str]] = None,
+             filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
+        try:
+            df = pd.read_csv(self.table_path(instance_dir), nrows=rows,
+                             usecols=get_read_columns(columns, filters))
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+        df = apply_filters(df, filters)
+        if columns != None:
+            df = df[columns]
+        return df
+
+    def write(self, df: pd.DataFrame, instance_dir: str) -> None:
+        df.to_csv(self.table_path(instance_dir), index=False)
+
+
+class ParquetStorage(TableStorage):
+    name = 'parquet'
+    file_name = 'table.parquet'
+
+    def read(self, instance_dir: str, rows: Optional[int] = None, columns: Optional[list[str]] = None,
+             filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
+        # pyarrow pushes both the projection and the filters down to the row groups
+        df = pd.read_parquet(self.table_path(instance_dir), columns=columns,
+                             filters=[tuple(f) for f in filters] if filters else None)
+        if rows != None:
+            df = df.head(rows)
+        return df
+
+    def write(self, df: pd.DataFrame, instance_dir: str) -> None:
+        try:
+            df.to_parquet(self.table_path(instance_dir), index=False, compression='zstd')
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            _stringify_mixed_columns(df).to_parquet(self.table_path(instance_dir), index=False, compression='zstd')
+
+
+class ArrowStorage(TableStorage):
+    '''Arrow IPC (feather v2) files: cheapest to read back, lz4 compressed.'''
+    name = 'arrow'
+    file_name = 'table.arrow'
+
+    def read(self, instance_dir: str, rows: Optional[int] = None, columns: Optional[list[str]] = None,
+             filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
+        df = pd.read_feather(self.table_path(instance_dir), columns=get_read_columns(columns, filters))
+        df = apply_filters(df, filters)
+        if columns != None:
+            df = df[columns]
+        if rows != None:
+            df = df.head(rows)
+        return df
+
+    def write(self, df: pd.DataFrame, instance_dir: str) -> None:
+        df = df.reset_index(drop=True)
+        try:
+            df.to_feather(self.table_path(instance_dir), compression='lz4')
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            _stringify_mixed_columns(df).to_feather(self.table_path(instance_dir), compression='lz4')
+
+
+class ChunkedStorage(TableStorage):
+    """
+    Every column is stored once per table as a content addressed parquet chunk (<table>/chunks/<hash>.parquet)
+    and an instance is a manifest of column hashes. Copying an instance copies only the manifest, and a write
+    only creates chunks for columns whose content changed.
+    """
+    name = 'chunked'
+    file_name = 'manifest.json'
+
+    def _chunk_dir(self, instance_dir: str) -> str:
+        return os.path.join(os.path.dirname(os.path.normpath(instance_dir)), CHUNK_DIR)
+
+    def _read_manifest(self, instance_dir: str) -> dict[str, Any]:
+        with open(self.table_path(instance_dir), 'r') as file:
+            return json.load(file)
+
+    def _read_chunk(self, chunk_dir: str, chunk: str, column: str) -> pd.Series:
+        series = pd.read_parquet(os.path.join(chunk_dir, chunk + '.parquet'))['value']
+        series.name = column
+        return series
+
+    def read(self, instance_dir: str, rows: Optional[int] = None, columns: Optional[list[str]] = None,
+             filters: Optional[list[RowFilter]] = None) -> pd.DataFrame:
+        manifest = self._read_manifest(instance_dir)
+        chunk_dir = self._chunk_dir(instance_dir)
+        read_columns = get_read_columns(columns, filters)
+        if read_columns == None:
+            read_columns = manifest['columns']
+        data = {column: self._read_chunk(chunk_dir, manifest['chunks'][column], column) for column in read_columns}
+        df = pd.DataFrame(data, index=pd.RangeIndex(manifest['n_rows']), columns=read_columns)
+        df = apply_filters(df, filters)
+        if columns != None:
+            df = df[columns]
+        if rows != None:
+            df = df.head(rows)
+        return df
+
+    def _column_table(self, series: pd.Series) -> pa.Table:
+        frame = series.reset_index(drop=True).to_frame('value')
+        try:
+            return pa.Table.from_pandas(frame, preserve_index=False)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            return pa.Table.from_pandas(_stringify_mixed_columns(frame), preserve_index=False)
+
+    def _hash_table(self, table: pa.Table) -> str:
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return hashlib.sha256(sink.getvalue()).hexdigest()
+
+    def _referenced_chunks(self, table_dir: str, skip_instance: Optional[str] = None) -> set[str]:
+        used = set()
+        for item in os.listdir(table_dir):
+            manifest_path = os.path.join(table_dir, item, self.file_name)
+            if item != skip_instance and os.path.isfile(manifest_path):
+                with open(manifest_path, 'r') as file:
+                    used.update(json.load(file)['chunks'].values())
+        return used
+
+    def _drop_superseded(self, instance_dir: str, chunks: dict[str, str]) -> None:
+        '''
+        Rewrites of an in progress instance (e.g. delta compactions) would otherwise leave one dead chunk
+        per rewrite. Chunks touched since the old manifest was written may be reused by another writer.
+        '''
+        manifest_path = self.table_path(instance_dir)
+        if not os.path.exists(manifest_path):
+            return
+        written = os.path.getmtime(manifest_path)
+        old_chunks = set(self._read_manifest(instance_dir)['chunks'].values()) - set(chunks.values())
+        if len(old_chunks) == 0:
+            return
+        instance_dir = os.path.normpath(instance_dir)
+        used = self._referenced_chunks(os.path.dirname(instance_dir), os.path.basename(instance_dir))
+        chunk_dir = self._chunk_dir(instance_dir)
+        for chunk in old_chunks - used:
+            chunk_path = os.path.join(chunk_dir, chunk + '.parquet')
+            if os.path.exists(chunk_path) and os.path.getmtime(chunk_path) <= written:
+                os.remove(chunk_path)
+
+    def write(self, df: pd.DataFrame, instance_dir: str) -> None:
+        chunk_dir = self._chunk_dir(instance_dir)
+        os.makedirs(chunk_dir, exist_ok=True)
+        chunks = {}
+        for column in df.columns:
+            table = self._column_table(df[column])
+            chunk = self._hash_table(table)
+            chunk_path = os.path.join(chunk_dir, chunk + '.parquet')
+            if os.path.exists(chunk_path):
+                # refresh so a concurrent collect_garbage leaves it alone
+                os.utime(chunk_path)
+            else:
+                temp_path = chunk_path + '.' + str(os.getpid()) + '.tmp'
+                pq.write_table(table, temp_path, compression='zstd')
+                os.replace(temp_path, chunk_path)
+            chunks[column] = chunk
+        self._drop_superseded(instance_dir, chunks)
+        manifest = {'columns': list(df.columns), 'chunks': chunks, 'n_rows': len(df)}
+        manifest_path = self.table_path(instance_dir)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def collect_garbage(self, table_dir: str) -> None:
+        chunk_dir = os.path.join(table_dir, CHUNK_DIR)
+        if not os.path.isdir(chunk_dir):
+            return
+        used = self._referenced_chunks(table_dir)
+        now = time.time()
+        for item in os.listdir(chunk_dir):
+            chunk_path = os.path.join(chunk_dir, item)
+            if item.split('.')[0] in used or now - os.path.getmtime(chunk_path) < CHUNK_GRACE_PERIOD:
+                continue
+            os.remove(chunk_path)
+
+
+STORAGE_BACKENDS = {
+    'csv': CSVStorage,
+    'parquet': ParquetStorage,
+    'arrow': ArrowStorage,
+    'chunked': ChunkedStorage,
+}
+
+
+def get_storage(storage: str) -> TableStorage:
+    if storage not in STORAGE_BACKENDS:
+        raise ValueError(f'Storage backend not supported: {storage}')
+    return STORAGE_BACKENDS[storage]()
+
+
+def setup_table_storage(table_name: str, db_dir: str, storage: str = DEFAULT_STORAGE) -> None:
+    get_storage(storage)
+    storage_path = os.path.join(db_dir, table_name, STORAGE_FILE)
+    with open(storage_path, 'w') as file:
+        yaml.safe_dump({'storage': storage}, file)
+
+
+def get_table_storage(table_name: str, db_dir: str) -> TableStorage:
+    '''Tables created before storage backends existed have no storage.yaml and stay on csv.'''
+    storage_path = os.path.join(db_dir, table_name, STORAGE_FILE)
+    if not os.path.exists(storage_path):
+        return CSVStorage()
+    with open(storage_path, 'r') as file:
+        config = yaml.safe_load(file)
+    return get_storage(config['storage'])
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from typing import Optional, Hashable
+import threading
+import pandas as pd
+
+from auto_data_table import file_operations
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3 # bytes
+
+TableCacheKey = tuple[str, str, Optional[tuple[str, ...]], Optional[Hashable]]
+
+
+def _filter_key(filters: Optional[list]) -> Optional[tuple]:
+    if not filters:
+        return None
+    return tuple((column, op, tuple(value) if isinstance(value, list) else value)
+                 for column, op, value in filters)
+
+
+class TableCache:
+    """
+    Dependency tables loaded during one execute_table run, keyed by (table, instance_id, columns, filters).
+    Frames are shared between prompts and should be treated as read only. The least recently used
+    frames are evicted once the cached frames use more than memory_budget bytes.
+    """
+    def __init__(self, db_dir: str, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.db_dir = db_dir
+        self.memory_budget = memory_budget
+        self.tables: OrderedDict[TableCacheKey, pd.DataFrame] = OrderedDict()
+        self.sizes: dict[TableCacheKey, int] = {}
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _lookup(self, key: TableCacheKey) -> Optional[pd.DataFrame]:
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        # a projection can be served from the full table when that is already loaded, it is cached as well so
+        # the same frame (and the key indexes built on it) is returned next time
+        table_name, instance_id, columns, filters = key
+        full_key = (table_name, instance_id, None, filters)
+        if columns != None and full_key in self.tables:
+            self.tables.move_to_end(full_key)
+            df = self.tables[full_key][list(columns)]
+            self._insert(key, df)
+            return df
+        return None
+
+    def _insert(self, key: TableCacheKey, df: pd.DataFrame) -> None:
+        if key in self.tables:
+            return
+        size = int(df.memory_usage(deep=True).sum())
+        self.tables[key] = df
+        self.sizes[key] = size
+        self.total_size += size
+        while self.total_size > self.memory_budget and len(self.tables) > 1:
+            old_key, _ = self.tables.popitem(last=False)
+            self.total_size -= self.sizes.pop(old_key)
+
+    def get_table(self, instance_id: str, table_name: str, columns: Optional[list[str]] = None,
+                  filters: Optional[list] = None) -> pd.DataFrame:
+        key = (table_name, instance_id, tuple(columns) if columns != None else None, _filter_key(filters))
+        with self.lock:
+            df = self._lookup(key)
+            if df is not None:
+                self.hits += 1
+                return df
+            self.misses += 1
+        df = file_operations.get_table(instance_id, table_name, self.db_dir, columns=columns, filters=filters)
+        with self.lock:
+            self._insert(key, df)
+        return df
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tables.clear()
+            self.sizes.clear()
+            self.total_size = 0
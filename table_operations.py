@@ -1,99 +1,249 @@
 
-from typing import Optional
+from typing import Optional, Callable
 import time
-from auto_data_table.meta_operations import MetaDataStore
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from auto_data_table.meta_operations import MetaDataStore, get_metadata_store
 from auto_data_table import file_operations
 from auto_data_table.prompt_execution import prompt_parser
+from auto_data_table.prompt_execution import fingerprints
 from auto_data_table.prompt_execution.parse_code import execute_code_from_prompt, execute_gen_table_from_prompt
 from auto_data_table.prompt_execution.parse_llm import execute_llm_from_prompt
-from auto_data_table.database_lock import DatabaseLock
+from auto_data_table.database_lock import DatabaseLock, process_alive
+from auto_data_table.snapshot_operations import InstanceSnapshot, retire_instance, is_retirement_pending, reap_retired_instances
+from auto_data_table.storage_operations import DEFAULT_STORAGE
+from auto_data_table.table_cache import TableCache, DEFAULT_MEMORY_BUDGET
 import pandas as pd
 import random
 import string
 
-def _update_table_columns(to_change_columns: list, all_columns:list, instance_id: str, table_name: str, db_dir: str) -> list[str]:
+DEFAULT_THREAD_BUDGET = 16 # threads shared by the prompts of a table that run at the same time
+
+def _update_table_columns(to_change_columns: list, all_columns:list, instance_id: str, table_name: str, db_dir: str,
+                          incremental_columns: list = []) -> pd.DataFrame:
+    '''incremental_columns change but are cleared by row when their prompt runs.'''
     df = file_operations.get_table(instance_id, table_name, db_dir)
     columns = list(dict.fromkeys(df.columns).keys()) + [col for col in all_columns if col not in df.columns]
     for col in columns:
         if col not in all_columns:
-            df.drop(col, axis=1)
+            df = df.drop(col, axis=1)
         elif len(df) == 0:
             df[col] = []
-        elif col in to_change_columns or col not in df.columns:
+        elif (col in to_change_columns and col not in incremental_columns) or col not in df.columns:
             df[col] = pd.NA
     file_operations.write_table(df, instance_id, table_name, db_dir) 
+    return df
 
 def _fetch_table_cache(external_dependencies:list, db_metadata:MetaDataStore, instance_id:str, table_name:str, db_dir:str,
-                       start_time:float) -> prompt_parser.Cache:
+                       start_time:float, columns: dict[prompt_parser.CacheKey, Optional[list[str]]] = {},
+                       filters: dict[str, list] = {}, table_cache: Optional[TableCache] = None,
+                       self_df: Optional[pd.DataFrame] = None) -> prompt_parser.Cache:
     cache = {}
-    cache['self'] = file_operations.get_table(instance_id, table_name, db_dir)
+    if self_df is not None:
+        cache['self'] = self_df
+    else:
+        cache['self'] = file_operations.get_table(instance_id, table_name, db_dir)
 
     for dep in external_dependencies:
-        table, _, _,instance, latest = dep
+        table, _, instance, _, latest = dep
         if latest:
             #instance = db_metadata.get_last_table_update(table, before_time=start_time)
-            cache[table] = file_operations.get_table(instance, table, db_dir)
+            key = table
         else:
-            cache[(table, instance)] = file_operations.get_table(instance, table, db_dir)
+            key = (table, instance)
+        if key in cache:
+            continue
+        if table_cache != None:
+            cache[key] = table_cache.get_table(instance, table, columns=columns.get(key), filters=filters.get(table))
+        else:
+            cache[key] = file_operations.get_table(instance, table, db_dir, columns=columns.get(key),
+                                                   filters=filters.get(table))
     return cache
     
-def execute_table(table_name: str, db_dir: str, author: str, instance_id: str = 'TEMP'):
-    instance_lock = DatabaseLock(db_dir, table_name, instance_id)
-    instance_lock.acquire_exclusive_lock()
-    prompts = file_operations.get_prompts(instance_id, table_name, db_dir)
-    #print(prompts)
-    #raise ValueError()
-    if 'origin' in prompts['description']:
-        origin = prompts['description']
+def _acquire_snapshots(external_deps: dict[str, list], db_dir: str) -> list[InstanceSnapshot]:
+    '''Dependencies are materialized instances, they are read without locks.'''
+    snapshots = {}
+    try:
+        for pname in external_deps:
+            for table, _, instance, _, _ in external_deps[pname]:
+                if (table, instance) in snapshots:
+                    continue
+                snapshot = InstanceSnapshot(db_dir, table, instance)
+                snapshot.acquire()
+                snapshots[(table, instance)] = snapshot
+    except Exception as e:
+        for snapshot in snapshots.values():
+            snapshot.release()
+        raise e
+    return list(snapshots.values())
+    
+def _execute_prompt(pname: str, prompt: prompt_parser.Prompt, external_deps: list, db_metadata: MetaDataStore,
+                    instance_id: str, table_name: str, db_dir: str, start_time: float, table_cache: TableCache,
+                    self_df: Optional[pd.DataFrame], write_lock: Optional[threading.RLock] = None,
+                    is_generator: bool = False, key_columns: list[str] = [], done_rows: list[list[int]] = [],
+                    record_checkpoint: Optional[Callable[[list[list[int]]], None]] = None,
+                    record_unchanged: Optional[Callable[[], None]] = None) -> pd.DataFrame:
+    '''
+    done_rows are the row ranges of the checkpoints of an interrupted execution of the prompt. record_unchanged
+    is called if no row's fingerprint changed, the prompt's columns then keep the version of the origin.
+    '''
+    dep_columns = prompt_parser.get_dependency_columns(prompt, external_deps)
+    cache = _fetch_table_cache(external_deps, db_metadata, instance_id, table_name, db_dir, start_time,
+                               dep_columns, prompt.get('filters', {}), table_cache, self_df)
+    if is_generator:
+        return execute_gen_table_from_prompt(prompt, cache, instance_id, table_name, db_dir)
+    if write_lock == None:
+        write_lock = threading.RLock()
+    checkpoint = None
+    if prompt['type'] == 'code' and prompt['is_udf']:
+        interval = prompt.get('checkpoint_interval', file_operations.DEFAULT_CHECKPOINT_INTERVAL)
+        checkpoint = file_operations.RowCheckpoint(cache['self'], instance_id, table_name, db_dir, done_rows,
+                                                   interval, write_lock, record_checkpoint)
+    with write_lock:
+        # rows whose inputs are unchanged since the instance this one was derived from keep their values
+        row_fingerprints = fingerprints.get_row_fingerprints(prompt, cache, key_columns)
+        prev_fingerprints = fingerprints.load_fingerprints(pname, instance_id, table_name, db_dir)
+        n_changed = None
+        if prev_fingerprints != None:
+            n_changed = fingerprints.clear_changed_rows(cache['self'], prompt['parsed_changed_columns'], key_columns,
+                                                        row_fingerprints, prev_fingerprints,
+                                                        checkpoint.done if checkpoint != None else set())
+    if n_changed == 0 and record_unchanged != None:
+        record_unchanged()
+    if prompt['type'] == 'code':
+        self_df = execute_code_from_prompt(prompt, cache, instance_id, table_name, db_dir, write_lock, checkpoint)
+    elif prompt['type'] == 'llm':
+        self_df = execute_llm_from_prompt(prompt, cache, instance_id, table_name, db_dir, write_lock)
     else:
-        origin = None
-    db_metadata = MetaDataStore(db_dir)
-    start_time = time.time()
-    top_pnames, to_change_columns, all_columns, internal_prompt_deps, external_deps = prompt_parser.parse_prompts(prompts, db_metadata , start_time,  table_name, db_dir)
-    # print(top_pnames)
-    # print(to_change_columns)
-    # print(all_columns)
-    # raise ValueError()
-    # execute prompts
-    dep_locks = []
-    for pname in external_deps:
-        for table, _, instance, _,_ in external_deps[pname]:
-            lock = DatabaseLock(db_dir, table_name=table, instance_id=instance)
-            lock.acquire_shared_lock()
-            dep_locks.append(lock)
+        self_df = cache['self']
+    fingerprints.save_fingerprints(row_fingerprints, pname, instance_id, table_name, db_dir)
+    return self_df
 
-    data = {'origin': origin,
-            'top_pnames': top_pnames, 'to_change_columns': to_change_columns, 'start_time': start_time,
-            'all_columns': all_columns, 'internal_prompt_deps': internal_prompt_deps, 'external_deps': external_deps,
-            'gen_columns': prompts[top_pnames[0]]['parsed_changed_columns']}
-    process_id = db_metadata.start_new_process(author, 'execute_table', table_name, instance_id, start_time, data = data)
-   # raise ValueError()
-    _update_table_columns(to_change_columns,all_columns, instance_id, table_name, db_dir) 
-    db_metadata.update_process_step(process_id, 'clear_table')
-    for i, pname in enumerate(top_pnames):
-        prompt = prompt_parser.convert_reference(prompts[pname])
-        cache = _fetch_table_cache(external_deps[pname], db_metadata, instance_id, table_name, db_dir, start_time)
-        if i == 0:
-            execute_gen_table_from_prompt(prompt, cache, instance_id, table_name, db_dir) 
+def _execute_prompts(prompts: dict[str, prompt_parser.Prompt], top_pnames: list[str], prompt_deps: dict[str, list[str]],
+                     complete_steps: list[str], external_deps: dict[str, list], db_metadata: MetaDataStore,
+                     process_id: str, instance_id: str, table_name: str, db_dir: str, start_time: float,
+                     table_cache: TableCache, self_df: Optional[pd.DataFrame], thread_budget: int,
+                     checkpoints: dict[str, list[list[int]]] = {}, unchanged_columns: list[str] = []) -> pd.DataFrame:
+    '''
+    Runs the generator, then every prompt as soon as the prompts it depends on are done. Running prompts share
+    thread_budget threads (a prompt takes its n_threads) and one lock for writes to the table. Steps are
+    recorded from this thread as prompts finish, so a restart skips exactly the finished prompts, and the
+    rows a running UDF finished are checkpointed to checkpoint_<pname>, so a restart skips those rows too.
+    Columns of prompts that recomputed no rows are recorded in unchanged_columns.
+    '''
+    # the running prompts and this thread update the same process record
+    log_lock = threading.Lock()
+    def record_checkpoint(pname: str, ranges: list[list[int]]) -> None:
+        with log_lock:
+            db_metadata.update_process_data(process_id, {f'checkpoint_{pname}': ranges})
+    unchanged_columns = list(unchanged_columns)
+    def record_unchanged(pname: str) -> None:
+        with log_lock:
+            unchanged_columns.extend(col for col in prompts[pname]['parsed_changed_columns']
+                                     if col not in unchanged_columns)
+            db_metadata.update_process_data(process_id, {'unchanged_columns': list(unchanged_columns)})
+
+    gen_pname = top_pnames[0]
+    if gen_pname not in complete_steps:
+        self_df = _execute_prompt(gen_pname, prompts[gen_pname], external_deps[gen_pname], db_metadata, instance_id,
+                                  table_name, db_dir, start_time, table_cache, self_df, is_generator=True)
+        db_metadata.update_process_step(process_id, gen_pname)
+    if self_df is None:
+        # all prompts have to update the same frame
+        self_df = file_operations.get_table(instance_id, table_name, db_dir)
+    write_lock = threading.RLock()
+    done = set(complete_steps) | {gen_pname}
+    pending = [pname for pname in top_pnames[1:] if pname not in done]
+    running = {}
+    used_threads = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=max(thread_budget, 1)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for pname in list(pending):
+                if error != None:
+                    break
+                if any(dep not in done for dep in prompt_deps.get(pname, [])):
+                    continue
+                # an async engine runs its requests in one thread
+                n_threads = 1 if prompts[pname].get('engine') == 'async' else prompts[pname].get('n_threads', 1)
+                n_threads = min(n_threads, thread_budget)
+                if len(running) > 0 and used_threads + n_threads > thread_budget:
+                    continue
+                pending.remove(pname)
+                future = executor.submit(_execute_prompt, pname, prompts[pname], external_deps[pname], db_metadata,
+                                         instance_id, table_name, db_dir, start_time, table_cache, self_df, write_lock,
+                                         key_columns=prompts[gen_pname]['parsed_changed_columns'],
+                                         done_rows=checkpoints.get(pname, []),
+                                         record_checkpoint=functools.partial(record_checkpoint, pname),
+                                         record_unchanged=functools.partial(record_unchanged, pname))
+                running[future] = (pname, n_threads)
+                used_threads += n_threads
+            if len(running) == 0:
+                if error != None:
+                    raise error
+                raise ValueError(f'Prompts {pending} depend on prompts that are not executed.')
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pname, n_threads = running.pop(future)
+                used_threads -= n_threads
+                if future.exception() != None:
+                    # let the running prompts finish, nothing new is started
+                    error = error or future.exception()
+                    continue
+                done.add(pname)
+                with log_lock:
+                    db_metadata.update_process_step(process_id, pname)
+            if error != None and len(running) == 0:
+                raise error
+    return self_df
+
+def execute_table(table_name: str, db_dir: str, author: str, instance_id: str = 'TEMP',
+                  cache_budget: int = DEFAULT_MEMORY_BUDGET, thread_budget: int = DEFAULT_THREAD_BUDGET):
+    instance_lock = DatabaseLock(db_dir, table_name, instance_id)
+    instance_lock.acquire_exclusive_lock()
+    # a failed execution keeps its process record for restart_execute_table, but not the lock and snapshots
+    snapshots = []
+    try:
+        prompts = file_operations.get_prompts(instance_id, table_name, db_dir)
+        if 'origin' in prompts['description']:
+            origin = prompts['description']['origin']
         else:
-            if prompt['type'] == 'code':
-                execute_code_from_prompt(prompt, cache, instance_id, table_name, db_dir)
-            elif prompt['type'] == 'llm':
-                execute_llm_from_prompt(prompt, cache, instance_id, table_name, db_dir)
-        db_metadata.update_process_step(process_id, pname)
-        #raise ValueError()
-    rand_str = ''.join(random.choices(string.ascii_letters, k=5))
-    perm_instance_id = str(int(time.time())) + rand_str
-    db_metadata.update_process_data(process_id, {'perm_instance_id': perm_instance_id})
-    file_operations.materialize_table(perm_instance_id, instance_id, table_name, db_dir)
-    db_metadata.write_to_log(process_id)
-    instance_lock.release_exclusive_lock()
-    for lock in dep_locks:
-        lock.release_shared_lock()
+            origin = None
+        db_metadata = get_metadata_store(db_dir)
+        start_time = time.time()
+        top_pnames, to_change_columns, incremental_columns, all_columns, internal_prompt_deps, external_deps = prompt_parser.parse_prompts(prompts, db_metadata , start_time,  table_name, db_dir)
+        # execute prompts
+        snapshots.extend(_acquire_snapshots(external_deps, db_dir))
+        prompt_deps = prompt_parser.get_prompt_dependencies(prompts, top_pnames, internal_prompt_deps)
+
+        data = {'origin': origin,
+                'top_pnames': top_pnames, 'to_change_columns': to_change_columns, 'start_time': start_time,
+                'incremental_columns': incremental_columns,
+                'all_columns': all_columns, 'internal_prompt_deps': internal_prompt_deps, 'external_deps': external_deps,
+                'gen_columns': prompts[top_pnames[0]]['parsed_changed_columns'], 'lock_waits': instance_lock.wait_times(),
+                'prompt_deps': prompt_deps}
+        process_id = db_metadata.start_new_process(author, 'execute_table', table_name, instance_id, start_time, data = data)
+        compiled_prompts = prompt_parser.compile_prompts(instance_id, table_name, db_dir)
+        self_df = _update_table_columns(to_change_columns,all_columns, instance_id, table_name, db_dir, incremental_columns) 
+        db_metadata.update_process_step(process_id, 'clear_table')
+        table_cache = TableCache(db_dir, cache_budget)
+        self_df = _execute_prompts(compiled_prompts, top_pnames, prompt_deps, [], external_deps, db_metadata, process_id,
+                                   instance_id, table_name, db_dir, start_time, table_cache, self_df, thread_budget)
+        table_cache.clear()
+        rand_str = ''.join(random.choices(string.ascii_letters, k=5))
+        perm_instance_id = str(int(time.time())) + rand_str
+        db_metadata.update_process_data(process_id, {'perm_instance_id': perm_instance_id})
+        file_operations.materialize_table(perm_instance_id, instance_id, table_name, db_dir)
+        db_metadata.write_to_log(process_id)
+    finally:
+        instance_lock.release_exclusive_lock()
+        for snapshot in snapshots:
+            snapshot.release()
 
 
-def restart_execute_table(author:str, process_id:str, db_dir:str): #TODO also allow clearing??
-    db_metadata = MetaDataStore(db_dir)
+def restart_execute_table(author:str, process_id:str, db_dir:str, thread_budget: int = DEFAULT_THREAD_BUDGET): #TODO also allow clearing??
+    db_metadata = get_metadata_store(db_dir)
     process = db_metadata.update_process_restart(author, process_id)
     try: 
         table_name = process.table_name
@@ -105,6 +255,12 @@ def restart_execute_table(author:str, process_id:str, db_dir:str): #TODO also al
         instance_id = process.instance_id
         start_time = process.data['start_time']
         origin = process.data['origin']
+        # processes started before prompts ran in parallel run in order
+        prompt_deps = process.data.get('prompt_deps', {pname: top_pnames[:i] for i, pname in enumerate(top_pnames)})
+        checkpoints = {pname: process.data[f'checkpoint_{pname}'] for pname in top_pnames
+                       if f'checkpoint_{pname}' in process.data}
+        incremental_columns = process.data.get('incremental_columns', [])
+        unchanged_columns = process.data.get('unchanged_columns', [])
     except Exception as e:
         print(process)
         db_metadata.write_to_log(process_id, success=False)
@@ -118,55 +274,48 @@ def restart_execute_table(author:str, process_id:str, db_dir:str): #TODO also al
 
     #instance_lock = DatabaseLock(table_name, db_dir, instance_id)
     #instance_lock.acquire_exclusive_lock()
-    prompts = file_operations.get_prompts(instance_id, table_name, db_dir)
-    # dep_locks = []
-    # for table, _, instance, _,_ in external_deps:
-    #     lock = DatabaseLock(db_dir, table_name=table, instance_id=instance)
-    #     lock.acquire_shared_lock()
-    #     dep_locks.append(lock)
+    compiled_prompts = prompt_parser.compile_prompts(instance_id, table_name, db_dir)
+    snapshots = _acquire_snapshots(external_deps, db_dir)
+    try:
+        self_df = None
+        if not 'clear_table' in process.complete_steps:
+            self_df = _update_table_columns(to_change_columns,all_columns, instance_id, table_name, db_dir,
+                                            incremental_columns) 
+            db_metadata.update_process_step(process_id, 'clear_table')
 
-    if not 'clear_table' in process.complete_steps:
-        _update_table_columns(to_change_columns,all_columns, instance_id, table_name, db_dir) 
-        db_metadata.update_process_step(process_id, 'clear_table')
-    
-    for i, pname in enumerate(top_pnames):
-        if pname in process.complete_steps:
-            continue
-        prompt = prompt_parser.convert_reference(prompts[pname])
-        cache = _fetch_table_cache(external_deps[pname], db_metadata, instance_id, table_name, db_dir, start_time)
-        if i == 0:
-            execute_gen_table_from_prompt(prompt, cache, instance_id, table_name, db_dir, start_time) 
+        table_cache = TableCache(db_dir)
+        self_df = _execute_prompts(compiled_prompts, top_pnames, prompt_deps, process.complete_steps, external_deps,
+                                   db_metadata, process_id, instance_id, table_name, db_dir, start_time, table_cache,
+                                   self_df, thread_budget, checkpoints, unchanged_columns)
+        table_cache.clear()
+
+        if 'perm_instance_id' in process.data:
+            perm_instance_id = process.data['perm_instance_id']
         else:
-            if prompt['type'] == 'code':
-                execute_code_from_prompt(prompt, cache, instance_id, table_name, db_dir)
-            elif prompt['type'] == 'llm':
-                execute_llm_from_prompt(prompt, cache, instance_id, table_name, db_dir)
-        db_metadata.update_process_step(process_id, pname)
-    
-    if 'instance_id' in process.data:
-        perm_instance_id = process.data['perm_instance_id']
-    else:
-        rand_str = ''.join(random.choices(string.ascii_letters, k=5))
-        perm_instance_id = str(int(time.time())) + rand_str
-        db_metadata.update_process_data(process_id, {'instance_id': perm_instance_id})
-    file_operations.materialize_table(perm_instance_id, instance_id, table_name, db_dir)
-    db_metadata.write_to_log(process_id)
+            rand_str = ''.join(random.choices(string.ascii_letters, k=5))
+            perm_instance_id = str(int(time.time())) + rand_str
+            db_metadata.update_process_data(process_id, {'perm_instance_id': perm_instance_id})
+        file_operations.materialize_table(perm_instance_id, instance_id, table_name, db_dir)
+        db_metadata.write_to_log(process_id)
+    finally:
+        for snapshot in snapshots:
+            snapshot.release()
     # instance_lock.release_exclusive_lock()
     # for lock in dep_locks:
     #     lock.release_shared_lock()
 
 def delete_table(table_name: str, db_dir: str, author: str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     lock = DatabaseLock(db_dir, table_name)
     lock.acquire_exclusive_lock()
-    operation = 'delete_table_instance'
-    process_id = db_metadata.start_new_process(author, operation, table_name)
-    file_operations.delete_table(table_name, db_dir)
+    operation = 'delete_table'
+    process_id = db_metadata.start_new_process(author, operation, table_name, data={'lock_waits': lock.wait_times()})
+    retire_instance(db_dir, table_name)
     db_metadata.write_to_log(process_id)
     lock.release_exclusive_lock()
 
 def restart_delete_table(author:str, process_id:str, db_dir:str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     process = db_metadata.update_process_restart(author, process_id)
     try:
         table_name = process.table_name
@@ -177,22 +326,23 @@ def restart_delete_table(author:str, process_id:str, db_dir:str):
         raise e
     #lock = DatabaseLock(db_dir, table_name)
     #lock.acquire_exclusive_lock()
-    file_operations.delete_table(table_name, db_dir)
+    retire_instance(db_dir, table_name)
     db_metadata.write_to_log(process_id)
     #lock.release_exclusive_lock()
 
 def delete_table_instance(instance_id: str, table_name: str, db_dir: str, author: str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     operation = 'delete_table_instance'
     lock = DatabaseLock(db_dir, table_name, instance_id)
     lock.acquire_exclusive_lock()
-    process_id = db_metadata.start_new_process(author, operation, table_name, instance_id)
-    file_operations.delete_table(table_name, db_dir, instance_id)
+    process_id = db_metadata.start_new_process(author, operation, table_name, instance_id, data={'instance_id': instance_id, 'lock_waits': lock.wait_times()})
+    # readers of the instance keep their snapshot, the files go once the last one is done
+    retire_instance(db_dir, table_name, instance_id)
     db_metadata.write_to_log(process_id)
     lock.release_exclusive_lock()
 
 def restart_delete_table_instance(author:str, process_id:str, db_dir:str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     process = db_metadata.update_process_restart(author, process_id)
     try:
         table_name = process.table_name
@@ -204,7 +354,7 @@ def restart_delete_table_instance(author:str, process_id:str, db_dir:str):
         raise e
     #lock = DatabaseLock(db_dir, table_name, instance_id)
     #lock.acquire_exclusive_lock()
-    file_operations.delete_table(table_name, db_dir, instance_id)
+    retire_instance(db_dir, table_name, instance_id)
     db_metadata.write_to_log(process_id)
     #lock.release_exclusive_lock()
 
@@ -214,7 +364,7 @@ def setup_table_instance(instance_id: str, table_name: str, db_dir: str, author:
                          gen_prompt: str = ''):
     if len(prompts) != 0 and gen_prompt not in prompts:
         raise ValueError('Need to Define gen_prompt')
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     allow_multiple = db_metadata.get_table_multiple(table_name)
     if not allow_multiple and instance_id != 'TEMP':
         raise ValueError('Cannot Define Instance ID for Table without Versioning')
@@ -226,14 +376,14 @@ def setup_table_instance(instance_id: str, table_name: str, db_dir: str, author:
         prev_start_time = db_metadata.get_table_version_update(prev_name_id, table_name)
     else:
         prev_start_time = 0
-    data = {'gen_prompt': gen_prompt, 'prompts': prompts, 'prev_name_id': prev_name_id}
+    data = {'gen_prompt': gen_prompt, 'prompts': prompts, 'prev_name_id': prev_name_id, 'lock_waits': lock.wait_times()}
     process_id = db_metadata.start_new_process(author, 'setup_table_instance', table_name, instance_id, data= data)
     file_operations.setup_table_instance(instance_id, table_name, db_dir, prev_name_id, prev_start_time, prompts, gen_prompt) 
     db_metadata.write_to_log(process_id)
     lock.release_exclusive_lock()
 
 def restart_setup_table_instance(author:str, process_id:str, db_dir:str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     process = db_metadata.update_process_restart(author, process_id)
     try:
         table_name = process.table_name
@@ -251,47 +401,96 @@ def restart_setup_table_instance(author:str, process_id:str, db_dir:str):
     db_metadata.write_to_log(process_id)
     #lock.release_exclusive_lock()
 
-def setup_table(table_name: str, db_dir: str, author: str, allow_multiple: bool = True):
-    db_metadata = MetaDataStore(db_dir)
+def setup_table(table_name: str, db_dir: str, author: str, allow_multiple: bool = True,
+                storage: str = DEFAULT_STORAGE):
+    if is_retirement_pending(db_dir, table_name):
+        raise ValueError(f'Table {table_name} is deleted once its last readers finish.')
+    db_metadata = get_metadata_store(db_dir)
     lock = DatabaseLock(db_dir, table_name)
     lock.acquire_exclusive_lock()
-    process_id  = db_metadata.start_new_process(author, 'setup_table', table_name, data= {'allow_multiple': allow_multiple})
-    file_operations.setup_table_folder(table_name, db_dir)
+    data = {'allow_multiple': allow_multiple, 'storage': storage, 'lock_waits': lock.wait_times()}
+    process_id  = db_metadata.start_new_process(author, 'setup_table', table_name, data= data)
+    file_operations.setup_table_folder(table_name, db_dir, storage)
     db_metadata.write_to_log(process_id)
     # write to metadata about multiple
     lock.release_exclusive_lock()
 
 def restart_setup_table(author:str, process_id:str, db_dir:str):
-    db_metadata = MetaDataStore(db_dir)
+    db_metadata = get_metadata_store(db_dir)
     process = db_metadata.update_process_restart(author, process_id)
     try:
         table_name = process.table_name
         allow_multiple = process.data['allow_multiple']
+        storage = process.data.get('storage', 'csv')
     except Exception as e:
         print(process)
         db_metadata.write_to_log(process_id, success=False)
         print(f'Error Fetching Data for process {process_id}. Not executed.')
     #lock = DatabaseLock(db_dir, table_name)
     #lock.acquire_exclusive_lock()
-    file_operations.setup_table_folder(table_name, db_dir)
+    file_operations.setup_table_folder(table_name, db_dir, storage)
     db_metadata.write_to_log(process_id)
     #lock.release_exclusive_lock()
 
 
 
 
+def _restart_process(author: str, process_id: str, operation: str, db_dir: str):
+    if operation == 'setup_table':
+        restart_setup_table(author, process_id, db_dir)
+    elif operation == 'setup_table_instance':
+        restart_setup_table_instance(author, process_id, db_dir)
+    elif operation == 'delete_table':
+        restart_delete_table(author, process_id, db_dir)
+    elif operation == 'delete_table_instance':
+        restart_delete_table_instance(author, process_id, db_dir)
+    elif operation == 'execute_table':
+        restart_execute_table(author, process_id, db_dir)
+
+def recover_table(author: str, db_dir: str, table_name: str, instance_id: Optional[str] = None) -> list[str]:
+    '''
+    Restarts the unfinished processes of one table (or table instance) whose worker died, while the rest
+    of the database keeps running. Locks left by the worker are taken over once their leases expire, and
+    its snapshot readers are dropped.
+    Only workers on this host can be detected as dead, use restart_database for the others.
+    '''
+    restart_lock = DatabaseLock(db_dir, table_name='RESTART')
+    restart_lock.acquire_shared_lock()
+    db_metadata = get_metadata_store(db_dir)
+    recovered = []
+    for id, process in db_metadata.get_active_processes().items():
+        if process.table_name != table_name or (instance_id != None and process.instance_id != instance_id):
+            continue
+        if process.pid == None or process_alive(process.host, process.pid):
+            continue
+        if process.operation == 'execute_table':
+            lock = DatabaseLock(db_dir, table_name, process.instance_id)
+        else:
+            lock = DatabaseLock(db_dir, table_name)
+        lock.acquire_exclusive_lock()
+        try:
+            _restart_process(author, id, process.operation, db_dir)
+        finally:
+            lock.release_exclusive_lock()
+        recovered.append(id)
+    # deletes deferred for the readers of the dead worker
+    reap_retired_instances(db_dir)
+    restart_lock.release_shared_lock()
+    return recovered
+
 def restart_database(author:str, db_dir: str, excluded_processes: list[str] = []):
     db_lock = DatabaseLock(db_dir)
     db_lock.acquire_shared_lock()
     restart_lock = DatabaseLock(db_dir, table_name='RESTART')
     restart_lock.acquire_exclusive_lock()
-    db_metadata = MetaDataStore(db_dir)
-    db_metadata.teminate_previous_restarts()
-    
-    data = {'excluded_processes': excluded_processes, 'active_ids': active_ids}
-    process_id = db_metadata.start_new_process(author, 'restart_database', table_name = '', data= data)
-    db_metadata.write_to_log_after_restart()
-    active_ids = db_metadata.get_process_ids()
+    db_metadata = get_metadata_store(db_dir)
+    with db_metadata.transaction():
+        db_metadata.teminate_previous_restarts()
+        db_metadata.write_to_log_after_restart()
+        active_ids = db_metadata.get_process_ids()
+        data = {'excluded_processes': excluded_processes, 'active_ids': active_ids,
+                'lock_waits': {**db_lock.wait_times(), **restart_lock.wait_times()}}
+        process_id = db_metadata.start_new_process(author, 'restart_database', table_name = '', data= data)
     
     for id, operation in active_ids:
         if id == process_id:
@@ -301,18 +500,10 @@ def restart_database(author:str, db_dir: str, excluded_processes: list[str] = []
                 db_metadata.update_process_step(id, 'stop_execute')
             else:
                 raise ValueError(f"Can Only Stop Table Executions Right Now: {id}")
-        if operation == 'setup_table':
-            restart_setup_table(author, id, db_dir)
-        elif operation == 'setup_table_instance':
-            restart_setup_table_instance(author, id, db_dir)
-        elif operation == 'delete_table':
-            restart_delete_table(author, id, db_dir)
-        elif operation == 'delete_table_instance':
-            restart_delete_table_instance(author, id, db_dir)
-        elif operation == 'execute_table':
-            restart_execute_table(author, id, db_dir)
+        _restart_process(author, id, operation, db_dir)
         db_metadata.update_process_step(process_id, (id, operation))
-    
+    # deletes deferred for readers that died with their process
+    reap_retired_instances(db_dir)
     db_metadata.write_to_log(process_id)
     db_lock.release_shared_lock()
     restart_lock.release_exclusive_lock()
\ No newline at end of file
@@ -4,7 +4,28 @@ Test basic features of database -> more comprehensive testing happens when we ac
 
 import subprocess
 import shutil
+import socket
+import time
 import os
+import json
+import asyncio
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from auto_data_table import file_operations, table_operations, storage_operations
+from auto_data_table.pipeline_operations import run_pipeline
+from auto_data_table.table_cache import TableCache
+from auto_data_table.storage_operations import STORAGE_BACKENDS, get_table_storage
+from auto_data_table.prompt_execution.prompt_parser_table import parse_prompt_from_yaml, _get_key_index
+from auto_data_table.prompt_execution import parse_code, parse_llm, prompt_parser, llm_prompts, memo_store
+from auto_data_table.meta_operations import MetaDataStore, get_metadata_store
+from auto_data_table.sqlite_meta_operations import SQLiteMetaDataStore, migrate_json_metadata
+from auto_data_table.database_lock import DatabaseLock, MultiLock, lock_histograms
+from auto_data_table.log_operations import OperationLog
+from auto_data_table.snapshot_operations import InstanceSnapshot, reap_retired_instances, _active_readers
 
 def copy_files_to_table(base_dir, db_dir, table_name):
     org_path = os.path.join(base_dir, table_name)
@@ -66,13 +87,599 @@ def test_single_row():
 # def test_column_update():
 #     pass
 
-# def test_row_update():
-#     pass
+CALC_CODE = '''
+import pandas as pd
+def read_rows(path):
+    return pd.read_csv(path)
+def count(name):
+    open(name_log, 'a').write(name + '\\n')
+    return (len(name),)
+name_log = NAME_LOG
+'''
+
+CALC_GEN = '''
+type: code
+dependencies: []
+changed_columns: [name]
+function: read_rows
+code_file: calc.py
+is_global: false
+is_udf: false
+arguments:
+  path: INPUTS
+'''
+
+CALC_COUNT = '''
+type: code
+dependencies: [self.name]
+changed_columns: [n]
+function: count
+code_file: calc.py
+is_global: false
+is_udf: true
+arguments:
+  name: <<self.name>>
+'''
+
+def _setup_calc_table(tmp_path, metadata: str) -> str:
+    '''Table calc: one row per name in inputs.csv, n is the length of the name. Calls are logged to calls.txt.'''
+    db_dir = str(tmp_path / 'db')
+    file_operations.setup_database(db_dir, metadata=metadata)
+    (tmp_path / 'inputs.csv').write_text('name\nab\nabc\n')
+    code = CALC_CODE.replace('NAME_LOG', repr(str(tmp_path / 'calls.txt')))
+    (tmp_path / 'db' / 'code_functions' / 'calc.py').write_text(code)
+    table_operations.setup_table('calc', db_dir, 'test', allow_multiple=False)
+    (tmp_path / 'db' / 'calc' / 'prompts' / 'gen.yaml').write_text(CALC_GEN.replace('INPUTS', str(tmp_path / 'inputs.csv')))
+    (tmp_path / 'db' / 'calc' / 'prompts' / 'count.yaml').write_text(CALC_COUNT)
+    return db_dir
+
+def _execute_calc(db_dir: str, prev_id: str = '') -> str:
+    table_operations.setup_table_instance('TEMP', 'calc', db_dir, 'test', prev_id, ['gen', 'count'], 'gen')
+    table_operations.execute_table('calc', db_dir, 'test', 'TEMP')
+    return get_metadata_store(db_dir).get_last_table_update('calc')[1]
+
+@pytest.mark.parametrize('metadata', ['sqlite', 'json'])
+def test_row_update(tmp_path, metadata):
+    db_dir = _setup_calc_table(tmp_path, metadata)
+    v1 = _execute_calc(db_dir)
+    db_metadata = get_metadata_store(db_dir)
+    v1_time = db_metadata.get_last_column_update('calc', 'n')[0]
+
+    # same inputs: nothing is recomputed and n keeps its version
+    os.remove(tmp_path / 'calls.txt')
+    v2 = _execute_calc(db_dir, v1)
+    assert not os.path.exists(tmp_path / 'calls.txt')
+    assert db_metadata.get_last_column_update('calc', 'n')[0] == v1_time
+
+    # a new input row is computed incrementally and n gets a new version
+    (tmp_path / 'inputs.csv').write_text('name\nab\nabc\nabcd\n')
+    v3 = _execute_calc(db_dir, v2)
+    assert (tmp_path / 'calls.txt').read_text().split() == ['abcd']
+    assert list(file_operations.get_table(v3, 'calc', db_dir)['n']) == [2, 3, 4]
+    assert db_metadata.get_last_column_update('calc', 'n')[0] > v1_time
 
 # def test_restart():
 #     # USE timeout test
 #     pass
 
+ECHO_GEN = '''
+type: code
+dependencies: [calc.name]
+changed_columns: [name]
+function: copy_rows
+code_file: echo.py
+is_global: false
+is_udf: false
+arguments:
+  column: name
+table_arguments:
+  df: calc
+'''
+
+def test_pipeline_twice(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    (tmp_path / 'db' / 'code_functions' / 'echo.py').write_text('def copy_rows(df, column):\n    return df[[column]].copy()\n')
+    table_operations.setup_table('echo', db_dir, 'test', allow_multiple=False)
+    (tmp_path / 'db' / 'echo' / 'prompts' / 'gen.yaml').write_text(ECHO_GEN)
+
+    def setup_instances(prev: dict[str, str]) -> None:
+        table_operations.setup_table_instance('TEMP', 'calc', db_dir, 'test', prev.get('calc', ''), ['gen', 'count'], 'gen')
+        table_operations.setup_table_instance('TEMP', 'echo', db_dir, 'test', prev.get('echo', ''), ['gen'], 'gen')
+
+    db_metadata = get_metadata_store(db_dir)
+    setup_instances({})
+    assert run_pipeline(['echo', 'calc'], db_dir, 'test') == {'echo': 'executed', 'calc': 'executed'}
+    # calc reads a file, it has no tracked inputs and is always executed, echo reads its new version
+    versions = {table: db_metadata.get_last_table_update(table)[1] for table in ['calc', 'echo']}
+    setup_instances(versions)
+    assert run_pipeline(['echo', 'calc'], db_dir, 'test') == {'echo': 'executed', 'calc': 'executed'}
+    # echo alone reads the same version of calc again: skipped and its instance removed
+    versions = {table: db_metadata.get_last_table_update(table)[1] for table in ['calc', 'echo']}
+    setup_instances(versions)
+    assert run_pipeline(['echo'], db_dir, 'test') == {'echo': 'skipped'}
+    assert not os.path.exists(tmp_path / 'db' / 'echo' / 'TEMP')
+    assert db_metadata.get_last_table_update('echo')[1] == versions['echo']
+
+FAIL_ECHO = '''
+import os
+def copy_rows(df, column):
+    if os.path.exists(FLAG):
+        raise ValueError('echo failed')
+    return df[[column]].copy()
+'''
+
+def test_pipeline_failure(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    code = FAIL_ECHO.replace('FLAG', repr(str(tmp_path / 'fail')))
+    (tmp_path / 'db' / 'code_functions' / 'echo.py').write_text(code)
+    table_operations.setup_table('echo', db_dir, 'test', allow_multiple=False)
+    (tmp_path / 'db' / 'echo' / 'prompts' / 'gen.yaml').write_text(ECHO_GEN)
+    table_operations.setup_table_instance('TEMP', 'calc', db_dir, 'test', '', ['gen', 'count'], 'gen')
+    table_operations.setup_table_instance('TEMP', 'echo', db_dir, 'test', '', ['gen'], 'gen')
+
+    (tmp_path / 'fail').touch()
+    assert run_pipeline(['calc', 'echo'], db_dir, 'test') == {'calc': 'executed', 'echo': 'failed'}
+    # the failed execution released its lock and its snapshot of calc, its process is left for a restart
+    assert _active_readers(db_dir, 'calc') == 0
+    lock = DatabaseLock(db_dir, 'echo', 'TEMP')
+    lock.acquire_exclusive_lock(timeout=5)
+    lock.release_exclusive_lock()
+    assert [process.table_name for process in get_metadata_store(db_dir).get_active_processes().values()] == ['echo']
+
+    # the same process runs it again
+    os.remove(tmp_path / 'fail')
+    assert run_pipeline(['echo'], db_dir, 'test') == {'echo': 'executed'}
+    version = get_metadata_store(db_dir).get_last_table_update('echo')[1]
+    assert list(file_operations.get_table(version, 'echo', db_dir)['name']) == ['ab', 'abc']
+
+def test_snapshot_lifecycle(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    v1 = _execute_calc(db_dir)
+    v2 = _execute_calc(db_dir, v1)
+
+    # an instance that is read while it is deleted is removed once its reader is done
+    snapshot = InstanceSnapshot(db_dir, 'calc', v1)
+    snapshot.acquire()
+    table_operations.delete_table_instance(v1, 'calc', db_dir, 'test')
+    assert list(file_operations.get_table(v1, 'calc', db_dir)['n']) == [2, 3]
+    with pytest.raises(FileNotFoundError):
+        InstanceSnapshot(db_dir, 'calc', v1).acquire()
+    # the reader is alive, so the delete stays deferred
+    reap_retired_instances(db_dir)
+    assert os.path.isdir(tmp_path / 'db' / 'calc' / v1)
+    snapshot.release()
+    assert not os.path.exists(tmp_path / 'db' / 'calc' / v1)
+
+    # readers of processes that died are dropped by the next reap
+    dead = subprocess.Popen(['python', '-c', 'pass'])
+    dead.wait()
+    reader_dir = tmp_path / 'db' / 'snapshots' / 'calc' / 'readers' / v2
+    reader_dir.mkdir(parents=True)
+    (reader_dir / f'{socket.gethostname()}_{dead.pid}_0').touch()
+    table_operations.delete_table_instance(v2, 'calc', db_dir, 'test')
+    assert os.path.isdir(tmp_path / 'db' / 'calc' / v2)
+    reap_retired_instances(db_dir)
+    assert not os.path.exists(tmp_path / 'db' / 'calc' / v2)
+
+def test_recover_table(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    version = _execute_calc(db_dir)
+    code = FAIL_ECHO.replace('FLAG', repr(str(tmp_path / 'fail'))).replace("raise ValueError('echo failed')", 'os._exit(1)')
+    (tmp_path / 'db' / 'code_functions' / 'echo.py').write_text(code)
+    table_operations.setup_table('echo', db_dir, 'test', allow_multiple=False)
+    (tmp_path / 'db' / 'echo' / 'prompts' / 'gen.yaml').write_text(ECHO_GEN)
+    table_operations.setup_table_instance('TEMP', 'echo', db_dir, 'test', '', ['gen'], 'gen')
+
+    # the worker dies while it reads calc
+    (tmp_path / 'fail').touch()
+    worker = subprocess.run(['python', '-c', 'import sys; from auto_data_table import table_operations; '
+                             'table_operations.execute_table("echo", sys.argv[1], "test")', db_dir])
+    assert worker.returncode == 1
+    assert _active_readers(db_dir, 'calc') == 1
+    os.remove(tmp_path / 'fail')
+
+    db_metadata = get_metadata_store(db_dir)
+    assert len(table_operations.recover_table('test', db_dir, 'echo')) == 1
+    assert db_metadata.get_active_processes() == {}
+    echo_version = db_metadata.get_last_table_update('echo')[1]
+    assert list(file_operations.get_table(echo_version, 'echo', db_dir)['name']) == ['ab', 'abc']
+    # the reader of the dead worker is gone, deleting calc isn't deferred
+    assert _active_readers(db_dir, 'calc') == 0
+    table_operations.delete_table_instance(version, 'calc', db_dir, 'test')
+    assert not os.path.exists(tmp_path / 'db' / 'calc' / version)
+
+STORIES = pd.DataFrame({'name': ['ab', 'abc', 'abcd'], 'n': [2, 3, 4], 'score': [0.5, 1.5, 2.5]})
+
+def _setup_storage_table(tmp_path, storage: str, instances: list[str]) -> str:
+    db_dir = str(tmp_path / 'db')
+    file_operations.setup_database(db_dir)
+    table_operations.setup_table('stories', db_dir, 'test', storage=storage)
+    for instance_id in instances:
+        os.makedirs(tmp_path / 'db' / 'stories' / instance_id)
+    return db_dir
+
+@pytest.mark.parametrize('storage', list(STORAGE_BACKENDS))
+def test_storage_round_trip(tmp_path, storage):
+    db_dir = _setup_storage_table(tmp_path, storage, ['v1'])
+    file_operations.write_table(STORIES, 'v1', 'stories', db_dir)
+    assert isinstance(get_table_storage('stories', db_dir), STORAGE_BACKENDS[storage])
+    df = file_operations.get_table('v1', 'stories', db_dir)
+    pd.testing.assert_frame_equal(df, STORIES, check_dtype=False)
+    if storage != 'csv':
+        # typed backends don't re-infer dtypes
+        assert list(df.dtypes[['n', 'score']]) == list(STORIES.dtypes[['n', 'score']])
+    # projection and filters, a filtered column doesn't have to be read
+    df = file_operations.get_table('v1', 'stories', db_dir, columns=['name'], filters=[('n', '>', 2)])
+    assert list(df.columns) == ['name'] and list(df['name']) == ['abc', 'abcd']
+    assert len(file_operations.get_table('v1', 'stories', db_dir, rows=2)) == 2
+
+def test_chunk_sharing(tmp_path, monkeypatch):
+    db_dir = _setup_storage_table(tmp_path, 'chunked', ['v1', 'v2'])
+    chunk_dir = tmp_path / 'db' / 'stories' / 'chunks'
+    file_operations.write_table(STORIES, 'v1', 'stories', db_dir)
+    assert len(os.listdir(chunk_dir)) == 3
+    # a new version only stores the column that changed
+    file_operations.write_table(STORIES.assign(n=[4, 3, 2]), 'v2', 'stories', db_dir)
+    assert len(os.listdir(chunk_dir)) == 4
+
+    # the chunk only v1 used is kept for the grace period after v1 is deleted
+    file_operations.delete_table('stories', db_dir, 'v1')
+    assert len(os.listdir(chunk_dir)) == 4
+    monkeypatch.setattr(storage_operations, 'CHUNK_GRACE_PERIOD', 0)
+    get_table_storage('stories', db_dir).collect_garbage(str(tmp_path / 'db' / 'stories'))
+    assert len(os.listdir(chunk_dir)) == 3
+    assert list(file_operations.get_table('v2', 'stories', db_dir)['n']) == [4, 3, 2]
+
+def test_delta_log(tmp_path):
+    db_dir = _setup_storage_table(tmp_path, 'chunked', ['v1'])
+    df = STORIES.assign(answer=pd.NA)
+    file_operations.write_table(df, 'v1', 'stories', db_dir)
+    delta_log = file_operations.TableDeltaLog(df, 'v1', 'stories', db_dir, compact_every=10)
+    delta_log.append(0, {'answer': 'x'})
+    delta_log.append(2, {'answer': 'y'})
+    # a crash while the next row was appended
+    with open(delta_log.delta_path, 'a') as file:
+        file.write('{"index": 1, "val')
+
+    # the base table is unchanged, readers replay the log
+    assert storage_operations.get_storage('chunked').read(str(tmp_path / 'db' / 'stories' / 'v1'))['answer'].isna().all()
+    assert list(file_operations.get_table('v1', 'stories', db_dir)['answer'].fillna('')) == ['x', '', 'y']
+    df = file_operations.get_table('v1', 'stories', db_dir, columns=['name'], filters=[('answer', '==', 'y')])
+    assert list(df['name']) == ['abcd']
+
+    delta_log.compact()
+    assert not os.path.exists(delta_log.delta_path)
+    assert list(file_operations.get_table('v1', 'stories', db_dir)['answer'].fillna('')) == ['x', '', 'y']
+
+def test_migrate_json_metadata(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'json')
+    v1 = _execute_calc(db_dir)
+    json_store = get_metadata_store(db_dir)
+    assert type(json_store) == MetaDataStore
+    json_store.start_new_process('test', 'delete_table_instance', 'calc', v1, data={'instance_id': v1})
+    answers = (json_store.get_last_table_update('calc'), json_store.get_last_column_update('calc', 'n'),
+               json_store.get_table_multiple('calc'), json_store.get_process_ids())
+
+    migrate_json_metadata(db_dir)
+    sqlite_store = get_metadata_store(db_dir)
+    assert type(sqlite_store) == SQLiteMetaDataStore
+    assert (sqlite_store.get_last_table_update('calc'), sqlite_store.get_last_column_update('calc', 'n'),
+            sqlite_store.get_table_multiple('calc'), sqlite_store.get_process_ids()) == answers
+    with pytest.raises(FileExistsError):
+        migrate_json_metadata(db_dir)
+    # the migrated database keeps working: the active process restarts and new versions are recorded
+    table_operations.restart_database('test', db_dir)
+    assert sqlite_store.get_active_processes() == {}
+    assert not os.path.exists(tmp_path / 'db' / 'calc' / v1)
+    (tmp_path / 'inputs.csv').write_text('name\nabcd\n')
+    v2 = _execute_calc(db_dir)
+    assert v2 != v1 and list(file_operations.get_table(v2, 'calc', db_dir)['n']) == [4]
+
+def test_journal_recovery(tmp_path, monkeypatch):
+    db_dir = str(tmp_path / 'db')
+    file_operations.setup_database(db_dir, metadata='json')
+    db_metadata = get_metadata_store(db_dir)
+    process_id = db_metadata.start_new_process('test', 'setup_table', 'stories', data={'allow_multiple': True})
+
+    # crash after the journal is written and the log appended, before the metadata files are replaced
+    def crash(*args, **kwargs):
+        raise RuntimeError('crash')
+    monkeypatch.setattr(MetaDataStore, '_dump_file', crash)
+    with pytest.raises(RuntimeError):
+        db_metadata.write_to_log(process_id)
+    monkeypatch.undo()
+    assert os.path.exists(db_metadata.transaction_file)
+    assert len(db_metadata.query_logs('stories')) == 1
+
+    # the next transaction of any process replays the journal, the log entry isn't appended twice
+    db_metadata = get_metadata_store(db_dir)
+    assert db_metadata.get_all_tables() == ['stories']
+    assert db_metadata.get_table_multiple('stories') == True
+    assert db_metadata.get_active_processes() == {}
+    assert not os.path.exists(db_metadata.transaction_file)
+    assert [log.process_id for log in db_metadata.query_logs('stories')] == [process_id]
+
+def test_operation_log(tmp_path):
+    operation_log = OperationLog(str(tmp_path), segment_size=300)
+    entries = []
+    for i in range(20):
+        table_name = ['stories', 'calc'][i % 2]
+        operation = 'execute_table' if i % 3 == 0 else 'setup_table_instance'
+        entries.append({'log_time': float(i), 'table_name': table_name, 'operation': operation,
+                        'instance_id': 'TEMP', 'data': {'perm_instance_id': f'v{i}'}})
+        operation_log.append([json.dumps(entries[-1]) + '\n'])
+        operation_log.rotate_if_full()
+    assert len(os.listdir(operation_log.segment_dir)) > 3
+
+    assert operation_log.query() == entries
+    calc_executions = [e for e in entries if e['table_name'] == 'calc' and e['operation'] == 'execute_table']
+    assert operation_log.query('calc', operation='execute_table') == calc_executions
+    assert operation_log.query(instance_id='v7') == [entries[7]]
+    assert operation_log.query(since=5, until=12) == entries[5:12]
+    # a segment sealed right before a crash is indexed by the next query
+    os.remove(operation_log.summary_file)
+    assert operation_log.query('stories', since=10) == [e for e in entries[10:] if e['table_name'] == 'stories']
+
+LOCK_WORKER = '''
+import sys, time
+from auto_data_table.database_lock import MultiLock
+lock_file, mode, order_file = sys.argv[1:]
+lock = MultiLock(lock_file)
+if mode == 'exclusive':
+    lock.acquire_exclusive()
+else:
+    lock.acquire_shared()
+with open(order_file, 'a') as file:
+    file.write(mode + '\\n')
+time.sleep(0.5)
+lock.release_exclusive() if mode == 'exclusive' else lock.release_shared()
+'''
+
+def _wait_for(condition, timeout: float = 10) -> None:
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+def test_lock_turnstile(tmp_path):
+    lock_file = str(tmp_path / 'TABLE.lock')
+    order_file = tmp_path / 'order.txt'
+    reader = MultiLock(lock_file)
+    reader.acquire_shared()
+    writer = subprocess.Popen(['python', '-c', LOCK_WORKER, lock_file, 'exclusive', str(order_file)])
+    # the writer holds the turnstile while it waits for the reader
+    _wait_for(lambda: os.path.isdir(lock_file + '.queue.lease') and len(os.listdir(lock_file + '.queue.lease')) > 0)
+    late_reader = subprocess.Popen(['python', '-c', LOCK_WORKER, lock_file, 'shared', str(order_file)])
+    time.sleep(1)
+    # only a reader holds the lock, but a new reader queues behind the waiting writer
+    assert not os.path.exists(order_file)
+    reader.release_shared()
+    assert writer.wait(timeout=30) == 0 and late_reader.wait(timeout=30) == 0
+    assert order_file.read_text().split() == ['exclusive', 'shared']
+
+def test_lock_histograms(tmp_path):
+    db_dir = str(tmp_path / 'db')
+    file_operations.setup_database(db_dir)
+    start = time.time()
+    lock = DatabaseLock(db_dir, 'stories')
+    for _ in range(2):
+        lock.acquire_exclusive_lock()
+        time.sleep(0.2)
+        lock.release_exclusive_lock()
+    lock.acquire_exclusive_lock()
+    with pytest.raises(TimeoutError):
+        DatabaseLock(db_dir, 'stories').acquire_exclusive_lock(timeout=0.1)
+    lock.release_exclusive_lock()
+
+    histograms = lock_histograms(db_dir, since=start)
+    assert set(histograms) == {'DATABASE.lock shared', 'stories/TABLE.lock exclusive'}
+    table = histograms['stories/TABLE.lock exclusive']
+    assert table['timeouts'] == 1 and table['wait']['count'] == 4 and table['hold']['count'] == 3
+    assert table['hold']['p50'] >= 0.2 and sum(table['hold']['buckets'].values()) == 3
+    assert histograms['DATABASE.lock shared']['hold']['count'] == 4
+    assert lock_histograms(db_dir, since=time.time()) == {}
+
+ECHO_CODE = '''
+def copy_rows(df, column):
+    return df[[column]].copy()
+'''
+
+def _setup_udf_table(tmp_path, code: str, prompt: dict) -> str:
+    '''Table udf: the names of calc and the columns the prompt udf computes from them with a function of udf.py.'''
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    (tmp_path / 'inputs.csv').write_text('name\na\nab\nabc\nabcd\n')
+    _execute_calc(db_dir)
+    (tmp_path / 'db' / 'code_functions' / 'echo.py').write_text(ECHO_CODE)
+    code = code.replace('UDF_LOG', repr(str(tmp_path / 'udf_calls.txt')))
+    (tmp_path / 'db' / 'code_functions' / 'udf.py').write_text(code)
+    table_operations.setup_table('udf', db_dir, 'test', allow_multiple=False)
+    (tmp_path / 'db' / 'udf' / 'prompts' / 'gen.yaml').write_text(ECHO_GEN)
+    prompt = {'type': 'code', 'dependencies': ['self.name', 'calc.name'], 'code_file': 'udf.py', 'is_global': False,
+              'is_udf': True, 'arguments': {'name': '<<self.name>>'}} | prompt
+    (tmp_path / 'db' / 'udf' / 'prompts' / 'udf.yaml').write_text(yaml.safe_dump(prompt))
+    table_operations.setup_table_instance('TEMP', 'udf', db_dir, 'test', '', ['gen', 'udf'], 'gen')
+    return db_dir
+
+def _get_udf_table(db_dir: str) -> pd.DataFrame:
+    return file_operations.get_table(get_metadata_store(db_dir).get_last_table_update('udf')[1], 'udf', db_dir)
+
+PROCESS_CODE = '''
+import os
+def where(name, df):
+    return len(name) + len(df), os.getpid()
+'''
+
+def test_process_executor(tmp_path):
+    db_dir = _setup_udf_table(tmp_path, PROCESS_CODE, {'function': 'where', 'changed_columns': ['n', 'pid'],
+                                                       'table_arguments': {'df': 'calc'}, 'executor': 'process',
+                                                       'n_threads': 2, 'chunk_size': 1})
+    table_operations.execute_table('udf', db_dir, 'test')
+    df = _get_udf_table(db_dir)
+    assert list(df['n']) == [5, 6, 7, 8]
+    assert os.getpid() not in set(df['pid'])
+
+BATCH_CODE = '''
+def lengths(name, suffix, df):
+    open(UDF_LOG, 'a').write(f'{type(name).__name__} {len(name)}\\n')
+    return name.str.len() + len(df), name + suffix
+'''
+
+def test_batch_udf(tmp_path):
+    db_dir = _setup_udf_table(tmp_path, BATCH_CODE, {'function': 'lengths', 'changed_columns': ['n', 'tagged'],
+                                                     'arguments': {'name': '<<self.name>>', 'suffix': '!'},
+                                                     'table_arguments': {'df': 'calc'}, 'is_batch': True,
+                                                     'batch_size': 3, 'n_threads': 2})
+    table_operations.execute_table('udf', db_dir, 'test')
+    # argument columns are passed as Series of up to batch_size rows
+    assert sorted((tmp_path / 'udf_calls.txt').read_text().splitlines()) == ['Series 1', 'Series 3']
+    df = _get_udf_table(db_dir)
+    assert list(df['n']) == [5, 6, 7, 8]
+    assert list(df['tagged']) == ['a!', 'ab!', 'abc!', 'abcd!']
+
+def test_code_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / '__cache__')
+    code_file = tmp_path / 'double.py'
+    code_file.write_text('def double(x):\n    return 2 * x\n')
+    double, namespace = parse_code.load_function_from_file(str(code_file), 'double', cache_dir)
+    assert double(2) == 4
+    # the namespace is reused in the process, a new process loads the cached bytecode
+    assert parse_code.load_function_from_file(str(code_file), 'double', cache_dir)[1] is namespace
+    monkeypatch.setattr(parse_code, '_modules', {})
+    def no_compile(*args):
+        raise AssertionError('compiled again')
+    monkeypatch.setattr(parse_code, 'compile', no_compile, raising=False)
+    assert parse_code.load_function_from_file(str(code_file), 'double', cache_dir)[0](2) == 4
+    monkeypatch.undo()
+
+    # an edited file is compiled again and the bytecode of the old version is removed
+    code_file.write_text('def double(x):\n    return x + x + 1\n')
+    assert parse_code.load_function_from_file(str(code_file), 'double', cache_dir)[0](2) == 5
+    assert len(os.listdir(cache_dir)) == 1
+
+CRASH_CODE = '''
+import os
+def step(name):
+    if name == 'abc' and os.path.exists(UDF_FLAG):
+        os._exit(1)
+    open(UDF_LOG, 'a').write(name + '\\n')
+    return (len(name) if name != 'a' else None,)
+'''
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_checkpoint_resume(tmp_path, executor):
+    code = CRASH_CODE.replace('UDF_FLAG', repr(str(tmp_path / 'crash')))
+    db_dir = _setup_udf_table(tmp_path, code, {'function': 'step', 'changed_columns': ['n'], 'executor': executor,
+                                               'n_threads': 1, 'chunk_size': 1, 'checkpoint_interval': 0})
+    # the worker dies in the third row
+    (tmp_path / 'crash').touch()
+    worker = subprocess.run(['python', '-c', 'import sys; from auto_data_table import table_operations; '
+                             'table_operations.execute_table("udf", sys.argv[1], "test")', db_dir], capture_output=True)
+    assert worker.returncode != 0
+    assert (tmp_path / 'udf_calls.txt').read_text().split() == ['a', 'ab']
+    os.remove(tmp_path / 'crash')
+    os.remove(tmp_path / 'udf_calls.txt')
+
+    # the restart only runs the rows that weren't checkpointed, including the row without a result
+    table_operations.restart_database('test', db_dir)
+    assert (tmp_path / 'udf_calls.txt').read_text().split() == ['abc', 'abcd']
+    assert list(_get_udf_table(db_dir)['n'].fillna(0)) == [0, 2, 3, 4]
+
+def test_table_cache(tmp_path):
+    db_dir = _setup_calc_table(tmp_path, 'sqlite')
+    version = _execute_calc(db_dir)
+    table_cache = TableCache(db_dir)
+    full = table_cache.get_table(version, 'calc')
+    projection = table_cache.get_table(version, 'calc', columns=['name'])
+    # served from the full table, then from the cached projection
+    assert table_cache.get_table(version, 'calc', columns=['name']) is projection
+    assert (table_cache.hits, table_cache.misses) == (2, 1)
+    assert list(projection.columns) == ['name'] and len(projection) == len(full)
+    # key indexes are built once per cached frame
+    index = _get_key_index(projection, ['name'], 'name', reusable=True)
+    assert _get_key_index(table_cache.get_table(version, 'calc', columns=['name']), ['name'], 'name', reusable=True) is index
+
+def test_memo_keys(tmp_path):
+    # reprs of large arrays are truncated, keys are computed from the data
+    values = np.arange(10000)
+    changed = values.copy()
+    changed[5000] = -1
+    for convert in [lambda v: v, pd.Series, lambda v: pd.DataFrame({'v': v})]:
+        key = memo_store.get_call_key('function', {'values': convert(values)})
+        assert key == memo_store.get_call_key('function', {'values': convert(values.copy())})
+        assert key != memo_store.get_call_key('function', {'values': convert(changed)})
+    assert memo_store.get_call_key('function', {'values': values}) != memo_store.get_call_key('function', {'values': pd.Series(values)})
+
+    memo = memo_store.MemoStore(str(tmp_path))
+    memo.put('ab', 1)
+    memo.get('ab')
+    memo.get('cd')
+    memo.record_stats('count')
+    memo.record_stats('count')
+    assert memo_store.get_memo_stats(str(tmp_path)) == {'count': {'hits': 2, 'misses': 2, 'evicted': 0}}
+
+class FakeOpenAI:
+    """Assistants API of the OpenAI client, a run answers with the number of messages and the last message."""
+    def __init__(self, wrap=lambda function: function):
+        self.messages = {}
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(create=wrap(lambda **kwargs: SimpleNamespace(id='assistant', **kwargs))),
+            threads=SimpleNamespace(
+                create=wrap(self._create_thread),
+                messages=SimpleNamespace(create=wrap(self._add_message), list=wrap(self._list_messages)),
+                runs=SimpleNamespace(create_and_poll=wrap(lambda **kwargs: SimpleNamespace(status='completed')))))
+
+    def _create_thread(self):
+        thread = SimpleNamespace(id=len(self.messages))
+        self.messages[thread.id] = []
+        return thread
+
+    def _add_message(self, thread_id, role, content):
+        self.messages[thread_id].append(content[0]['content'])
+
+    def _list_messages(self, thread_id):
+        answer = f'{len(self.messages[thread_id])}: {self.messages[thread_id][-1]}'
+        return SimpleNamespace(data=[SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value=answer))])])
+
+def _async_call(function):
+    async def call(*args, **kwargs):
+        return function(*args, **kwargs)
+    return call
+
+LLM_PROMPT = {'name': 'ask', 'changed_columns': ['answer', 'topic'], 'output_type': 'entity', 'entity_name': 'topic',
+              'model': 'model', 'temperature': 0.0, 'retry': 1}
+LLM_FIELDS = {'context_files': [], 'context_msgs': 'The paper is <<self.name>>.', 'instructions': 'Answer briefly.',
+              'questions': ['What is <<self.name>> about?']}
+
+def test_llm_engines(tmp_path):
+    db_dir = str(tmp_path / 'db')
+    logs = {}
+    for engine in ['thread', 'async']:
+        os.makedirs(os.path.join(db_dir, 'papers', engine))
+        df = pd.DataFrame({'name': ['ab', 'abc', 'abcd'], 'answer': [pd.NA, 'done', pd.NA],
+                           'topic': [pd.NA, 'done', pd.NA]})
+        cache = {'self': df}
+        rendered = {field: prompt_parser.render_table_values(parse_prompt_from_yaml(value), cache)
+                    for field, value in LLM_FIELDS.items()}
+        delta_log = file_operations.TableDeltaLog(df, engine, 'papers', db_dir, compact_every=0)
+        current = df[LLM_PROMPT['changed_columns']].copy()
+        if engine == 'thread':
+            client = FakeOpenAI()
+            for index in range(len(df)):
+                parse_llm._execute_llm(index, LLM_PROMPT, client, delta_log, cache, rendered, current)
+        else:
+            client = FakeOpenAI(_async_call)
+            async def execute_rows():
+                await asyncio.gather(*(parse_llm._execute_llm_async(index, LLM_PROMPT, client, delta_log, cache,
+                                                                    rendered, current) for index in range(len(df))))
+            asyncio.run(execute_rows())
+        with open(delta_log.delta_path) as file:
+            logs[engine] = sorted(file.read().splitlines())
+    # the row that already has an answer is skipped
+    assert len(logs['thread']) == 2
+    assert logs['thread'] == logs['async']
+    assert json.loads(logs['thread'][0]) == {'index': 0, 'values': {'answer': '2: What is ab about?',
+                                                                    'topic': f'3: {llm_prompts.ENTITY_MSG.replace("ENTITY_NAME", "topic")}'}}
+
 def cleanup_folder():
     shutil.rmtree(yaml_base_dir)
 